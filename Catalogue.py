@@ -0,0 +1,131 @@
+from __future__ import annotations
+import os
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+from DataStore import dataset_path, iter_rows, read_dataset
+
+# Справочники ВходныеДанные/Номенклатура и КатегорииСайта в памяти процесса.
+# Файл читается один раз и перечитывается, только когда у него меняются путь, время изменения или размер
+# (загрузка нового справочника в интерфейсе, смена формата .csv/.parquet). Обработчики выгрузок Mindbox
+# присоединяют поля справочника через join(); при потоковой загрузке это один раз на файл, а не на каждый кусок.
+#
+#   nomenclature(data_dir)  DataFrame с индексом КодНоменклатуры, повторяющиеся строки — category
+#   categories(data_dir)    то же для КатегорииСайта с индексом КодКатегории
+#   item_names(data_dir)    {КодНоменклатуры: НазваниеНаСайте} без pandas (для Inference.py)
+#
+# Возвращаемые таблицы общие для всех вызывающих — их нельзя изменять на месте.
+# pandas импортируется только внутри функций, как и в DataStore.py.
+
+NOMENCLATURE_KEY = "КодНоменклатуры"
+CATEGORIES_KEY = "КодКатегории"
+
+# Строковая колонка хранится как category, если уникальных значений не больше этой доли строк
+_CATEGORY_MAX_SHARE = 0.5
+
+_lock = threading.Lock()
+_cache: Dict[Tuple[str, str], Tuple[tuple, object]] = {}
+
+
+# Отпечаток файла для проверки актуальности кэша; None — файла нет
+def _stamp(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path, st.st_mtime_ns, st.st_size
+
+
+def _cached(data_dir: str, stem: str, kind: str, build):
+    path = dataset_path(data_dir, stem)
+    stamp = _stamp(path)
+    if stamp is None:
+        return None
+    key = (os.path.abspath(data_dir), stem + ":" + kind)
+    with _lock:
+        hit = _cache.get(key)
+        if hit is not None and hit[0] == stamp:
+            return hit[1]
+    value = build(path)
+    with _lock:
+        _cache[key] = (stamp, value)
+    return value
+
+
+def _indexed_frame(path: str, key: str):
+    import pandas as pd
+
+    df = read_dataset(path, as_str=True)
+    if key not in df.columns:
+        return df
+    for col in df.columns:
+        if col == key:
+            continue
+        s = df[col]
+        if s.nunique(dropna=True) <= _CATEGORY_MAX_SHARE * len(df):
+            # Категории в типе исходной колонки: join() раскрывает их обратно без смены dtype
+            df[col] = s.astype(pd.CategoricalDtype(pd.Index(s.dropna().unique(), dtype=s.dtype)))
+    return df.set_index(key, drop=False).rename_axis(None)
+
+
+# Номенклатура как DataFrame с индексом по коду; None, если файл ещё не загружен
+def nomenclature(data_dir: str = "ВходныеДанные"):
+    return _cached(data_dir, "Номенклатура", "frame", lambda p: _indexed_frame(p, NOMENCLATURE_KEY))
+
+
+# Категории сайта как DataFrame с индексом по коду категории; None, если файл ещё не загружен
+def categories(data_dir: str = "ВходныеДанные"):
+    return _cached(data_dir, "КатегорииСайта", "frame", lambda p: _indexed_frame(p, CATEGORIES_KEY))
+
+
+# Левое присоединение колонок справочника к df по df[on] — результат как у
+# df.merge(frame[[key] + columns], left_on=on, right_on=key, how="left") без колонки key (индекс тоже сбрасывается).
+# При уникальном коде строки берутся по позициям индекса, категории раскрываются в исходный тип строк.
+def join(df, frame, on: str, columns: Sequence[str]):
+    import numpy as np
+    import pandas as pd
+    from pandas.api.extensions import take
+
+    columns = list(columns)
+    if not frame.index.is_unique:
+        right = frame[columns].rename_axis("__key").reset_index()
+        for col in columns:
+            if isinstance(right[col].dtype, pd.CategoricalDtype):
+                right[col] = right[col].astype(right[col].cat.categories.dtype)
+        return df.merge(right, left_on=on, right_on="__key", how="left").drop(columns=["__key"])
+
+    pos = frame.index.get_indexer(df[on])
+    found = pos >= 0
+    out = df.reset_index(drop=True)
+    for col in columns:
+        s = frame[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            codes = np.where(found, s.cat.codes.to_numpy()[pos], -1)
+            values, dtype = take(s.cat.categories.array, codes, allow_fill=True), s.cat.categories.dtype
+        else:
+            values, dtype = take(s.array, pos, allow_fill=True), s.dtype
+        out[col] = pd.Series(values, index=out.index, dtype=dtype)
+    return out
+
+
+def _names(path: str) -> Dict[str, str]:
+    names = {}
+    for code, name in iter_rows(path, (NOMENCLATURE_KEY, "НазваниеНаСайте")):
+        if code and name:
+            names[code] = name
+    return names
+
+
+# Соответствие код -> название на сайте; {} если номенклатуры нет или её не удалось прочитать
+def item_names(data_dir: str = "ВходныеДанные") -> Dict[str, str]:
+    try:
+        names = _cached(data_dir, "Номенклатура", "names", _names)
+    except Exception:
+        return {}
+    return names or {}
+
+
+# Сброс кэша (например, в тестах или после ручной замены файлов с тем же временем изменения)
+def clear() -> None:
+    with _lock:
+        _cache.clear()
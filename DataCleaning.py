@@ -0,0 +1,171 @@
+from __future__ import annotations
+import sys
+import time
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from DataStore import _cli_value
+
+# Очистка полей выгрузок Mindbox, общая для обработчиков заказов, просмотров и избранного.
+# Все функции работают целыми колонками (.str и numpy) и дают тот же результат, что построчные
+# apply/agg в прежних обработчиках. Сравнение скорости и совпадения результатов:
+#
+#   python DataCleaning.py --benchmark [--rows 200000]
+#
+# main.py подключает модуль лениво, при первой обработке файла.
+
+# Значения, которые после очистки считаются пустыми
+EMPTY_MARKERS = ["", " ", "  ", "None", "none", "NULL", "null", "-", "--", "nan"]
+
+
+# Числовые коды (карта, номер заказа, MindboxID) в строку без ".0": 123.0 -> "123"; пропуск остаётся NaN.
+# Колонку float (так pandas читает коды с пропусками) переводим через int64 в numpy: целые значения
+# меньше 1e16 str() печатает без экспоненты, поэтому результат совпадает с str(int(x))
+def strip_float_suffix(s: pd.Series) -> pd.Series:
+    if s.dtype.kind != "f":
+        return s.astype(str).str.replace(r"\.0$", "", regex=True).where(s.notna(), np.nan)
+
+    x = s.to_numpy()
+    out = np.full(len(x), np.nan, dtype=object)
+    whole = np.isfinite(x) & (np.floor(x) == x) & (np.abs(x) < 1e16)
+    out[whole] = x[whole].astype(np.int64).astype(str).astype(object)
+    rest = ~whole & ~np.isnan(x)
+    out[rest] = [str(v) for v in x[rest].tolist()]
+    return pd.Series(out, index=s.index)
+
+
+# Телефон: основной, при отсутствии — запасной, в строку без ".0"
+def merge_phones(main: pd.Series, pending: pd.Series) -> pd.Series:
+    return strip_float_suffix(main.combine_first(pending))
+
+
+# Код категории в строку: без ".0" на конце, без точек и запятых, без пробелов по краям
+def clean_category_code(s: pd.Series) -> pd.Series:
+    return (
+        s.astype(str)
+        .str.replace(r"\.0$", "", regex=True)  # убираем только .0 в конце
+        .str.replace(r"[.,]", "", regex=True)  # убираем лишние знаки, если вдруг есть
+        .str.strip()
+    )
+
+
+# Замена всех видов пустых значений на NaN
+def blank_to_nan(df):
+    return df.replace(EMPTY_MARKERS, np.nan)
+
+
+# Склейка колонок через sep с пропуском значений "nan"/NaN (пустые строки сохраняются, как и раньше)
+def join_present(df: pd.DataFrame, columns: Sequence[str], sep: str = "_") -> pd.Series:
+    out = np.full(len(df), "", dtype=object)
+    started = np.zeros(len(df), dtype=bool)
+    for col in columns:
+        text = df[col].astype(str)
+        valid = (df[col].notna() & text.ne("nan")).to_numpy()
+        value = text.where(valid, "").to_numpy(dtype=object)
+        prefix = np.where(started, out + sep, "")
+        out = np.where(valid, prefix + value, out)
+        started |= valid
+    return pd.Series(out, index=df.index)
+
+
+# ФИО из фамилии, имени и отчества через пробел; пропуски пропускаются, пробелы по краям убираются
+def full_name(df: pd.DataFrame, columns: Sequence[str] = ("Фамилия", "Имя", "Отчество")) -> pd.Series:
+    parts = [df[col].fillna("").astype(str) for col in columns]
+    return parts[0].str.cat(parts[1:], sep=" ").str.strip()
+
+
+# Прежние построчные варианты — только для сравнения в бенчмарке
+def _legacy_strip_float_suffix(s: pd.Series) -> pd.Series:
+    return s.apply(lambda x: str(int(x)) if pd.notnull(x) and str(x).endswith(".0") else str(x))
+
+
+def _legacy_merge_phones(main: pd.Series, pending: pd.Series) -> pd.Series:
+    return main.combine_first(pending).apply(
+        lambda x: str(x)[:-2] if pd.notnull(x) and str(x).endswith(".0") else str(x) if pd.notnull(x) else np.nan)
+
+
+def _legacy_join_present(df: pd.DataFrame, columns: Sequence[str], sep: str = "_") -> pd.Series:
+    return df[list(columns)].apply(lambda row: sep.join([str(x) for x in row if pd.notnull(x) and x != "nan"]),
+                                   axis=1)
+
+
+def _legacy_full_name(df: pd.DataFrame, columns: Sequence[str] = ("Фамилия", "Имя", "Отчество")) -> pd.Series:
+    return df[list(columns)].fillna("").agg(" ".join, axis=1).str.strip()
+
+
+# Синтетическая выгрузка с пропусками, числовыми кодами из float и пустыми категориями
+def _benchmark_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+
+    def with_gaps(values: np.ndarray, share: float) -> pd.Series:
+        s = pd.Series(values)
+        return s.where(rng.random(rows) >= share)
+
+    names = np.array(["Иванов", "Петрова", "Сидоров", "Ким", "Ли"], dtype=object)
+    categories = np.array(["101", "2.05", "3,7", " 44 ", "", "nan"], dtype=object)
+    return pd.DataFrame({
+        "ТелефонОсновной": with_gaps(rng.integers(79_000_000_000, 79_999_999_999, rows).astype(float), 0.3),
+        "ЗапаснойТелефон": with_gaps(rng.integers(77_000_000_000, 77_999_999_999, rows).astype(float), 0.5),
+        "ДисконтнаяКарта": with_gaps(rng.integers(1, 10 ** 13, rows).astype(float), 0.4),
+        "Фамилия": with_gaps(names[rng.integers(0, len(names), rows)], 0.2),
+        "Имя": with_gaps(names[rng.integers(0, len(names), rows)], 0.2),
+        "Отчество": with_gaps(names[rng.integers(0, len(names), rows)], 0.6),
+        "Категория1": with_gaps(rng.integers(1, 500, rows).astype(float), 0.3),
+        "Категория2": with_gaps(categories[rng.integers(0, len(categories), rows)], 0.3),
+        "Категория3": with_gaps(rng.integers(1, 500, rows).astype(float), 0.5),
+    })
+
+
+def benchmark(rows: int = 200_000) -> List[Dict[str, object]]:
+    df = _benchmark_frame(rows)
+    cats = df[["Категория1", "Категория2", "Категория3"]].apply(clean_category_code)
+    cat_cols = list(cats.columns)
+
+    cases: List[tuple] = [
+        ("Телефон", lambda: _legacy_merge_phones(df["ТелефонОсновной"], df["ЗапаснойТелефон"]),
+         lambda: merge_phones(df["ТелефонОсновной"], df["ЗапаснойТелефон"])),
+        ("ДисконтнаяКарта", lambda: _legacy_strip_float_suffix(df["ДисконтнаяКарта"]),
+         lambda: strip_float_suffix(df["ДисконтнаяКарта"])),
+        ("ЛюбимаяКатегория", lambda: _legacy_join_present(cats, cat_cols),
+         lambda: join_present(cats, cat_cols)),
+        ("ФИО", lambda: _legacy_full_name(df), lambda: full_name(df)),
+    ]
+
+    results = []
+    for name, legacy, vectorized in cases:
+        legacy_s, legacy_out = _timed(legacy)
+        new_s, new_out = _timed(vectorized)
+        results.append({
+            "field": name,
+            "legacy_s": legacy_s,
+            "vectorized_s": new_s,
+            "speedup": legacy_s / new_s if new_s > 0 else float("inf"),
+            "equal": _same(legacy_out, new_out),
+        })
+    return results
+
+
+def _timed(fn: Callable[[], pd.Series]):
+    t = time.perf_counter()
+    out = fn()
+    return time.perf_counter() - t, out
+
+
+# Совпадение после замены пустых значений на NaN — в таком виде поля попадают в датасет
+def _same(a: pd.Series, b: pd.Series) -> bool:
+    return bool(blank_to_nan(a.astype(object)).equals(blank_to_nan(b.astype(object))))
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if "--benchmark" in argv:
+        rows = int(_cli_value(argv, "--rows", "200000"))
+        print(f"Строк: {rows}")
+        print(f"{'поле':<18}{'построчно, с':>14}{'колонками, с':>14}{'ускорение':>11}  совпадает")
+        for r in benchmark(rows):
+            print(f"{r['field']:<18}{r['legacy_s']:>14.3f}{r['vectorized_s']:>14.3f}{r['speedup']:>10.1f}x  {r['equal']}")
+    else:
+        print("Usage:")
+        print("  python DataCleaning.py --benchmark [--rows 200000]")
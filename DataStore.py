@@ -0,0 +1,1025 @@
+from __future__ import annotations
+import os
+import sys
+import csv
+import json
+import time
+import uuid
+import itertools
+import threading
+import importlib.util
+from typing import Iterator, List, Optional, Tuple
+
+# Хранилище обработанных датасетов в ВходныеДанные/.
+# Каждый датасет — это основа имени (ЗаказыОригинал, ЗаказыОтбор, Номенклатура, ...) и одно из расширений:
+#   .parquet  колоночный формат с типами: даты — datetime64, числа — int/Int64/float, повторяющиеся строки — category
+#   .csv      прежний текстовый формат: разделитель |, кодировка utf-8-sig, все значения — строки
+#   .manifest сегментированный датасет после дозаписи ("Добавить данные к существующему"): JSON-список файлов
+#             в папке <основа>.segments/, по одному на загрузку; читатели ниже объединяют их прозрачно
+#   .rowhash  папка индекса загруженных строк и файлов выгрузки — по нему дозапись отбрасывает повторы
+# Новые файлы пишутся в STORE_FORMAT, читаются оба формата. CSV для внешних программ выгружается отдельно:
+#
+#   python DataStore.py --export-csv [--data-dir ВходныеДанные] [--out ЭкспортCSV]
+#   python DataStore.py --convert [--data-dir ВходныеДанные]      # перезаписать старые .csv в STORE_FORMAT
+#   python DataStore.py --compact [--data-dir ВходныеДанные]      # слить сегменты каждого датасета в один
+#
+# pandas и pyarrow импортируются только внутри функций: модуль можно подключать из интерфейса и Inference.py.
+
+STORE_EXTENSIONS = {"parquet": ".parquet", "csv": ".csv"}
+
+# Формат записи: parquet, если установлен pyarrow; переопределяется переменной окружения RS_STORE_FORMAT=parquet|csv.
+STORE_FORMAT = os.environ.get("RS_STORE_FORMAT") or (
+    "parquet" if importlib.util.find_spec("pyarrow") is not None else "csv"
+)
+if STORE_FORMAT not in STORE_EXTENSIONS:
+    STORE_FORMAT = "csv"
+
+MANIFEST_EXTENSION = ".manifest"
+MANIFEST_FORMAT = 1
+
+# Фоновое сжатие запускается, когда у датасета накопилось столько сегментов (переменная окружения RS_COMPACT_SEGMENTS)
+COMPACT_MIN_SEGMENTS = int(os.environ.get("RS_COMPACT_SEGMENTS", "8"))
+
+# Сколько секунд сегменты, заменённые сжатием, остаются на диске для читателей старого манифеста
+# (переменная окружения RS_RETIRED_GRACE_SECONDS)
+RETIRED_GRACE_SECONDS = float(os.environ.get("RS_RETIRED_GRACE_SECONDS", "600"))
+
+# Колонки с датами и числами. Остальные строковые колонки числами не считаются даже если похожи
+# (MindboxID, КодНоменклатуры, НомерЗаказа — коды с ведущими нулями).
+_DATE_COLUMNS = ("Дата", "ДатаРождения")
+_NUMERIC_COLUMNS = ("Количество", "НачальнаяЦена", "КонечнаяСтоимость", "НачальнаяСтоимость", "ПроцентСкидки", "Возраст")
+
+# Строковая колонка хранится как category, если уникальных значений не больше этой доли строк.
+_CATEGORY_MAX_SHARE = 0.5
+
+
+# -------------------------------------------Пути---------------------------------------------------------------------
+
+# Существующий файл датасета stem в data_dir (при наличии нескольких форматов — более свежий);
+# для сегментированного датасета это его манифест. Если файла нет — путь, по которому он будет записан.
+def dataset_path(data_dir: str, stem: str) -> str:
+    found = [
+        os.path.join(data_dir, stem + ext)
+        for ext in (*STORE_EXTENSIONS.values(), MANIFEST_EXTENSION)
+        if os.path.isfile(os.path.join(data_dir, stem + ext))
+    ]
+    if found:
+        return max(found, key=os.path.getmtime)
+    return target_path(data_dir, stem)
+
+
+# Путь для записи датасета stem в текущем формате хранилища.
+def target_path(data_dir: str, stem: str) -> str:
+    return os.path.join(data_dir, stem + STORE_EXTENSIONS[STORE_FORMAT])
+
+
+def _is_parquet(path: str) -> bool:
+    return path.lower().endswith(".parquet")
+
+
+def _is_manifest(path: str) -> bool:
+    return path.lower().endswith(MANIFEST_EXTENSION)
+
+
+# Основа имени датасета без расширения.
+def dataset_stem(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+# -------------------------------------------Чтение-------------------------------------------------------------------
+
+# Имена колонок без чтения данных.
+def dataset_columns(path: str) -> List[str]:
+    if _is_manifest(path):
+        names: List[str] = []
+        for seg in segment_paths(path):
+            names.extend(n for n in dataset_columns(seg) if n not in names)
+        return names
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+        return list(pq.read_schema(path).names)
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return next(csv.reader(f, delimiter="|"), [])
+
+
+# Читает датасет в DataFrame. columns — только эти колонки (отсутствующие в файле пропускаются).
+# as_str=True — все значения строками, как при прежнем pd.read_csv(..., dtype=str); иначе типы из parquet,
+# причём category раскладываются обратно в обычные строки (fillna/.str в коде анализа работают как раньше).
+def read_dataset(path: str, columns: Optional[List[str]] = None, as_str: bool = False):
+    import pandas as pd
+
+    if _is_manifest(path):
+        frames = [read_dataset(seg, columns, as_str) for seg in segment_paths(path)]
+        if not frames:
+            return pd.DataFrame(columns=columns or [])
+        return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+    use = None
+    if columns is not None:
+        present = set(dataset_columns(path))
+        use = [c for c in columns if c in present]
+
+    if not _is_parquet(path):
+        return pd.read_csv(path, sep="|", dtype=str, encoding="utf-8-sig", usecols=use)
+
+    df = pd.read_parquet(path, columns=use)
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            df[col] = s.astype(object)
+        if as_str and not pd.api.types.is_string_dtype(df[col]):
+            s = df[col]
+            if pd.api.types.is_datetime64_any_dtype(s):
+                text = s.dt.strftime("%Y-%m-%d")
+            else:
+                text = s.astype(str)
+            df[col] = text.astype(object).where(s.notna(), None)
+    return df
+
+
+# Датасет кусками по chunk_rows строк (DataFrame), без загрузки файла целиком.
+# columns — только эти колонки (отсутствующие в файле пропускаются).
+def iter_dataset_chunks(path: str, chunk_rows: int = 200_000, columns: Optional[List[str]] = None):
+    import pandas as pd
+
+    if _is_manifest(path):
+        for seg in segment_paths(path):
+            yield from iter_dataset_chunks(seg, chunk_rows, columns)
+        return
+    use = None
+    if columns is not None:
+        present = set(dataset_columns(path))
+        use = [c for c in columns if c in present]
+    if not _is_parquet(path):
+        yield from pd.read_csv(path, sep="|", dtype=str, encoding="utf-8-sig", chunksize=chunk_rows, usecols=use)
+        return
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=use):
+        df = batch.to_pandas()
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+        yield df
+
+
+# Построчный проход по колонкам columns без pandas: кортежи значений (отсутствующая колонка — None).
+# CSV читается через csv.reader, parquet — пакетами через pyarrow (читаются только нужные колонки).
+def iter_rows(path: str, columns: Tuple[str, ...]) -> Iterator[tuple]:
+    if _is_manifest(path):
+        for seg in segment_paths(path):
+            yield from iter_rows(seg, columns)
+        return
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        present = set(pf.schema_arrow.names)
+        use = [c for c in columns if c in present]
+        for batch in pf.iter_batches(columns=use):
+            values = {name: batch.column(i).to_pylist() for i, name in enumerate(batch.schema.names)}
+            cols = [values.get(c, [None] * batch.num_rows) for c in columns]
+            yield from zip(*cols)
+        return
+
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f, delimiter="|")
+        header = next(reader, None)
+        if header is None:
+            return
+        pos = [header.index(c) if c in header else -1 for c in columns]
+        for rec in reader:
+            n = len(rec)
+            yield tuple(rec[p] if 0 <= p < n else None for p in pos)
+
+
+# -------------------------------------------Запись-------------------------------------------------------------------
+
+# Приводит колонки к типам для parquet. Преобразование делается, только если не теряет значений:
+# даты — в datetime64, числовые колонки — в int/float (с пропусками — Int64), прочее — в строки,
+# частые строки — в category. Пустые строки становятся пропусками, как и после записи/чтения через CSV.
+def _typed_for_storage(df):
+    import pandas as pd
+
+    out = df.copy()
+    for col in out.columns:
+        s = out[col]
+        if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+            continue
+
+        s = s.where(~s.isin([""]), None)
+        notna = int(s.notna().sum())
+
+        if col in _DATE_COLUMNS:
+            conv = pd.to_datetime(s, errors="coerce")
+            if int(conv.notna().sum()) == notna:
+                out[col] = conv
+                continue
+
+        if col in _NUMERIC_COLUMNS:
+            num = pd.to_numeric(s, errors="coerce")
+            if int(num.notna().sum()) == notna:
+                if notna < len(num) and (num.dropna() % 1 == 0).all():
+                    num = num.astype("Int64")
+                out[col] = num
+                continue
+
+        # смешанные значения (строки вперемешку с числами после дозаписи) сохраняются строками
+        s = s.astype(object).where(s.isna(), s.astype(str))
+
+        if len(s) and s.nunique(dropna=True) <= _CATEGORY_MAX_SHARE * len(s):
+            s = s.astype("category")
+        out[col] = s
+    return out
+
+
+# Записывает датасет по пути path (формат — по расширению). Запись атомарная (временный файл + rename);
+# файлы того же датасета в другом формате удаляются, чтобы читатели не увидели устаревшую копию.
+def write_dataset(df, path: str) -> None:
+    _write_file(df, path)
+    _remove_other_formats(path)
+
+
+def _write_file(df, path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    if _is_parquet(path):
+        _typed_for_storage(df).to_parquet(tmp, index=False, engine="pyarrow")
+    else:
+        df.to_csv(tmp, index=False, sep="|", encoding="utf-8-sig")
+    os.replace(tmp, path)
+
+
+# Удаляет копии датасета в других форматах, включая манифест с сегментами (перезапись заменяет дозаписанное).
+def _remove_other_formats(path: str) -> None:
+    import shutil
+
+    base = os.path.join(os.path.dirname(path), dataset_stem(path))
+    with _segments_lock:
+        for ext in (*STORE_EXTENSIONS.values(), MANIFEST_EXTENSION):
+            other = base + ext
+            if other != path and os.path.isfile(other):
+                os.remove(other)
+        if os.path.isdir(base + ".segments"):
+            shutil.rmtree(base + ".segments", ignore_errors=True)
+
+
+# Общий тип колонки для частей, записанных по отдельности (в одной части колонка может оказаться
+# целиком пустой, в другой — числовой, в третьей — строковой).
+def _unify_arrow_types(types: list):
+    import pyarrow as pa
+
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.string()
+    if all(t == types[0] for t in types):
+        return types[0]
+    if all(pa.types.is_timestamp(t) for t in types):
+        return types[0]
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64() if any(pa.types.is_floating(t) for t in types) else pa.int64()
+    if any(pa.types.is_dictionary(t) for t in types):
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+# Метаданные pandas для собранного файла: описание каждой колонки берётся из части, где у неё тот же тип
+# (по ним pandas восстанавливает Int64 с пропусками и category). Без них nullable-целые читались бы как float.
+def _merged_pandas_metadata(schemas: list, schema) -> Optional[bytes]:
+    import pyarrow as pa
+
+    base, cols = None, {}
+    for sch in schemas:
+        md = sch.pandas_metadata
+        if not md:
+            continue
+        base = base or md
+        for entry in md.get("columns", []):
+            name = entry.get("field_name")
+            if name in cols or name not in sch.names or name not in schema.names:
+                continue
+            t, u = sch.field(name).type, schema.field(name).type
+            if t == u or (pa.types.is_dictionary(t) and pa.types.is_dictionary(u)):
+                cols[name] = entry
+    if base is None:
+        return None
+    generic = {"pandas_type": "object", "numpy_type": "object", "metadata": None}
+    base = dict(base, index_columns=[], columns=[cols.get(n) or dict(generic, name=n, field_name=n) for n in schema.names])
+    return json.dumps(base).encode("utf-8")
+
+
+def _cast_column(col, target):
+    import pyarrow as pa
+
+    if col.type == target:
+        return col
+    if pa.types.is_dictionary(target) and not (pa.types.is_string(col.type) or pa.types.is_dictionary(col.type)):
+        col = col.cast(pa.string())
+    return col.cast(target)
+
+
+class DatasetWriter:
+    """
+    Пишет датасет по частям: write(df) для каждого обработанного куска, close() собирает итоговый файл.
+
+    CSV дописывается сразу во временный файл. Для parquet каждый кусок сохраняется отдельной частью
+    (со своими типами), а close() потоково переписывает части в один файл с общей схемой — в памяти
+    одновременно находится не больше одного пакета строк. Итоговый файл появляется атомарно.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows = 0
+        self._tmp = path + ".tmp"
+        self._parts_dir = path + ".parts"
+        self._parts: List[str] = []
+        self._csv_started = False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if _is_parquet(path):
+            import shutil
+            shutil.rmtree(self._parts_dir, ignore_errors=True)
+            os.makedirs(self._parts_dir)
+
+    # Существующий датасет становится началом нового файла (сегментированный — всеми сегментами по порядку).
+    def include(self, existing_path: str, chunk_rows: int = 200_000) -> None:
+        if _is_manifest(existing_path):
+            for seg in segment_paths(existing_path):
+                self.include(seg, chunk_rows)
+            return
+        if _is_parquet(self.path) and _is_parquet(existing_path):
+            self._parts.append(existing_path)
+            self.rows += _parquet_rows(existing_path)
+            return
+        for chunk in iter_dataset_chunks(existing_path, chunk_rows):
+            self.write(chunk)
+
+    def write(self, df) -> None:
+        if df is None or not len(df):
+            return
+        if _is_parquet(self.path):
+            part = os.path.join(self._parts_dir, f"{len(self._parts):06d}.parquet")
+            _typed_for_storage(df).to_parquet(part, index=False, engine="pyarrow")
+            self._parts.append(part)
+        else:
+            df.to_csv(self._tmp, index=False, sep="|", encoding="utf-8-sig" if not self._csv_started else "utf-8",
+                      mode="a" if self._csv_started else "w", header=not self._csv_started)
+            self._csv_started = True
+        self.rows += len(df)
+
+    def close(self) -> int:
+        if _is_parquet(self.path):
+            self._assemble_parquet()
+        elif not self._csv_started:
+            return 0
+        os.replace(self._tmp, self.path)
+        _remove_other_formats(self.path)
+        self.abort()
+        return self.rows
+
+    def abort(self) -> None:
+        import shutil
+        shutil.rmtree(self._parts_dir, ignore_errors=True)
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def _assemble_parquet(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schemas = [pq.read_schema(p) for p in self._parts]
+        names: List[str] = []
+        for sch in schemas:
+            names.extend(n for n in sch.names if n not in names)
+        fields = [
+            pa.field(n, _unify_arrow_types([sch.field(n).type for sch in schemas if n in sch.names]))
+            for n in names
+        ]
+        schema = pa.schema(fields)
+        pandas_md = _merged_pandas_metadata(schemas, schema)
+        if pandas_md is not None:
+            schema = schema.with_metadata({b"pandas": pandas_md})
+
+        with pq.ParquetWriter(self._tmp, schema) as writer:
+            if not self._parts:
+                writer.write_table(schema.empty_table())
+            for p in self._parts:
+                for batch in pq.ParquetFile(p).iter_batches(batch_size=65_536):
+                    cols = []
+                    for f in schema:
+                        if f.name in batch.schema.names:
+                            cols.append(_cast_column(batch.column(batch.schema.get_field_index(f.name)), f.type))
+                        else:
+                            cols.append(pa.nulls(batch.num_rows, type=f.type))
+                    writer.write_table(pa.Table.from_arrays(cols, schema=schema))
+
+
+# -------------------------------------------Сегменты (дозапись)-----------------------------------------------------
+# Манифест <основа>.manifest:
+#   {"format": 1, "id": "...", "next": 3, "segments": [{"file": "000000.parquet", "rows": 1200, "bytes": 53211}, ...],
+#    "retired": [{"file": "000000.parquet", "at": 1760000000.0}, ...]}
+# id не меняется при дозаписи и сжатии (см. dataset_version); манифест, созданный из обычного файла, наследует его id.
+# Сегмент пишется целиком, и только потом попадает в манифест; манифест заменяется атомарно. Файлы, заменённые
+# сжатием, попадают в "retired" с временем замены и удаляются не раньше чем через RETIRED_GRACE_SECONDS —
+# читатель, открывший старый манифест, успевает их дочитать. Удаляет их первая после этого дозапись или сжатие,
+# а после фонового сжатия — ещё и таймер. Чтение манифест не меняет: блокировка — только в пределах процесса
+# (интерфейс и его фоновое сжатие), а обучение и сервер читают хранилище из других процессов.
+
+_segments_lock = threading.RLock()
+_compacting: set = set()
+
+
+def _manifest_path(data_dir: str, stem: str) -> str:
+    return os.path.join(data_dir, stem + MANIFEST_EXTENSION)
+
+
+def _segments_dir(manifest_path: str) -> str:
+    return os.path.splitext(manifest_path)[0] + ".segments"
+
+
+def _read_manifest(manifest_path: str) -> dict:
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError(f"Неизвестный формат манифеста: {manifest_path}")
+    return manifest
+
+
+def _write_manifest(manifest_path: str, manifest: dict) -> None:
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, manifest_path)
+
+
+def _segment_entry(path: str, rows: Optional[int]) -> dict:
+    return {"file": os.path.basename(path), "rows": rows, "bytes": os.path.getsize(path)}
+
+
+def _parquet_rows(path: str) -> Optional[int]:
+    if not _is_parquet(path):
+        return None
+    import pyarrow.parquet as pq
+    return pq.read_metadata(path).num_rows
+
+
+# Файлы сегментов по манифесту в порядке дозаписи; для обычного файла — он сам.
+def segment_paths(path: str) -> List[str]:
+    if not _is_manifest(path):
+        return [path]
+    with _segments_lock:
+        manifest = _read_manifest(path)
+    return [os.path.join(_segments_dir(path), s["file"]) for s in manifest["segments"]]
+
+
+def _file_id(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+# Версия датасета {"stem", "id", "rows"}: по ней читатель, запомнивший версию, отличает дозапись (тот же id, строк
+# не меньше — новые строки идут после прежних, сжатие порядок сохраняет) от перезаписи (другой id). Для обычного
+# файла id — время изменения и размер. None — число строк неизвестно (CSV вне манифеста, манифест прежней версии).
+def dataset_version(path: str) -> Optional[dict]:
+    if _is_manifest(path):
+        with _segments_lock:
+            manifest = _read_manifest(path)
+        rows = [s.get("rows") for s in manifest["segments"]]
+        if not manifest.get("id") or any(r is None for r in rows):
+            return None
+        return {"stem": dataset_stem(path), "id": manifest["id"], "rows": int(sum(rows))}
+    rows = _parquet_rows(path) if os.path.isfile(path) else None
+    if rows is None:
+        return None
+    return {"stem": dataset_stem(path), "id": _file_id(path), "rows": int(rows)}
+
+
+# Как iter_rows, но начиная со строки start: дозаписанное после версии с start строками (см. dataset_version).
+# Сегменты, целиком лежащие до start, не открываются.
+def iter_rows_from(path: str, columns: Tuple[str, ...], start: int) -> Iterator[tuple]:
+    if not _is_manifest(path):
+        yield from itertools.islice(iter_rows(path, columns), start, None)
+        return
+    with _segments_lock:
+        manifest = _read_manifest(path)
+    seg_dir = _segments_dir(path)
+    for s in manifest["segments"]:
+        if s.get("rows") is not None and start >= s["rows"]:
+            start -= s["rows"]
+            continue
+        rows = iter_rows(os.path.join(seg_dir, s["file"]), columns)
+        start -= sum(1 for _ in itertools.islice(rows, start))
+        yield from rows
+
+
+def _retired_entry(name: str) -> dict:
+    return {"file": name, "at": time.time()}
+
+
+# Заменённые сегменты, срок ожидания которых истёк (запись-строка — от прежней версии манифеста, без времени)
+def _expired_retired(manifest: dict) -> List[dict]:
+    deadline = time.time() - RETIRED_GRACE_SECONDS
+    entries = [e if isinstance(e, dict) else {"file": e, "at": 0.0} for e in manifest.get("retired", [])]
+    return [e for e in entries if e["at"] <= deadline]
+
+
+def _delete_retired(manifest: dict, seg_dir: str) -> None:
+    expired = {e["file"] for e in _expired_retired(manifest)}
+    kept = []
+    for entry in manifest.get("retired", []):
+        name = entry["file"] if isinstance(entry, dict) else entry
+        if name not in expired:
+            kept.append(entry)
+            continue
+        try:
+            os.remove(os.path.join(seg_dir, name))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            kept.append(entry)  # файл ещё открыт (Windows) — удалим в следующий раз
+    manifest["retired"] = kept
+
+
+# Удаляет заменённые сегменты датасета stem, срок ожидания которых истёк.
+def purge_retired(data_dir: str, stem: str) -> None:
+    manifest_path = _manifest_path(data_dir, stem)
+    with _segments_lock:
+        if not os.path.isfile(manifest_path):
+            return
+        manifest = _read_manifest(manifest_path)
+        if _expired_retired(manifest):
+            _delete_retired(manifest, _segments_dir(manifest_path))
+            _write_manifest(manifest_path, manifest)
+
+
+# Манифест датасета stem; при первой дозаписи обычный файл переносится в папку сегментов первым сегментом.
+def _ensure_manifest(data_dir: str, stem: str) -> str:
+    manifest_path = _manifest_path(data_dir, stem)
+    if os.path.isfile(manifest_path):
+        return manifest_path
+    seg_dir = _segments_dir(manifest_path)
+    os.makedirs(seg_dir, exist_ok=True)
+    segments = []
+    ident = uuid.uuid4().hex
+    existing = dataset_path(data_dir, stem)
+    if os.path.isfile(existing) and not _is_manifest(existing):
+        ident = _file_id(existing)
+        first = os.path.join(seg_dir, "000000" + os.path.splitext(existing)[1])
+        os.replace(existing, first)
+        segments.append(_segment_entry(first, _parquet_rows(first)))
+    _write_manifest(manifest_path, {"format": MANIFEST_FORMAT, "id": ident, "next": 1, "segments": segments,
+                                    "retired": []})
+    return manifest_path
+
+
+# Путь для нового сегмента датасета stem (номер резервируется в манифесте). Файл пишет вызывающий
+# (append_dataset или DatasetWriter при потоковой загрузке), после чего регистрирует его через add_segment.
+def new_segment_path(data_dir: str, stem: str) -> str:
+    with _segments_lock:
+        manifest_path = _ensure_manifest(data_dir, stem)
+        manifest = _read_manifest(manifest_path)
+        number = int(manifest["next"])
+        manifest["next"] = number + 1
+        _write_manifest(manifest_path, manifest)
+    return os.path.join(_segments_dir(manifest_path), f"{number:06d}{STORE_EXTENSIONS[STORE_FORMAT]}")
+
+
+# Добавляет записанный сегмент в конец манифеста; пустой сегмент не регистрируется.
+def add_segment(data_dir: str, stem: str, segment_path: str, rows: int) -> None:
+    if not rows or not os.path.isfile(segment_path):
+        if os.path.isfile(segment_path):
+            os.remove(segment_path)
+        return
+    with _segments_lock:
+        manifest_path = _ensure_manifest(data_dir, stem)
+        manifest = _read_manifest(manifest_path)
+        manifest["segments"].append(_segment_entry(segment_path, rows))
+        _delete_retired(manifest, _segments_dir(manifest_path))
+        _write_manifest(manifest_path, manifest)
+
+
+# Дозапись df к датасету stem отдельным сегментом: прежние данные не читаются и не переписываются.
+def append_dataset(df, data_dir: str, stem: str) -> str:
+    path = new_segment_path(data_dir, stem)
+    _write_file(df, path)
+    add_segment(data_dir, stem, path, len(df))
+    return _manifest_path(data_dir, stem)
+
+
+def segment_count(data_dir: str, stem: str) -> int:
+    manifest_path = _manifest_path(data_dir, stem)
+    if not os.path.isfile(manifest_path):
+        return 0
+    with _segments_lock:
+        return len(_read_manifest(manifest_path)["segments"])
+
+
+# Сливает сегменты датасета stem в один (потоково, через DatasetWriter). Сегменты, дописанные во время
+# сжатия, остаются после слитого. Возвращает True, если манифест заменён.
+def compact_dataset(data_dir: str, stem: str) -> bool:
+    manifest_path = _manifest_path(data_dir, stem)
+    seg_dir = _segments_dir(manifest_path)
+    with _segments_lock:
+        if not os.path.isfile(manifest_path):
+            return False
+        snapshot = [s["file"] for s in _read_manifest(manifest_path)["segments"]]
+    if len(snapshot) < 2:
+        return False
+
+    out = new_segment_path(data_dir, stem)
+    writer = DatasetWriter(out)
+    try:
+        for name in snapshot:
+            writer.include(os.path.join(seg_dir, name))
+        rows = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    with _segments_lock:
+        current = _read_manifest(manifest_path) if os.path.isfile(manifest_path) else None
+        if current is None or [s["file"] for s in current["segments"][:len(snapshot)]] != snapshot:
+            # датасет перезаписан или сжат параллельно — результат не нужен
+            if os.path.isfile(out):
+                os.remove(out)
+            return False
+        current["segments"] = [_segment_entry(out, rows)] + current["segments"][len(snapshot):]
+        _delete_retired(current, seg_dir)
+        current["retired"] = current["retired"] + [_retired_entry(name) for name in snapshot]
+        _write_manifest(manifest_path, current)
+    return True
+
+
+def _purge_quietly(data_dir: str, stem: str) -> None:
+    try:
+        purge_retired(data_dir, stem)
+    except Exception as e:
+        print(f"[DataStore] удаление заменённых сегментов {stem} не выполнено: {e}", file=sys.stderr)
+
+
+# Запускает compact_dataset в фоновом потоке, если у датасета не меньше COMPACT_MIN_SEGMENTS сегментов
+# и сжатие ещё не идёт. Поток не демон: при выходе из программы сжатие дописывается до конца.
+def compact_in_background(data_dir: str, stem: str) -> Optional[threading.Thread]:
+    key = os.path.abspath(_manifest_path(data_dir, stem))
+    with _segments_lock:
+        if key in _compacting or segment_count(data_dir, stem) < COMPACT_MIN_SEGMENTS:
+            return None
+        _compacting.add(key)
+
+    def run() -> None:
+        try:
+            if compact_dataset(data_dir, stem):
+                # заменённые сегменты удаляются по истечении срока, даже если датасет больше не читают
+                timer = threading.Timer(RETIRED_GRACE_SECONDS + 1, _purge_quietly, (data_dir, stem))
+                timer.daemon = True
+                timer.start()
+        except Exception as e:
+            print(f"[DataStore] сжатие {stem} не выполнено: {e}", file=sys.stderr)
+        finally:
+            with _segments_lock:
+                _compacting.discard(key)
+
+    thread = threading.Thread(target=run, name=f"compact-{stem}")
+    thread.start()
+    return thread
+
+
+# -------------------------------------------Индекс загруженных строк------------------------------------------------
+# <основа>.rowhash/ рядом с датасетом, в который пишутся выгрузки Mindbox:
+#   index.json  {"format": 2, "columns": [...], "next": 2, "shards": ["000000.npy", ...],
+#                "files": [{"name": ..., "hash": ..., "rows": N}]}
+#   NNNNNN.npy  отсортированные 64-битные метки строк, по файлу на загрузку
+# Метка строится по ключевым колонкам обработанной строки (событие: дата, код товара, клиент, ...) и номеру
+# её повторения: k-я одинаковая строка получает метку (хэш, k). Поэтому индекс — мультимножество: файл, где
+# событие встречается 3 раза, после загрузки, где оно было 2 раза, добавит одну строку, а повторная загрузка
+# того же периода — ни одной. Проверка — двоичный поиск по файлам индекса через mmap, сам датасет не читается.
+# Метки считаются по тем же значениям, что лежат в датасете, поэтому индекса нет (датасет загружен до появления
+# индекса) — он строится по датасету один раз, при первой дозаписи. Файл с тем же содержимым (blake2b) повторно
+# не загружается.
+
+ROWHASH_FORMAT = 2
+_DIGEST_BLOCK_BYTES = 1024 * 1024
+
+
+def _rowhash_dir(data_dir: str, stem: str) -> str:
+    return os.path.join(data_dir, stem + ".rowhash")
+
+
+# Хэш содержимого файла (blake2b, hex)
+def file_digest(path: str) -> str:
+    import hashlib
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_DIGEST_BLOCK_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Значения колонки в едином текстовом виде — одинаковом для только что обработанного куска (date, int, str)
+# и для прочитанного из parquet (datetime64, category) или CSV (строки): даты — ГГГГ-ММ-ДД, числа без ".0".
+def _canonical_column(s, name: str):
+    import pandas as pd
+    from DataCleaning import strip_float_suffix
+
+    if name in _DATE_COLUMNS:
+        text = pd.to_datetime(s, errors="coerce").dt.strftime("%Y-%m-%d")
+    else:
+        text = strip_float_suffix(s)
+    return text.astype(object).where(text.notna(), "").astype(str)
+
+
+# 64-битный хэш ключевых колонок каждой строки df (numpy uint64); отсутствующая колонка считается пустой
+def row_hashes(df, columns: List[str]):
+    import numpy as np
+    import pandas as pd
+
+    canon = pd.DataFrame({
+        col: _canonical_column(df[col], col) if col in df.columns else pd.Series("", index=df.index)
+        for col in sorted(columns)
+    }, index=df.index)
+    if not len(canon.columns):
+        return np.zeros(len(df), dtype=np.uint64)
+    return pd.util.hash_pandas_object(canon, index=False, categorize=False).to_numpy(dtype=np.uint64)
+
+
+class _OccurrenceCounter:
+    """Номер повторения каждой строки по хэшу с учётом предыдущих кусков того же файла или датасета."""
+
+    def __init__(self):
+        import numpy as np
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._counts = np.zeros(0, dtype=np.int64)
+
+    # Метки (хэш, номер повторения) для хэшей очередного куска
+    def tokens(self, hashes):
+        import numpy as np
+
+        order = np.argsort(hashes, kind="stable")
+        sorted_h = hashes[order]
+        starts = np.concatenate(([True], sorted_h[1:] != sorted_h[:-1])) if len(sorted_h) else np.zeros(0, bool)
+        group_start = np.maximum.accumulate(np.where(starts, np.arange(len(sorted_h)), 0))
+        within = np.empty(len(hashes), dtype=np.int64)
+        within[order] = np.arange(len(sorted_h)) - group_start
+
+        base = np.zeros(len(hashes), dtype=np.int64)
+        if len(self._keys):
+            pos = np.minimum(np.searchsorted(self._keys, hashes), len(self._keys) - 1)
+            found = self._keys[pos] == hashes
+            base[found] = self._counts[pos[found]]
+
+        uniq = sorted_h[starts]
+        counts = np.diff(np.append(np.flatnonzero(starts), len(sorted_h)))
+        keys = np.concatenate((self._keys, uniq))
+        merged = np.concatenate((self._counts, counts))
+        order = np.argsort(keys, kind="stable")
+        keys, merged = keys[order], merged[order]
+        first = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) else np.zeros(0, bool)
+        self._keys = keys[first]
+        self._counts = np.add.reduceat(merged, np.flatnonzero(first)) if len(keys) else merged
+
+        return _mix64(hashes, base + within)
+
+
+# Перемешивание хэша с номером повторения (splitmix64)
+def _mix64(hashes, occurrence):
+    import numpy as np
+
+    with np.errstate(over="ignore"):
+        z = hashes ^ (occurrence.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+# Отсортированные уникальные значения нескольких массивов меток. Устойчивая сортировка (timsort) сливает
+# уже отсортированные файлы индекса почти линейно; np.unique на таких объёмах в разы медленнее.
+def _sorted_unique(parts: list):
+    import numpy as np
+
+    values = np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint64)
+    values.sort(kind="stable")
+    if len(values) < 2:
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def _new_rowhash_index(columns: List[str], next_number: int = 0) -> dict:
+    return {"format": ROWHASH_FORMAT, "columns": list(columns), "next": next_number, "shards": [], "files": []}
+
+
+# Индекс из index.json; None — индекса нет или он построен по другим колонкам или в другом формате
+def _read_rowhash_index(index_dir: str, columns: List[str]) -> Optional[dict]:
+    path = os.path.join(index_dir, "index.json")
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    if index.get("format") != ROWHASH_FORMAT or index.get("columns") != list(columns):
+        return None
+    return index
+
+
+def _write_rowhash_index(index_dir: str, index: dict) -> None:
+    _write_manifest(os.path.join(index_dir, "index.json"), index)
+
+
+# Удаляет файлы меток, не вошедшие в индекс (прежний индекс при перезаписи, слитые файлы)
+def _delete_unused_shards(index_dir: str, index: dict) -> None:
+    for name in os.listdir(index_dir):
+        if name.endswith(".npy") and name not in index["shards"]:
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                pass  # файл ещё открыт через mmap (Windows) — удалится при следующей загрузке
+
+
+# Строит индекс по уже записанному датасету stem (читаются только ключевые колонки)
+def _rebuild_rowhash_index(data_dir: str, stem: str, columns: List[str], next_number: int = 0) -> dict:
+    import numpy as np
+
+    index_dir = _rowhash_dir(data_dir, stem)
+    counter = _OccurrenceCounter()
+    parts = [counter.tokens(row_hashes(chunk, columns))
+             for chunk in iter_dataset_chunks(dataset_path(data_dir, stem), columns=list(columns))]
+    tokens = _sorted_unique(parts)
+    index = _new_rowhash_index(columns, next_number)
+    os.makedirs(index_dir, exist_ok=True)
+    if len(tokens):
+        shard = f"{next_number:06d}.npy"
+        np.save(os.path.join(index_dir, shard), tokens)
+        index["next"] = next_number + 1
+        index["shards"].append(shard)
+    _write_rowhash_index(index_dir, index)
+    _delete_unused_shards(index_dir, index)
+    return index
+
+
+class ImportIndex:
+    """
+    Индекс уже загруженных строк и файлов датасета stem для одной загрузки файла source_path.
+
+    columns — ключевые колонки обработанной строки, по которым строки считаются одинаковыми.
+    append=True — дозапись: already_imported() сообщает, что файл с тем же содержимым уже загружен,
+    fresh(df) отмечает строки обработанного куска, которых ещё нет в датасете; если индекса нет, он строится
+    по датасету. append=False (или датасета ещё нет) — перезапись: индекс после commit() описывает только этот
+    файл. Индекс на диске меняется только в commit(), после записи данных (кроме построения отсутствующего).
+    """
+
+    def __init__(self, data_dir: str, stem: str, source_path: str, columns: List[str], append: bool = True):
+        self.dir = _rowhash_dir(data_dir, stem)
+        self.data_dir, self.stem = data_dir, stem
+        self.columns = list(columns)
+        self.name = os.path.basename(source_path)
+        self.digest = file_digest(source_path)
+        self.append = append and os.path.exists(dataset_path(data_dir, stem))
+        self.rebuilt = False
+        self.rows = 0
+        self.rejected = 0
+        self._tokens: list = []
+        self._counter = _OccurrenceCounter()
+        self._shards = None
+        self._index = _new_rowhash_index(self.columns)
+        if self.append:
+            with _segments_lock:
+                try:
+                    index = _read_rowhash_index(self.dir, self.columns)
+                except (OSError, ValueError):
+                    index = None
+                if index is None:
+                    index = _rebuild_rowhash_index(data_dir, stem, self.columns, self._next_number())
+                    self.rebuilt = True
+            self._index = index
+
+    def _next_number(self) -> int:
+        if not os.path.isdir(self.dir):
+            return 0
+        numbers = [int(name[:-4]) for name in os.listdir(self.dir) if name.endswith(".npy") and name[:-4].isdigit()]
+        return max(numbers, default=-1) + 1
+
+    def already_imported(self) -> bool:
+        return self.append and any(f["hash"] == self.digest for f in self._index["files"])
+
+    # Маска строк обработанного куска df, которых ещё нет в датасете (numpy bool); метки принятых строк
+    # запоминаются для commit(). Куски одного файла передаются по порядку.
+    def fresh(self, df):
+        import numpy as np
+
+        tokens = self._counter.tokens(row_hashes(df, self.columns))
+        keep = ~self._seen(tokens) if self.append else np.ones(len(tokens), dtype=bool)
+        self.rejected += int((~keep).sum())
+        self._tokens.append(tokens[keep])
+        self.rows += int(keep.sum())
+        return keep
+
+    def _seen(self, tokens):
+        import numpy as np
+
+        if self._shards is None:
+            self._shards = [np.load(os.path.join(self.dir, name), mmap_mode="r") for name in self._index["shards"]]
+        seen = np.zeros(len(tokens), dtype=bool)
+        for shard in self._shards:
+            if not len(shard):
+                continue
+            pos = np.minimum(np.searchsorted(shard, tokens), len(shard) - 1)
+            seen |= np.asarray(shard[pos]) == tokens
+        return seen
+
+    # Записывает метки принятых строк отдельным файлом и отмечает файл загруженным. replace=True — индекс
+    # начинается заново (перезапись датасета или дозапись, которая не удалась и перешла в перезапись).
+    # Когда файлов меток накопилось COMPACT_MIN_SEGMENTS, они сливаются в один.
+    def commit(self, replace: bool = False) -> None:
+        import numpy as np
+
+        replace = replace or not self.append
+        tokens = _sorted_unique(self._tokens)
+        self._shards = None
+        with _segments_lock:
+            try:
+                index = _read_rowhash_index(self.dir, self.columns)
+            except (OSError, ValueError):
+                index = None
+            if replace:
+                index = _new_rowhash_index(self.columns, self._next_number())
+            elif index is None:
+                # индекс пропал во время загрузки — строим заново по датасету, где уже есть и новые строки
+                index = _rebuild_rowhash_index(self.data_dir, self.stem, self.columns, self._next_number())
+                tokens = tokens[:0]
+            os.makedirs(self.dir, exist_ok=True)
+
+            if len(index["shards"]) + 1 >= COMPACT_MIN_SEGMENTS:
+                parts = [np.load(os.path.join(self.dir, name)) for name in index["shards"]]
+                tokens = _sorted_unique(parts + [tokens])
+                index["shards"] = []
+
+            if len(tokens):
+                number = int(index["next"])
+                shard = f"{number:06d}.npy"
+                np.save(os.path.join(self.dir, shard), tokens)
+                index["next"] = number + 1
+                index["shards"].append(shard)
+            index["files"].append({"name": self.name, "hash": self.digest, "rows": self.rows})
+            _write_rowhash_index(self.dir, index)
+            _delete_unused_shards(self.dir, index)
+
+
+# -------------------------------------------Экспорт и перевод формата------------------------------------------------
+
+def _dataset_files(data_dir: str) -> List[str]:
+    if not os.path.isdir(data_dir):
+        return []
+    stems = sorted({
+        dataset_stem(name)
+        for name in os.listdir(data_dir)
+        if os.path.splitext(name)[1].lower() in (*STORE_EXTENSIONS.values(), MANIFEST_EXTENSION)
+    })
+    return [dataset_path(data_dir, stem) for stem in stems]
+
+
+# Выгружает все датасеты в out_dir в прежнем CSV-формате (| и utf-8-sig). Хранилище не меняется.
+def export_csv(data_dir: str = "ВходныеДанные", out_dir: str = "ЭкспортCSV") -> List[str]:
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for path in _dataset_files(data_dir):
+        dst = os.path.join(out_dir, dataset_stem(path) + ".csv")
+        read_dataset(path).to_csv(dst, index=False, sep="|", encoding="utf-8-sig")
+        written.append(dst)
+    return written
+
+
+# Перезаписывает датасеты, хранящиеся не в STORE_FORMAT (например, старые .csv), в текущий формат.
+# Сегментированные датасеты при этом собираются в один обычный файл.
+def convert_store(data_dir: str = "ВходныеДанные") -> List[str]:
+    written = []
+    for path in _dataset_files(data_dir):
+        dst = target_path(data_dir, dataset_stem(path))
+        if path == dst:
+            continue
+        write_dataset(read_dataset(path), dst)
+        written.append(dst)
+    return written
+
+
+# Значение параметра "--flag value" из командной строки или default (общее для CLI DataStore, DataCleaning и Inference).
+def _cli_value(argv: List[str], flag: str, default: Optional[str] = None) -> Optional[str]:
+    if flag in argv:
+        i = argv.index(flag)
+        if i + 1 < len(argv):
+            return argv[i + 1]
+    return default
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    data_dir = _cli_value(argv, "--data-dir", "ВходныеДанные")
+    if "--export-csv" in argv:
+        for p in export_csv(data_dir, _cli_value(argv, "--out", "ЭкспортCSV")):
+            print(p)
+    elif "--convert" in argv:
+        for p in convert_store(data_dir):
+            print(p)
+    elif "--compact" in argv:
+        for p in _dataset_files(data_dir):
+            if _is_manifest(p) and compact_dataset(data_dir, dataset_stem(p)):
+                print(p)
+    else:
+        print("Usage:")
+        print("  python DataStore.py --export-csv [--data-dir ВходныеДанные] [--out ЭкспортCSV]")
+        print("  python DataStore.py --convert [--data-dir ВходныеДанные]")
+        print("  python DataStore.py --compact [--data-dir ВходныеДанные]")
@@ -0,0 +1,618 @@
+from __future__ import annotations
+import os
+
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+
+import sys
+import json
+import math
+import time
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import Catalogue as catalogue
+from DataStore import _cli_value, dataset_path, dataset_version, iter_rows, iter_rows_from
+
+# Инференс BPR-MF и EASE^R по артефактам из Models/ только на NumPy и стандартной библиотеке.
+# Модуль намеренно не импортирует torch, pandas и scipy: запуск CLI/сервера не платит за их загрузку.
+# Обработанные датасеты в формате parquet (см. DataStore.py) читаются через pyarrow, он подгружается только для них.
+#
+#   python Inference.py --recommend <MindboxID> [--k 20] [--model ease|bprmf]
+#   python Inference.py --serve [--host 127.0.0.1] [--port 8765]
+
+
+# -------------------------------------------Вспомогательные функции----------------------------------------------------
+
+# Функция для получения текущего времени в читаемом формате.
+def _now() -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Функция для выбора правильного файла из каталога данных: сначала проверяется наличие файла с префиксом "Отбор".
+# Формат файла (.parquet/.csv) определяет DataStore.dataset_path.
+def _pick_file(data_dir: str, base: str, selection: bool) -> str:
+    if selection:
+        p = dataset_path(data_dir, f"{base}Отбор")
+        if os.path.isfile(p):
+            return p
+    return dataset_path(data_dir, f"{base}Оригинал")
+
+
+# Top-k индексов по строкам матрицы оценок, отсортированные по убыванию.
+def _topk_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(int(k), scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+# Позиции элементов строк `rows` в CSR-массивах: (длины строк, плоские индексы в data/indices).
+def _csr_row_positions(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lens = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    flat = np.arange(int(lens.sum()), dtype=np.int64) - np.repeat(np.cumsum(lens) - lens, lens) + np.repeat(starts, lens)
+    return lens, flat
+
+
+# ----------------------------- Config -----------------------------
+
+@dataclass
+class InferenceConfig:
+    """Subset of TrainConfig needed at inference time; read from artifacts.json (defaults match TrainConfig)."""
+    data_dir: str = "ВходныеДанные"
+    w_view_item: float = 1.0
+    w_favorite: float = 3.0
+    w_purchase: float = 5.0
+
+    @staticmethod
+    def from_meta(meta: dict) -> "InferenceConfig":
+        saved = meta.get("config") or {}
+        cfg = InferenceConfig()
+        for name in cfg.__dataclass_fields__:
+            if name in saved:
+                setattr(cfg, name, type(getattr(cfg, name))(saved[name]))
+        return cfg
+
+
+# ----------------------------- Artifacts -----------------------------
+#
+# Models/
+#   artifacts.json                      - метаданные (формат, размеры, тип EASE, конфиг)
+#   idx2user.npy, idx2item.npy          - коды в порядке индексов (фиксированная ширина, без pickle)
+#   users_sorted.npy, users_sorted_idx.npy, items_sorted.npy, items_sorted_idx.npy
+#                                       - отсортированные коды и их индексы для бинарного поиска
+#   user_emb.npy, item_emb.npy          - таблицы эмбеддингов BPR-MF
+#   ease_B.npy | ease_B.{data,indices,indptr}.npy - плотная или разреженная (CSR) матрица EASE
+#   profile.{data,indices,indptr}.npy   - индекс истории: user -> (items, суммарные веса) по всем событиям
+#   topk_<model>.{data,indices,indptr}.npy - предрасчитанные top-K без уже просмотренных: scores float16, items int32,
+#                                       offsets по пользователям
+#   ann_ivf.{centroids,indptr,items}.npy - IVF-индекс по item_emb (опционально, cfg.ann_enabled)
+#   mappings.json, lightgcn.pt          - прежний формат (для совместимости, нужен torch)
+#
+# Все .npy открываются с mmap_mode='r': запрос по одному пользователю читает только нужные строки,
+# а несколько процессов делят page cache.
+
+ARTIFACTS_FORMAT = 2
+_CSR_PARTS = ("data", "indices", "indptr")
+_PROFILE_BASES = ("Заказы", "Просмотры", "Избранное")
+
+
+# Файлы, из которых строится профиль пользователя: "Отбор", если есть, иначе "Оригинал".
+def _profile_source_paths(data_dir: str) -> List[str]:
+    paths = []
+    for base in _PROFILE_BASES:
+        p = _pick_file(data_dir, base, True)
+        if not os.path.isfile(p):
+            p = _pick_file(data_dir, base, False)
+        paths.append(p)
+    return paths
+
+
+def _file_stamps(paths: List[str]) -> Dict[str, List[float]]:
+    return {
+        os.path.abspath(p): [os.path.getmtime(p), os.path.getsize(p)]
+        for p in paths
+        if os.path.isfile(p)
+    }
+
+
+# Версии источников профиля (DataStore.dataset_version) в порядке _profile_source_paths; сохраняются при обучении,
+# чтобы после дозаписи выделить новые строки (см. _profile_changes).
+def _source_versions(paths: List[str]) -> List[Optional[dict]]:
+    return [dataset_version(p) if os.path.isfile(p) else None for p in paths]
+
+
+@dataclass
+class SparseRows:
+    """CSR matrix held as three (possibly memory-mapped) arrays; only the requested rows are read."""
+    data: np.ndarray
+    indices: np.ndarray
+    indptr: np.ndarray
+    shape: Tuple[int, int]
+
+    def row(self, r: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = int(self.indptr[r]), int(self.indptr[r + 1])
+        return np.asarray(self.indices[start:end], dtype=np.int64), np.asarray(self.data[start:end], dtype=np.float32)
+
+
+@dataclass
+class IVFIndex:
+    """
+    Inverted-file index over item embeddings: spherical k-means centroids and per-cluster item lists.
+    A query scores the nprobe closest clusters only instead of the whole catalogue.
+    """
+    centroids: np.ndarray  # [C, d]
+    indptr: np.ndarray     # [C+1]
+    items: np.ndarray      # [I], товары, сгруппированные по кластерам
+    nprobe: int
+
+    def candidates(self, u: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        nprobe = min(int(nprobe or self.nprobe), len(self.centroids))
+        probe = _topk_rows((np.asarray(self.centroids) @ u).reshape(1, -1), nprobe)[0]
+        _, flat = _csr_row_positions(self.indptr, probe)
+        return np.asarray(self.items[flat], dtype=np.int64)
+
+    def search(self, u: np.ndarray, item_emb: np.ndarray, k: int, exclude: Optional[np.ndarray] = None,
+               nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        cand = self.candidates(u, nprobe)
+        if exclude is not None and len(exclude):
+            cand = cand[~np.isin(cand, exclude)]
+        cand = np.sort(cand)  # последовательное чтение строк memmap
+        scores = np.asarray(item_emb[cand], dtype=np.float32) @ u
+        top = _topk_rows(scores.reshape(1, -1), k)[0]
+        return cand[top], scores[top]
+
+
+@dataclass
+class ModelArtifacts:
+    meta: dict
+    idx2user: np.ndarray
+    idx2item: np.ndarray
+    users_sorted: np.ndarray
+    users_sorted_idx: np.ndarray
+    items_sorted: np.ndarray
+    items_sorted_idx: np.ndarray
+    user_emb: Optional[np.ndarray]
+    item_emb: Optional[np.ndarray]
+    ease_B: object  # np.ndarray | SparseRows | None
+    profile: Optional[SparseRows] = None
+    topk: Dict[str, SparseRows] = field(default_factory=dict)
+    ann: Optional[IVFIndex] = None
+    changes: Optional[tuple] = field(default=None, repr=False)  # (штампы файлов, результат _profile_changes)
+
+    @property
+    def num_users(self) -> int:
+        return len(self.idx2user)
+
+    @property
+    def num_items(self) -> int:
+        return len(self.idx2item)
+
+    def user_index(self, mindbox_id: str) -> Optional[int]:
+        idx = _lookup_sorted(self.users_sorted, self.users_sorted_idx, [str(mindbox_id)])[0]
+        return None if idx < 0 else int(idx)
+
+    def item_indices(self, codes) -> np.ndarray:
+        return _lookup_sorted(self.items_sorted, self.items_sorted_idx, codes)
+
+
+# Бинарный поиск кодов в отсортированном массиве; -1 для неизвестных.
+def _lookup_sorted(values_sorted: np.ndarray, sorted_idx: np.ndarray, queries) -> np.ndarray:
+    q = np.asarray(list(queries), dtype=str)
+    if len(q) == 0 or len(values_sorted) == 0:
+        return np.full(len(q), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(values_sorted, q), len(values_sorted) - 1)
+    found = np.asarray(values_sorted[pos]) == q
+    return np.where(found, np.asarray(sorted_idx[pos], dtype=np.int64), -1)
+
+
+def load_artifacts(out_dir: str = "Models") -> ModelArtifacts:
+    meta_path = os.path.join(out_dir, "artifacts.json")
+    if not os.path.isfile(meta_path):
+        raise FileNotFoundError("Models not found. Train first (press the train button).")
+
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+
+    def _mm(name: str) -> Optional[np.ndarray]:
+        path = os.path.join(out_dir, name)
+        return np.load(path, mmap_mode="r", allow_pickle=False) if os.path.isfile(path) else None
+
+    ease_B = None
+    if meta.get("ease") == "dense":
+        ease_B = _mm("ease_B.npy")
+    elif meta.get("ease") == "csr":
+        data, indices, indptr = (_mm(f"ease_B.{part}.npy") for part in _CSR_PARTS)
+        n = int(meta["num_items"])
+        ease_B = SparseRows(data, indices, indptr, (n, n))
+
+    profile = None
+    if meta.get("profile_sources"):
+        parts = [_mm(f"profile.{part}.npy") for part in _CSR_PARTS]
+        if all(p is not None for p in parts):
+            profile = SparseRows(parts[0], parts[1], parts[2], (int(meta["num_users"]), int(meta["num_items"])))
+
+    topk = {}
+    for use in (meta.get("topk") or {}):
+        parts = [_mm(f"topk_{use}.{part}.npy") for part in _CSR_PARTS]
+        if all(p is not None for p in parts):
+            topk[use] = SparseRows(parts[0], parts[1], parts[2], (int(meta["num_users"]), int(meta["topk"][use])))
+
+    ann = None
+    if meta.get("ann"):
+        centroids, indptr, items = (_mm(f"ann_ivf.{part}.npy") for part in ("centroids", "indptr", "items"))
+        if centroids is not None and indptr is not None and items is not None:
+            ann = IVFIndex(centroids=centroids, indptr=indptr, items=items, nprobe=int(meta["ann"]["nprobe"]))
+
+    return ModelArtifacts(
+        meta=meta,
+        idx2user=_mm("idx2user.npy"),
+        idx2item=_mm("idx2item.npy"),
+        users_sorted=_mm("users_sorted.npy"),
+        users_sorted_idx=_mm("users_sorted_idx.npy"),
+        items_sorted=_mm("items_sorted.npy"),
+        items_sorted_idx=_mm("items_sorted_idx.npy"),
+        user_emb=_mm("user_emb.npy"),
+        item_emb=_mm("item_emb.npy"),
+        ease_B=ease_B,
+        profile=profile,
+        topk=topk,
+        ann=ann,
+    )
+
+
+# ----------------------------- Profiles -----------------------------
+
+# Количество как в обучении: число, иначе 1, с ограничением [1, 10].
+def _qty(value: Optional[str]) -> float:
+    try:
+        q = float(value)
+    except (TypeError, ValueError):
+        return 1.0
+    if not math.isfinite(q):
+        return 1.0
+    return min(max(q, 1.0), 10.0)
+
+
+def _user_profile_from_processed(data_dir: str, mindbox_id: str, item_indices, cfg: InferenceConfig) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build a single-user sparse profile (indices + weights) from processed CSVs.
+    Used for EASE inference and for filtering 'seen' items.
+    item_indices: codes -> item indices (-1 for unknown), e.g. ModelArtifacts.item_indices.
+    """
+    sources = [iter_rows(p, cols) if os.path.isfile(p) else ()
+               for p, cols in zip(_profile_source_paths(data_dir), _PROFILE_COLUMNS)]
+    codes, weights = [], []
+    for _, code, w in _profile_events(*sources, cfg, mindbox_id=str(mindbox_id)):
+        codes.append(code)
+        weights.append(w)
+    return _aggregate_profile(codes, weights, item_indices)
+
+
+# Колонки источников профиля в порядке _profile_source_paths (заказы, просмотры, избранное).
+_PROFILE_COLUMNS = (
+    ("MindboxID", "КодНоменклатуры", "Количество"),
+    ("MindboxID", "КодНоменклатуры", "ТипТовара"),
+    ("MindboxID", "КодНоменклатуры"),
+)
+
+
+# События профиля (MindboxID, код товара, вес) из строк заказов, просмотров и избранного (колонки — _PROFILE_COLUMNS);
+# mindbox_id — только события этого пользователя.
+def _profile_events(orders, views, favorites, cfg: InferenceConfig,
+                    mindbox_id: Optional[str] = None) -> Iterator[Tuple[str, str, float]]:
+    for uid, code, qty in orders:
+        if code and uid is not None and (mindbox_id is None or uid == mindbox_id):
+            yield uid, code, cfg.w_purchase * _qty(qty)
+    for uid, code in favorites:
+        if code and uid is not None and (mindbox_id is None or uid == mindbox_id):
+            yield uid, code, cfg.w_favorite
+    for uid, code, kind in views:
+        if kind == "Номенклатура" and code and uid is not None and (mindbox_id is None or uid == mindbox_id):
+            yield uid, code, cfg.w_view_item
+
+
+# Суммирует веса по товарам; неизвестные коды отбрасываются.
+def _aggregate_profile(codes: List[str], weights: List[float], item_indices) -> Tuple[np.ndarray, np.ndarray]:
+    if not codes:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    idx = item_indices(codes)
+    w = np.asarray(weights, dtype=np.float64)
+    known = idx >= 0
+    if not known.any():
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    uniq, inv = np.unique(idx[known], return_inverse=True)
+    val = np.bincount(inv.ravel(), weights=w[known]).astype(np.float32)
+    return uniq.astype(np.int64), val
+
+
+_changes_lock = threading.Lock()
+
+
+# Пользователи, чья история изменилась после обучения: {MindboxID: (коды, веса) новых событий}. Новые события —
+# строки, дозаписанные к источникам профиля после версий из meta["profile_versions"]; они читаются один раз
+# и кэшируются в arts до следующего изменения файлов. None — изменения выделить нельзя (источник перезаписан,
+# заменён другим или записан без версии, модель обучена до появления версий): тогда устаревшими считаются все
+# пользователи и профиль каждого собирается полным чтением файлов до переобучения (это печатается один раз).
+def _profile_changes(arts: ModelArtifacts, data_dir: str, cfg: InferenceConfig) -> Optional[Dict[str, Tuple[List[str], List[float]]]]:
+    paths = _profile_source_paths(data_dir)
+    stamps = _file_stamps(paths)
+    trained = arts.meta.get("profile_sources") or {}
+    if stamps == trained:
+        return {}
+    with _changes_lock:
+        if arts.changes is not None and arts.changes[0] == stamps:
+            return arts.changes[1]
+
+        changes: Optional[Dict[str, Tuple[List[str], List[float]]]] = {}
+        versions = arts.meta.get("profile_versions") or [None] * len(paths)
+        sources = []
+        for path, cols, old in zip(paths, _PROFILE_COLUMNS, versions):
+            key = os.path.abspath(path)
+            if key in stamps and stamps[key] == trained.get(key):
+                sources.append(())
+                continue
+            cur = dataset_version(path) if os.path.isfile(path) else None
+            if old is None or cur is None or cur["stem"] != old["stem"] or cur["id"] != old["id"] or cur["rows"] < old["rows"]:
+                changes = None
+                break
+            sources.append(iter_rows_from(path, cols, int(old["rows"])))
+
+        if changes is None:
+            print(f"[{_now()}] Profile sources in {data_dir} were replaced since training; "
+                  f"every user is scored live from the processed files until retraining.")
+        else:
+            for uid, code, w in _profile_events(*sources, cfg):
+                codes, weights = changes.setdefault(uid, ([], []))
+                codes.append(code)
+                weights.append(w)
+            print(f"[{_now()}] Profile sources in {data_dir} were appended since training: "
+                  f"{len(changes):,} users with new events are scored live.")
+        arts.changes = (stamps, changes)
+        return changes
+
+
+# Профиль пользователя: из сохранённого индекса за O(истории), если пользователь известен модели и изменения
+# источников после обучения выделяются (_profile_changes); новые события пользователя добавляются к строке индекса.
+# Иначе — полным чтением обработанных файлов.
+def _user_profile(arts: ModelArtifacts, data_dir: str, mindbox_id: str, cfg: InferenceConfig) -> Tuple[np.ndarray, np.ndarray]:
+    if arts.profile is not None:
+        changes = _profile_changes(arts, data_dir, cfg)
+        u_idx = arts.user_index(str(mindbox_id)) if changes is not None else None
+        if u_idx is not None:
+            idx, w = arts.profile.row(u_idx)
+            if str(mindbox_id) not in changes:
+                return idx, w
+            codes, weights = changes[str(mindbox_id)]
+            new_idx, new_w = _aggregate_profile(codes, weights, arts.item_indices)
+            uniq, inv = np.unique(np.concatenate([np.asarray(idx, dtype=np.int64), new_idx]), return_inverse=True)
+            val = np.bincount(inv.ravel(), weights=np.concatenate([np.asarray(w, dtype=np.float64), new_w]))
+            return uniq, val.astype(np.float32)
+    return _user_profile_from_processed(data_dir, str(mindbox_id), arts.item_indices, cfg)
+
+
+# ----------------------------- Scoring -----------------------------
+
+# EASE-оценки для одного профиля: читаются только строки B, соответствующие просмотренным товарам.
+def _ease_profile_scores(B, seen_idx: np.ndarray, seen_w: np.ndarray) -> np.ndarray:
+    seen_idx = np.asarray(seen_idx, dtype=np.int64)
+    seen_w = np.asarray(seen_w, dtype=np.float32)
+    if isinstance(B, SparseRows):
+        lens, flat = _csr_row_positions(B.indptr, seen_idx)
+        vals = np.asarray(B.data[flat], dtype=np.float32) * np.repeat(seen_w, lens)
+        return np.bincount(np.asarray(B.indices[flat], dtype=np.int64), weights=vals, minlength=B.shape[1]).astype(np.float32)
+    return np.asarray(seen_w @ np.asarray(B[seen_idx]), dtype=np.float32).ravel()
+
+
+# Оценки всех товаров для пользователя (просмотренные замаскированы) или (None, сообщение об ошибке).
+def _score_user(arts: ModelArtifacts, mindbox_id: str, use: str, cfg: InferenceConfig) -> Tuple[Optional[np.ndarray], str]:
+    # Build user seen profile for filtering (and for EASE scoring)
+    seen_idx, seen_w = _user_profile(arts, cfg.data_dir, str(mindbox_id), cfg)
+
+    if use.lower() == "ease":
+        if arts.ease_B is None:
+            return None, "EASE model not found (Models/ease_B*.npy). Use use='bprmf' or retrain."
+        if len(seen_idx) == 0:
+            return None, f"User {mindbox_id}: no history in processed files. Cannot score with EASE."
+
+        # score = w @ B[seen, :]
+        scores = _ease_profile_scores(arts.ease_B, seen_idx, seen_w)
+    else:
+        # BPR-MF
+        if arts.user_emb is None or arts.item_emb is None:
+            return None, "BPR-MF embeddings not found (Models/user_emb.npy, item_emb.npy). Retrain."
+
+        u_idx = arts.user_index(str(mindbox_id))
+        if u_idx is None:
+            return None, f"User {mindbox_id} not found in mappings."
+
+        u = np.asarray(arts.user_emb[u_idx], dtype=np.float32)          # [d], одна строка из memmap
+        scores = np.asarray(arts.item_emb @ u, dtype=np.float32)        # [n_items]
+
+    # filter seen
+    if len(seen_idx):
+        scores[seen_idx] = -1e9
+    return scores, ""
+
+
+# Top-k из предрасчитанной таблицы, если пользователь в ней есть и его история не менялась после обучения
+# (_profile_changes), иначе живой расчёт. Возвращает (items, scores, error, source), source: "table" | "ann" | "live".
+def _recommend(arts: ModelArtifacts, mindbox_id: str, k: int, use: str, cfg: InferenceConfig):
+    use = "ease" if use.lower() == "ease" else "bprmf"
+    # k в пределах [1, число товаров]: отрицательный срез items[:k] отрезал бы хвост строки таблицы
+    k = max(1, min(int(k), arts.num_items))
+    table = arts.topk.get(use)
+    if table is not None and k <= table.shape[1]:
+        changes = _profile_changes(arts, cfg.data_dir, cfg)
+        fresh = changes is not None and str(mindbox_id) not in changes
+        u_idx = arts.user_index(str(mindbox_id)) if fresh else None
+        if u_idx is not None:
+            items, scores = table.row(u_idx)
+            if len(items):
+                return items[:k], scores[:k], "", "table"
+
+    if use == "bprmf" and arts.ann is not None and arts.user_emb is not None:
+        u_idx = arts.user_index(str(mindbox_id))
+        if u_idx is not None:
+            seen_idx, _ = _user_profile(arts, cfg.data_dir, str(mindbox_id), cfg)
+            u = np.asarray(arts.user_emb[u_idx], dtype=np.float32)
+            items, scores = arts.ann.search(u, arts.item_emb, k, exclude=seen_idx)
+            return items, scores, "", "ann"
+
+    scores, error = _score_user(arts, str(mindbox_id), use, cfg)
+    if scores is None:
+        return None, None, error, "live"
+    top = _topk_rows(scores.reshape(1, -1), k)[0]
+    return top, scores[top], "", "live"
+
+
+# ----------------------------- Recommendation (console) -----------------------------
+
+def _load_item_names(data_dir: str) -> Dict[str, str]:
+    """
+    Returns mapping item_code -> name (if nomenclature file exists).
+    Cached per process by Catalogue until the nomenclature file changes.
+    """
+    return catalogue.item_names(data_dir)
+
+
+def _print_top(title: str, top: np.ndarray, top_scores: np.ndarray, idx2item, names: Dict[str, str]) -> None:
+    print(title)
+    for rank, (ii, score) in enumerate(zip(top, top_scores), start=1):
+        code = str(idx2item[int(ii)])
+        nm = names.get(code, "")
+        if nm:
+            print(f"{rank:02d}. {code} | {nm} | score={float(score):.4f}")
+        else:
+            print(f"{rank:02d}. {code} | score={float(score):.4f}")
+
+
+def print_recommendations(mindbox_id: str, k: int = 20, use: str = "ease", arts: Optional[ModelArtifacts] = None) -> None:
+    """
+    Prints top-K recommendations to console using saved artifacts.
+    use: "ease" | "bprmf"
+    """
+    arts = arts if arts is not None else load_artifacts()
+    cfg = InferenceConfig.from_meta(arts.meta)  # for profile weights + paths
+    names = _load_item_names(cfg.data_dir)
+
+    top, top_scores, error, _source = _recommend(arts, str(mindbox_id), k, use, cfg)
+    if top is None:
+        print(f"[{_now()}] {error}")
+        return
+
+    title = "EASE" if use.lower() == "ease" else "BPR-MF"
+    _print_top(f"[{_now()}] Recommendations ({title}) for MindboxID={mindbox_id} top{k}:", top, top_scores, arts.idx2item, names)
+
+
+# ----------------------------- Recommendation server -----------------------------
+
+def serve_recommendations(host: str = "127.0.0.1", port: int = 8765, arts: Optional[ModelArtifacts] = None) -> None:
+    """
+    Local HTTP server that loads artifacts once and answers from memory:
+      GET /recommend?mindbox_id=<id>&k=<int>&model=ease|bprmf
+      GET /health
+    Every response carries the server-side latency (JSON field latency_ms and X-Latency-Ms header).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    t0 = time.perf_counter()
+    arts = arts if arts is not None else load_artifacts()
+    cfg = InferenceConfig.from_meta(arts.meta)
+    names = _load_item_names(cfg.data_dir)
+    print(f"[{_now()}] Artifacts loaded in {(time.perf_counter() - t0) * 1000:.1f} ms: "
+          f"users={arts.num_users:,} items={arts.num_items:,} ease={arts.meta.get('ease')}")
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, payload: dict, started: float) -> None:
+            latency = (time.perf_counter() - started) * 1000.0
+            payload["latency_ms"] = round(latency, 3)
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Latency-Ms", f"{latency:.3f}")
+            self.end_headers()
+            self.wfile.write(body)
+            print(f"[{_now()}] {self.path} -> {status} in {latency:.2f} ms")
+
+        def do_GET(self):
+            started = time.perf_counter()
+            url = urlparse(self.path)
+            query = {key: vals[-1] for key, vals in parse_qs(url.query).items()}
+
+            if url.path == "/health":
+                self._send(200, {"status": "ok", "users": arts.num_users, "items": arts.num_items}, started)
+                return
+            if url.path != "/recommend":
+                self._send(404, {"error": f"unknown path {url.path}"}, started)
+                return
+
+            mindbox_id = query.get("mindbox_id")
+            if not mindbox_id:
+                self._send(400, {"error": "mindbox_id is required"}, started)
+                return
+            try:
+                k = int(query.get("k", 20))
+            except ValueError:
+                self._send(400, {"error": "k must be an integer"}, started)
+                return
+            if k < 1:
+                self._send(400, {"error": "k must be a positive integer"}, started)
+                return
+            use = query.get("model", "ease")
+
+            top, top_scores, error, source = _recommend(arts, mindbox_id, k, use, cfg)
+            if top is None:
+                self._send(404, {"mindbox_id": mindbox_id, "model": use, "error": error}, started)
+                return
+
+            items = []
+            for ii, score in zip(top, top_scores):
+                code = str(arts.idx2item[int(ii)])
+                items.append({"code": code, "name": names.get(code, ""), "score": float(score)})
+            self._send(200, {"mindbox_id": mindbox_id, "model": use, "k": k, "source": source, "items": items}, started)
+
+        def log_message(self, fmt, *args):
+            # собственный лог в _send уже содержит латентность
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    print(f"[{_now()}] Serving recommendations on http://{host}:{port}/recommend?mindbox_id=&k=&model=")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# ----------------------------- CLI -----------------------------
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if "--serve" in argv:
+        serve_recommendations(
+            host=_cli_value(argv, "--host", "127.0.0.1"),
+            port=int(_cli_value(argv, "--port", "8765")),
+        )
+    elif "--recommend" in argv:
+        try:
+            k = int(_cli_value(argv, "--k", "20"))
+        except ValueError:
+            k = 20
+        print_recommendations(_cli_value(argv, "--recommend"), k=k, use=_cli_value(argv, "--model", "ease"))
@@ -10,8 +10,10 @@ os.environ.setdefault("NUMEXPR_NUM_THREADS", "1")
 import sys
 import json
 import time
-import subprocess
-from dataclasses import dataclass
+import shutil
+import hashlib
+import importlib.util
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple
 
 import numpy as np
@@ -21,10 +23,41 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import Catalogue as catalogue
+from DataStore import _cli_value, dataset_columns, read_dataset
+# train_recommender остаётся доступным как LightFM.train_recommender (запуск обучения в отдельном процессе)
+from TrainLauncher import train_recommender
+from Inference import (
+    ModelArtifacts,
+    IVFIndex,
+    SparseRows,
+    ARTIFACTS_FORMAT,
+    _CSR_PARTS,
+    _csr_row_positions,
+    _file_stamps,
+    _lookup_sorted,
+    _now,
+    _pick_file,
+    _profile_changes,
+    _profile_source_paths,
+    _source_versions,
+    _topk_rows,
+    load_artifacts,
+    print_recommendations as _print_recommendations,
+    serve_recommendations as _serve_recommendations,
+)
+
+# Движок pd.read_csv: pyarrow разбирает файл в несколько потоков, но на одном ядре не быстрее движка C
+# и держит заметно больше памяти, поэтому выбирается только при наличии pyarrow и нескольких CPU.
+_CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") is not None and (os.cpu_count() or 1) > 1 else "c"
+_csv_engine_fallback_logged = False
+
 try:
     import scipy.sparse as sp
+    import scipy.linalg as sla
 except Exception:
     sp = None
+    sla = None
 
 
 # ----------------------------- Config -----------------------------
@@ -47,23 +80,48 @@ class TrainConfig:
     weight_decay: float = 1e-6
     bpr_reg: float = 1e-4
     seed: int = 42
+    sampler: str = "alias"  # "alias" (с возвращением) | "epoch" (полный проход за эпоху)
+    neg_sampler: str = "uniform"  # "uniform" | "popularity" | "hard"
+    neg_pop_alpha: float = 0.75
+    neg_hard_candidates: int = 10
 
     # Eval
     topk: int = 20
+    eval_ks: Tuple[int, ...] = (5, 10, 20)
     min_user_interactions_for_eval: int = 2
+    eval_block: int = 2048           # пользователей на один блок оценок BPR-MF (на устройстве eval_block x items float)
+
+    # ANN (IVF) по эмбеддингам товаров BPR-MF
+    ann_enabled: bool = False
+    ann_nlist: int = 0               # 0 — ceil(sqrt(items))
+    ann_target_recall: float = 0.95  # минимальный nprobe, дающий такой recall@topk относительно точного поиска
+    ann_eval_users: int = 1000
+
+    # Предрасчёт top-K для всех пользователей после обучения (0 — выключено)
+    precompute_topk: int = 100
+    precompute_block: int = 2048
 
     # EASE^R
     ease_lambda: float = 200.0
     max_items_for_ease: int = 15000  # guardrail
+    ease_eval_block: int = 1024      # пользователей на один блок X_block @ B при оценке
+    ease_dtype: str = "float32"      # "float32" | "float64"
+    ease_lambda_grid: Tuple[float, ...] = ()  # непустой — перебор lambda по одному разложению G
+    ease_partition: str = "auto"     # "auto" (блоки при items > max_items_for_ease) | "category" | "cooccurrence" | "none"
+    ease_block_size: int = 5000      # максимум товаров в одном блоке
+    ease_workers: int = 2            # процессов для решения блоков
+    ease_prune_topm: int = 0         # >0 — хранить только top-m весов в строке B (CSR ease_B.npz)
+    ease_prune_threshold: float = 0.0  # >0 — хранить только веса с |w| > threshold
+    ease_prune_report: Tuple[int, ...] = ()  # m, для которых печатается точность/размер при обучении, например (50, 100, 200, 500)
+
+    # Кэш датасета (маппинги, события, разбиение) по хешам входных файлов и весам событий
+    dataset_cache: bool = True
+    dataset_cache_dir: str = os.path.join("Models", "cache")
+    dataset_cache_keep: int = 3      # сколько последних версий датасета хранить
 
 
 # -------------------------------------------Вспомогательные функции----------------------------------------------------
 
-# Функция для получения текущего времени в читаемом формате.
-def _now() -> str:
-    return time.strftime("%Y-%m-%d %H:%M:%S")
-
-
 # Устанавливает случайное зерно для обеспечения воспроизводимости: для NumPy, Python, PyTorch и CUDA.
 def _set_seed(seed: int) -> None:
     import random
@@ -79,18 +137,71 @@ def _ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
-# Функция для выбора правильного файла из каталога данных: сначала проверяется наличие файла с префиксом "Отбор".
-def _pick_file(data_dir: str, base: str, selection: bool) -> str:
-    if selection:
-        p = os.path.join(data_dir, f"{base}Отбор.csv")
-        if os.path.isfile(p):
-            return p
-    return os.path.join(data_dir, f"{base}Оригинал.csv")
-
-
-# Читает CSV файл с разделителем | и кодировкой utf-8-sig (чтобы корректно работать с BOM).
-def _read_csv_pipe(path: str) -> pd.DataFrame:
-    return pd.read_csv(path, sep="|", dtype=str, encoding="utf-8-sig")
+# Колонки обработанных Заказов/Просмотров/Избранного, нужные обучению и профилям, и их типы.
+# Количество остаётся строкой: в данных встречается мусор, он приводится через pd.to_numeric(errors="coerce").
+_EVENT_COLUMNS: Dict[str, object] = {
+    "MindboxID": str,
+    "КодНоменклатуры": str,
+    "Дата": str,
+    "Количество": str,
+    "ТипТовара": "category",
+}
+
+
+# Читает обработанный датасет: CSV с разделителем | и кодировкой utf-8-sig (чтобы корректно работать с BOM)
+# или parquet/сегментированный датасет из DataStore (типы колонок берутся из файла, category — только там,
+# где запрошено в columns; сегменты объединяются).
+# columns — нужные колонки и их типы (отсутствующие в файле пропускаются); без columns читаются все колонки как str.
+# При ошибке pyarrow (см. _CSV_ENGINE, _read_csv_arrow) файл перечитывается движком C.
+def _read_csv_pipe(path: str, columns: Optional[Dict[str, object]] = None) -> pd.DataFrame:
+    if not path.lower().endswith(".csv"):
+        df = read_dataset(path, columns=list(columns) if columns is not None else None)
+        for c in df.columns:
+            if columns is not None and columns.get(c) == "category":
+                df[c] = df[c].astype("category")
+        return df
+
+    kwargs = {"sep": "|", "encoding": "utf-8-sig", "dtype": str}
+    if columns is not None:
+        use = [c for c in dataset_columns(path) if c in columns]
+        kwargs["usecols"] = use
+        kwargs["dtype"] = {c: columns[c] for c in use}
+    if _CSV_ENGINE == "pyarrow":
+        try:
+            return _read_csv_arrow(path, kwargs.get("usecols"), kwargs["dtype"])
+        except (ValueError, NotImplementedError) as e:
+            # ArrowInvalid/ArrowNotImplementedError наследуют эти классы; файл читается заново движком C
+            global _csv_engine_fallback_logged
+            if not _csv_engine_fallback_logged:
+                print(f"[{_now()}] pyarrow CSV engine failed on {path} ({type(e).__name__}: {e}); "
+                      f"falling back to the C engine")
+                _csv_engine_fallback_logged = True
+    return pd.read_csv(path, **kwargs)
+
+
+# Читает CSV через pyarrow.csv. pd.read_csv(engine="pyarrow") сначала выводит типы и лишь потом применяет dtype=str,
+# из-за чего коды из одних цифр теряют ведущие нули ("007" -> "7") и перестают совпадать с кодами Catalogue/Inference;
+# поэтому все колонки читаются сразу как строки, а category применяется после. Пустые значения — NaN, как у движка C.
+def _read_csv_arrow(path: str, use: Optional[List[str]], dtype: object) -> pd.DataFrame:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    names = use if use is not None else dataset_columns(path)
+    table = pacsv.read_csv(
+        path,
+        parse_options=pacsv.ParseOptions(delimiter="|"),
+        convert_options=pacsv.ConvertOptions(
+            column_types={c: pa.string() for c in names},
+            include_columns=names,
+            strings_can_be_null=True,
+        ),
+    )
+    df = table.to_pandas()
+    if isinstance(dtype, dict):
+        for c, t in dtype.items():
+            if t == "category" and c in df.columns:
+                df[c] = df[c].astype("category")
+    return df
 
 
 # Преобразует колонку с датами в формат datetime. Если ошибка — заменяет на NaT.
@@ -108,13 +219,71 @@ class Mappings:
     idx2item: List[str]
 
 
+# Разреженная матрица взаимодействий (user -> items, weights) в формате CSR на массивах NumPy.
+# Индексы внутри строки отсортированы, что позволяет векторизованно проверять принадлежность.
+@dataclass
+class UserItemCSR:
+    indptr: np.ndarray    # [U+1]
+    indices: np.ndarray   # [nnz], отсортированы внутри каждой строки
+    weights: np.ndarray   # [nnz], суммарный вес пары
+    num_items: int
+    keys: np.ndarray = field(init=False, repr=False)  # [nnz] u * I + i, глобально отсортированы
+
+    def __post_init__(self) -> None:
+        rows = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        self.keys = rows * self.num_items + self.indices
+
+    @staticmethod
+    def from_pairs(pairs: np.ndarray, num_users: int, num_items: int, weights: Optional[np.ndarray] = None) -> "UserItemCSR":
+        u = pairs[:, 0].astype(np.int64)
+        i = pairs[:, 1].astype(np.int64)
+        keys, inv = np.unique(u * num_items + i, return_inverse=True)
+        w = np.ones(len(u), dtype=np.float64) if weights is None else np.asarray(weights, dtype=np.float64)
+        agg = np.bincount(inv.ravel(), weights=w, minlength=len(keys)).astype(np.float32)
+        rows = keys // num_items
+        indptr = np.zeros(num_users + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_users), out=indptr[1:])
+        return UserItemCSR(indptr=indptr, indices=(keys % num_items).astype(np.int64), weights=agg, num_items=num_items)
+
+    @property
+    def num_users(self) -> int:
+        return len(self.indptr) - 1
+
+    def row(self, u: int) -> np.ndarray:
+        return self.indices[self.indptr[u]:self.indptr[u + 1]]
+
+    def gather_rows(self, users: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns (row_pos, items, weights) for all positives of `users`,
+        where row_pos is the position of the user inside `users`.
+        """
+        lens, flat = _csr_row_positions(self.indptr, users)
+        row_pos = np.repeat(np.arange(len(lens), dtype=np.int64), lens)
+        return row_pos, self.indices[flat], self.weights[flat]
+
+    def to_scipy(self) -> "sp.csr_matrix":
+        return sp.csr_matrix((self.weights, self.indices, self.indptr), shape=(self.num_users, self.num_items))
+
+    def contains(self, users: np.ndarray, items: np.ndarray) -> np.ndarray:
+        # ключи u * I + i монотонны по строкам CSR, поэтому один searchsorted на весь батч
+        if len(self.keys) == 0:
+            return np.zeros(np.shape(items), dtype=bool)
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        if items.ndim == 2:
+            users = users[:, None]
+        q = users * self.num_items + items
+        pos = np.minimum(np.searchsorted(self.keys, q), len(self.keys) - 1)
+        return self.keys[pos] == q
+
+
 @dataclass
 class Splits:
     train_pairs: np.ndarray       # [N,2] (u,i)
     train_weights: np.ndarray     # [N]
     eval_users: np.ndarray        # [M]
     eval_items: np.ndarray        # [M]
-    user_pos_train: List[set]     # per user: set(items)
+    train_csr: UserItemCSR        # user -> (items, weights) по train_pairs
 
 
 # Создаёт маппинги для пользователей и товаров. Конвертирует их в индексы
@@ -198,7 +367,7 @@ def _collect_user_item_events(
 
 
 # Делит данные на обучающие и тестовые выборки на основе времени последнего взаимодействия каждого пользователя.
-def _train_test_split_last_per_user(events: pd.DataFrame, cfg: TrainConfig, num_users: int) -> Splits:
+def _train_test_split_last_per_user(events: pd.DataFrame, cfg: TrainConfig, num_users: int, num_items: int) -> Splits:
     events_sorted = events.sort_values(["u_idx", "ts"])
     last = events_sorted.groupby("u_idx").tail(1)
 
@@ -215,36 +384,364 @@ def _train_test_split_last_per_user(events: pd.DataFrame, cfg: TrainConfig, num_
     train_pairs = train_agg[["u_idx", "i_idx"]].astype(int).to_numpy()
     train_weights = train_agg["w"].astype(float).to_numpy()
 
-    user_pos_train = [set() for _ in range(num_users)]
-    for u, i in train_pairs:
-        user_pos_train[int(u)].add(int(i))
+    train_csr = UserItemCSR.from_pairs(train_pairs, num_users, num_items, train_weights)
 
     return Splits(
         train_pairs=train_pairs,
         train_weights=train_weights,
         eval_users=eval_users,
         eval_items=eval_items,
-        user_pos_train=user_pos_train,
+        train_csr=train_csr,
+    )
+
+
+# ----------------------------- Dataset cache -----------------------------
+# Models/cache/digests.json          abspath -> [mtime, size, blake2b] (хеш не пересчитывается, пока файл не менялся)
+# Models/cache/<key>/users.npy       idx2user, fixed-width unicode
+# Models/cache/<key>/items.npy       idx2item
+# Models/cache/<key>/events.npz      u_idx, i_idx, ts (datetime64[ns]), w
+# Models/cache/<key>/splits.npz      train_pairs, train_weights, eval_users, eval_items, csr_indptr, csr_indices, csr_weights
+# Models/cache/<key>/meta.json       формат, ключ и исходные файлы
+# key — хеш от содержимого Заказов/Просмотров/Избранного, весов событий и порога для eval.
+
+DATASET_CACHE_FORMAT = 1
+
+
+# Хеши содержимого файлов; для неизменённых (mtime, size) берутся из digests.json без чтения файла.
+def _file_digests(cache_dir: str, paths: List[str]) -> List[str]:
+    index_path = os.path.join(cache_dir, "digests.json")
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except Exception:
+        index = {}
+
+    digests = []
+    changed = False
+    for p in paths:
+        ap = os.path.abspath(p)
+        stamp = [os.path.getmtime(p), os.path.getsize(p)]
+        known = index.get(ap)
+        if known is not None and known[:2] == stamp:
+            digests.append(known[2])
+            continue
+        h = hashlib.blake2b(digest_size=16)
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        index[ap] = stamp + [h.hexdigest()]
+        digests.append(h.hexdigest())
+        changed = True
+
+    if changed:
+        _ensure_dir(cache_dir)
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+    return digests
+
+
+def _dataset_cache_key(cfg: TrainConfig, paths: List[str]) -> str:
+    payload = {
+        "format": DATASET_CACHE_FORMAT,
+        "inputs": _file_digests(cfg.dataset_cache_dir, paths),
+        "weights": [cfg.w_view_item, cfg.w_favorite, cfg.w_purchase],
+        "min_user_interactions_for_eval": cfg.min_user_interactions_for_eval,
+    }
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode("utf-8"), digest_size=12).hexdigest()
+
+
+def _save_dataset_cache(cfg: TrainConfig, key: str, paths: List[str], maps: Mappings, events: pd.DataFrame,
+                        splits: Splits) -> None:
+    final_dir = os.path.join(cfg.dataset_cache_dir, key)
+    tmp_dir = final_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    _ensure_dir(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, "users.npy"), np.asarray(maps.idx2user, dtype=str))
+    np.save(os.path.join(tmp_dir, "items.npy"), np.asarray(maps.idx2item, dtype=str))
+    np.savez(
+        os.path.join(tmp_dir, "events.npz"),
+        u_idx=events["u_idx"].to_numpy(dtype=np.int64),
+        i_idx=events["i_idx"].to_numpy(dtype=np.int64),
+        ts=events["ts"].to_numpy(dtype="datetime64[ns]"),
+        w=events["w"].to_numpy(dtype=np.float64),
+    )
+    np.savez(
+        os.path.join(tmp_dir, "splits.npz"),
+        train_pairs=splits.train_pairs,
+        train_weights=splits.train_weights,
+        eval_users=splits.eval_users,
+        eval_items=splits.eval_items,
+        csr_indptr=splits.train_csr.indptr,
+        csr_indices=splits.train_csr.indices,
+        csr_weights=splits.train_csr.weights,
+    )
+    meta = {"format": DATASET_CACHE_FORMAT, "key": key, "created": _now(), "sources": [os.path.abspath(p) for p in paths]}
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # каталог версии появляется целиком или не появляется вовсе
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+    # остаются cfg.dataset_cache_keep последних версий
+    entries = [
+        os.path.join(cfg.dataset_cache_dir, name)
+        for name in os.listdir(cfg.dataset_cache_dir)
+        if os.path.isfile(os.path.join(cfg.dataset_cache_dir, name, "meta.json"))
+    ]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for old in entries[max(cfg.dataset_cache_keep, 1):]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _load_dataset_cache(cfg: TrainConfig, key: str) -> Optional[Tuple[Mappings, pd.DataFrame, Splits]]:
+    cache_dir = os.path.join(cfg.dataset_cache_dir, key)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format") != DATASET_CACHE_FORMAT or meta.get("key") != key:
+        return None
+
+    users = np.load(os.path.join(cache_dir, "users.npy")).tolist()
+    items = np.load(os.path.join(cache_dir, "items.npy")).tolist()
+    maps = Mappings(
+        user2idx=dict(zip(users, range(len(users)))),
+        idx2user=users,
+        item2idx=dict(zip(items, range(len(items)))),
+        idx2item=items,
     )
 
+    with np.load(os.path.join(cache_dir, "events.npz")) as z:
+        events = pd.DataFrame({"u_idx": z["u_idx"], "i_idx": z["i_idx"], "ts": z["ts"], "w": z["w"]})
+    with np.load(os.path.join(cache_dir, "splits.npz")) as z:
+        splits = Splits(
+            train_pairs=z["train_pairs"],
+            train_weights=z["train_weights"],
+            eval_users=z["eval_users"],
+            eval_items=z["eval_items"],
+            train_csr=UserItemCSR(
+                indptr=z["csr_indptr"], indices=z["csr_indices"], weights=z["csr_weights"], num_items=len(items)
+            ),
+        )
+    return maps, events, splits
+
+
+# Маппинги, события и разбиение: из кэша, если входные файлы и веса не менялись, иначе из CSV (с записью в кэш).
+def _prepare_dataset(cfg: TrainConfig, orders_path: str, views_path: str,
+                     fav_path: str) -> Optional[Tuple[Mappings, pd.DataFrame, Splits]]:
+    paths = [orders_path, views_path, fav_path]
+    key = None
+    if cfg.dataset_cache:
+        try:
+            t0 = time.perf_counter()
+            key = _dataset_cache_key(cfg, paths)
+            cached = _load_dataset_cache(cfg, key)
+            if cached is not None:
+                maps, events, splits = cached
+                print(f"[{_now()}] Dataset cache hit ({key}): {len(events):,} events "
+                      f"in {(time.perf_counter() - t0) * 1000:.0f} ms")
+                print(f"[{_now()}] Universe sizes: users={len(maps.idx2user):,} items={len(maps.idx2item):,}")
+                return maps, events, splits
+        except Exception as e:
+            print(f"[{_now()}] Dataset cache unavailable (non-fatal): {repr(e)}")
+
+    orders = _read_csv_pipe(orders_path, _EVENT_COLUMNS)
+    views = _read_csv_pipe(views_path, _EVENT_COLUMNS)
+    fav = _read_csv_pipe(fav_path, _EVENT_COLUMNS)
+
+    print(f"[{_now()}] Loaded:")
+    print(f"  - Orders:     {len(orders):,} rows  ({os.path.basename(orders_path)})")
+    print(f"  - Views:      {len(views):,} rows  ({os.path.basename(views_path)})")
+    print(f"  - Favorites:  {len(fav):,} rows    ({os.path.basename(fav_path)})")
+
+    maps = _build_mappings(orders, views, fav)
+    num_users = len(maps.idx2user)
+    num_items = len(maps.idx2item)
+    print(f"[{_now()}] Universe sizes: users={num_users:,} items={num_items:,}")
+
+    events = _collect_user_item_events(orders, views, fav, maps, cfg)
+    if len(events) == 0:
+        return None
+    splits = _train_test_split_last_per_user(events, cfg, num_users, num_items)
+
+    if key is not None:
+        try:
+            _save_dataset_cache(cfg, key, paths, maps, events, splits)
+            print(f"[{_now()}] Dataset cached: {os.path.join(cfg.dataset_cache_dir, key)}")
+        except Exception as e:
+            print(f"[{_now()}] Dataset cache write failed (non-fatal): {repr(e)}")
+    return maps, events, splits
+
+
+# ----------------------------- Samplers -----------------------------
+
+# Таблица псевдонимов (метод Воуза) для взвешенной выборки с возвращением за O(1) на элемент.
+# Строится один раз на разбиение; стоимость батча не зависит от числа пар N.
+def _build_alias_table(weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    w = np.asarray(weights, dtype=np.float64)
+    n = len(w)
+    total = w.sum()
+    if n == 0 or total <= 0:
+        return np.ones(n, dtype=np.float64), np.arange(n, dtype=np.int64)
+
+    scaled = (w * (n / total)).tolist()
+    alias = np.arange(n, dtype=np.int64)
+    small = [j for j, p in enumerate(scaled) if p < 1.0]
+    large = [j for j, p in enumerate(scaled) if p >= 1.0]
+
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        scaled[l] = scaled[l] - (1.0 - scaled[s])
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    prob = np.asarray(scaled, dtype=np.float64)
+    # остатки из-за погрешностей округления считаются полными ячейками
+    prob[large] = 1.0
+    prob[small] = 1.0
+    return prob, alias
+
+
+class PairSampler:
+    """
+    Batch sampler over (user, item) training pairs.
+
+    mode:
+      - "alias": weighted sampling with replacement via a precomputed alias table, O(batch) per batch;
+      - "epoch": weighted random permutation (Efraimidis-Spirakis keys) drawn once per epoch,
+                 batches are consecutive slices, so every pair is visited exactly once per epoch.
+    """
+
+    def __init__(self, train_pairs: np.ndarray, train_weights: np.ndarray, batch_size: int, mode: str = "alias"):
+        if mode not in ("alias", "epoch"):
+            raise ValueError(f"Unknown sampler mode: {mode}")
+        self.train_pairs = train_pairs
+        self.weights = np.asarray(train_weights, dtype=np.float64)
+        self.batch_size = int(batch_size)
+        self.mode = mode
+        self.n = len(train_pairs)
+
+        self._prob: Optional[np.ndarray] = None
+        self._alias: Optional[np.ndarray] = None
+        if mode == "alias":
+            self._prob, self._alias = _build_alias_table(self.weights)
 
-def _sample_batch(train_pairs: np.ndarray, train_weights: np.ndarray, batch_size: int, rng: np.random.Generator):
-    if len(train_pairs) <= batch_size:
-        return train_pairs[:, 0], train_pairs[:, 1]
-    w = train_weights.astype(np.float64)
-    w = w / (w.sum() + 1e-12)
-    idx = rng.choice(len(train_pairs), size=batch_size, replace=False, p=w)
-    return train_pairs[idx, 0], train_pairs[idx, 1]
+        self._order: Optional[np.ndarray] = None
+        self._cursor = 0
 
+    def steps_per_epoch(self) -> int:
+        return max(1, int(np.ceil(self.n / self.batch_size)))
 
-def _sample_negatives(users: np.ndarray, num_items: int, user_pos_train: List[set], rng: np.random.Generator, max_tries: int = 25):
-    neg = rng.integers(0, num_items, size=len(users), dtype=np.int64)
-    for _ in range(max_tries):
-        bad = np.array([n in user_pos_train[int(u)] for u, n in zip(users, neg)], dtype=bool)
-        if not bad.any():
-            break
-        neg[bad] = rng.integers(0, num_items, size=bad.sum(), dtype=np.int64)
-    return neg
+    def start_epoch(self, rng: np.random.Generator) -> None:
+        if self.mode != "epoch":
+            return
+        # ключи u^(1/w): сортировка по убыванию даёт взвешенную перестановку без возвращения
+        w = np.maximum(self.weights, 1e-12)
+        keys = np.log(rng.random(self.n)) / w
+        self._order = np.argsort(-keys, kind="stable")
+        self._cursor = 0
+
+    def sample(self, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        if self.n <= self.batch_size:
+            return self.train_pairs[:, 0], self.train_pairs[:, 1]
+
+        if self.mode == "alias":
+            col = rng.integers(0, self.n, size=self.batch_size)
+            keep = rng.random(self.batch_size) < self._prob[col]
+            idx = np.where(keep, col, self._alias[col])
+        else:
+            if self._order is None or self._cursor >= self.n:
+                self.start_epoch(rng)
+            idx = self._order[self._cursor:self._cursor + self.batch_size]
+            self._cursor += self.batch_size
+
+        return self.train_pairs[idx, 0], self.train_pairs[idx, 1]
+
+
+class NegativeSampler:
+    """
+    Negative item sampler with vectorized rejection of train positives.
+
+    strategy:
+      - "uniform": items drawn uniformly;
+      - "popularity": items drawn proportionally to popularity ** pop_alpha (alias table);
+      - "hard": n_candidates uniform negatives per row, the one with the highest model score is kept
+                (score_fn(users[B], cands[B, C]) -> scores[B, C] must be passed to sample()).
+    """
+
+    def __init__(self, pos: UserItemCSR, num_items: int, strategy: str = "uniform",
+                 pop_alpha: float = 0.75, n_candidates: int = 10, max_tries: int = 25):
+        if strategy not in ("uniform", "popularity", "hard"):
+            raise ValueError(f"Unknown negative sampling strategy: {strategy}")
+        self.pos = pos
+        self.num_items = int(num_items)
+        self.strategy = strategy
+        self.n_candidates = max(1, int(n_candidates))
+        self.max_tries = int(max_tries)
+
+        self._prob: Optional[np.ndarray] = None
+        self._alias: Optional[np.ndarray] = None
+        if strategy == "popularity":
+            pop = np.bincount(pos.indices, minlength=self.num_items).astype(np.float64)
+            self._prob, self._alias = _build_alias_table((pop + 1.0) ** float(pop_alpha))
+
+    def _draw(self, shape, rng: np.random.Generator) -> np.ndarray:
+        col = rng.integers(0, self.num_items, size=shape, dtype=np.int64)
+        if self._alias is None:
+            return col
+        keep = rng.random(shape) < self._prob[col]
+        return np.where(keep, col, self._alias[col])
+
+    def _reject(self, users: np.ndarray, neg: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        for _ in range(self.max_tries):
+            bad = self.pos.contains(users, neg)
+            if not bad.any():
+                break
+            neg[bad] = self._draw(int(bad.sum()), rng)
+        return neg
+
+    def sample(self, users: np.ndarray, rng: np.random.Generator, score_fn=None) -> np.ndarray:
+        users = np.asarray(users, dtype=np.int64)
+        if self.strategy != "hard" or score_fn is None:
+            return self._reject(users, self._draw(len(users), rng), rng)
+
+        cands = self._reject(users, self._draw((len(users), self.n_candidates), rng), rng)
+        scores = np.asarray(score_fn(users, cands), dtype=np.float32)
+        # кандидаты, оставшиеся положительными после max_tries, не выбираются
+        scores[self.pos.contains(users, cands)] = -np.inf
+        best = np.argmax(scores, axis=1)
+        return cands[np.arange(len(users)), best]
+
+
+# ----------------------------- Metrics -----------------------------
+
+# Метрики ранжирования для одного отложенного товара на пользователя по нескольким k за один проход.
+# topk_idx: [B, K] отсортированные рекомендации, K >= max(ks). Возвращает суммы (усреднение — у вызывающего).
+def _ranking_metric_sums(topk_idx: np.ndarray, gt: np.ndarray, ks: Tuple[int, ...]) -> Dict[str, float]:
+    hits = topk_idx == gt.reshape(-1, 1)                           # [B, K]
+    found = hits.any(axis=1)
+    rank = np.where(found, hits.argmax(axis=1) + 1, np.iinfo(np.int64).max)  # 1-based
+
+    sums: Dict[str, float] = {}
+    for k in ks:
+        hit_k = rank <= k
+        # при одном релевантном товаре recall@k = HR@k, а AP@k = 1/rank
+        sums[f"recall@{k}"] = float(hit_k.sum())
+        sums[f"hr@{k}"] = float(hit_k.sum())
+        sums[f"ndcg@{k}"] = float((1.0 / np.log2(rank[hit_k] + 1.0)).sum())
+        sums[f"map@{k}"] = float((1.0 / rank[hit_k]).sum())
+    return sums
+
+
+def _eval_ks(cfg: TrainConfig) -> Tuple[int, ...]:
+    return tuple(sorted(set(int(k) for k in cfg.eval_ks) | {int(cfg.topk)}))
 
 
 # ----------------------------- BPR-MF -----------------------------
@@ -264,69 +761,76 @@ class BPRMF(nn.Module):
 
 
 @torch.no_grad()
-def _eval_bprmf_recall_ndcg(model: BPRMF, splits: Splits, num_items: int, k: int, device: torch.device) -> Tuple[float, float]:
+def _eval_bprmf_metrics(model: BPRMF, splits: Splits, num_items: int, ks: Tuple[int, ...], device: torch.device,
+                        chunk: int = 2048) -> Dict[str, float]:
     if len(splits.eval_users) == 0:
-        return 0.0, 0.0
+        return {f"{m}@{k}": 0.0 for k in ks for m in ("recall", "hr", "ndcg", "map")}
 
     item_emb = model.item_emb.weight  # [I, d]
     users = splits.eval_users.astype(np.int64)
     gt = splits.eval_items.astype(np.int64)
+    kmax = min(max(ks), num_items)
 
-    chunk = 512
-    recalls, ndcgs = [], []
-
+    totals: Dict[str, float] = {}
     for start in range(0, len(users), chunk):
         u = users[start:start + chunk]
         g = gt[start:start + chunk]
 
-        u_t = torch.tensor(u, dtype=torch.long, device=device)
-        u_emb = model.user_emb(u_t)
-        scores = u_emb @ item_emb.t()
-
-        # filter train positives
-        for bi, uu in enumerate(u):
-            pos = splits.user_pos_train[int(uu)]
-            if pos:
-                idx = torch.tensor(list(pos), dtype=torch.long, device=device)
-                scores[bi, idx] = -1e9
-
-        topk_idx = torch.topk(scores, k=min(k, num_items), dim=1).indices.cpu().numpy()
-
-        for bi in range(len(u)):
-            target = int(g[bi])
-            if target in topk_idx[bi]:
-                rank = int(np.where(topk_idx[bi] == target)[0][0]) + 1
-                recalls.append(1.0)
-                ndcgs.append(1.0 / np.log2(rank + 1))
-            else:
-                recalls.append(0.0)
-                ndcgs.append(0.0)
+        u_t = torch.as_tensor(u, dtype=torch.long, device=device)
+        scores = model.user_emb(u_t) @ item_emb.t()
+
+        # filter train positives: one scatter for the whole chunk
+        row_pos, items, _ = splits.train_csr.gather_rows(u)
+        if len(items):
+            scores[torch.as_tensor(row_pos, device=device), torch.as_tensor(items, device=device)] = -1e9
 
-    return float(np.mean(recalls)), float(np.mean(ndcgs))
+        topk_idx = torch.topk(scores, k=kmax, dim=1).indices.cpu().numpy()
+        for key, val in _ranking_metric_sums(topk_idx, g, ks).items():
+            totals[key] = totals.get(key, 0.0) + val
 
+    return {key: val / len(users) for key, val in totals.items()}
 
-def train_bprmf(maps: Mappings, events: pd.DataFrame, cfg: TrainConfig, device: torch.device):
+
+def train_bprmf(maps: Mappings, events: pd.DataFrame, cfg: TrainConfig, device: torch.device,
+                splits: Optional[Splits] = None):
     torch.set_num_threads(1)
     torch.set_num_interop_threads(1)
 
     num_users = len(maps.idx2user)
     num_items = len(maps.idx2item)
-    splits = _train_test_split_last_per_user(events, cfg, num_users)
+    if splits is None:
+        splits = _train_test_split_last_per_user(events, cfg, num_users, num_items)
 
     model = BPRMF(num_users, num_items, cfg.embedding_dim).to(device)
     opt = torch.optim.Adam(model.parameters(), lr=cfg.lr, weight_decay=cfg.weight_decay)
     rng = np.random.default_rng(cfg.seed)
+    sampler = PairSampler(splits.train_pairs, splits.train_weights, cfg.batch_size, mode=cfg.sampler)
+    neg_sampler = NegativeSampler(
+        splits.train_csr,
+        num_items,
+        strategy=cfg.neg_sampler,
+        pop_alpha=cfg.neg_pop_alpha,
+        n_candidates=cfg.neg_hard_candidates,
+    )
+
+    @torch.no_grad()
+    def _score_candidates(users: np.ndarray, cands: np.ndarray) -> np.ndarray:
+        u_t = torch.as_tensor(users, dtype=torch.long, device=device)
+        c_t = torch.as_tensor(cands, dtype=torch.long, device=device)
+        return (model.user_emb(u_t).unsqueeze(1) * model.item_emb(c_t)).sum(dim=-1).cpu().numpy()
 
-    best = {"recall": -1.0, "ndcg": -1.0, "epoch": -1, "state": None}
+    ks = _eval_ks(cfg)
+    best = {"recall": -1.0, "ndcg": -1.0, "epoch": -1, "state": None, "metrics": {}}
 
     for epoch in range(1, cfg.epochs + 1):
         model.train()
-        steps = max(1, int(np.ceil(len(splits.train_pairs) / cfg.batch_size)))
+        steps = sampler.steps_per_epoch()
+        sampler.start_epoch(rng)
         total_loss = 0.0
 
         for _ in range(steps):
-            u_pos, i_pos = _sample_batch(splits.train_pairs, splits.train_weights, cfg.batch_size, rng)
-            i_neg = _sample_negatives(u_pos, num_items, splits.user_pos_train, rng)
+            u_pos, i_pos = sampler.sample(rng)
+            i_neg = neg_sampler.sample(u_pos, rng, score_fn=_score_candidates)
 
             u_t = torch.tensor(u_pos, dtype=torch.long, device=device)
             ip_t = torch.tensor(i_pos, dtype=torch.long, device=device)
@@ -348,13 +852,15 @@ def train_bprmf(maps: Mappings, events: pd.DataFrame, cfg: TrainConfig, device:
             total_loss += float(loss.detach().cpu())
 
         model.eval()
-        recall, ndcg = _eval_bprmf_recall_ndcg(model, splits, num_items, cfg.topk, device)
+        metrics = _eval_bprmf_metrics(model, splits, num_items, ks, device, chunk=cfg.eval_block)
+        recall, ndcg = metrics[f"recall@{cfg.topk}"], metrics[f"ndcg@{cfg.topk}"]
 
         print(f"[{_now()}] BPR-MF epoch {epoch:02d}/{cfg.epochs}: "
-              f"loss={total_loss/steps:.4f}  recall@{cfg.topk}={recall:.4f}  ndcg@{cfg.topk}={ndcg:.4f}")
+              f"loss={total_loss/steps:.4f}  recall@{cfg.topk}={recall:.4f}  ndcg@{cfg.topk}={ndcg:.4f}  "
+              f"map@{cfg.topk}={metrics[f'map@{cfg.topk}']:.4f}")
 
         if recall > best["recall"]:
-            best["recall"], best["ndcg"], best["epoch"] = recall, ndcg, epoch
+            best["recall"], best["ndcg"], best["epoch"], best["metrics"] = recall, ndcg, epoch, metrics
             best["state"] = {k: v.detach().cpu() for k, v in model.state_dict().items()}
 
     # restore best weights (optional; here last epoch is usually best, but keep it correct)
@@ -362,71 +868,466 @@ def train_bprmf(maps: Mappings, events: pd.DataFrame, cfg: TrainConfig, device:
         model.load_state_dict(best["state"])
 
     print(f"[{_now()}] BPR-MF best: epoch={best['epoch']} recall@{cfg.topk}={best['recall']:.4f} ndcg@{cfg.topk}={best['ndcg']:.4f}")
+    if best["metrics"]:
+        print("  " + "  ".join(f"{key}={val:.4f}" for key, val in best["metrics"].items()))
     return model, splits
 
 
 # ----------------------------- EASE^R -----------------------------
 
-def _ease_solve(X: "sp.csr_matrix", l2: float) -> np.ndarray:
-    G = (X.T @ X).toarray().astype(np.float32)
+def _ease_gram(X: "sp.csr_matrix", dtype: str) -> np.ndarray:
+    Xt = X.astype(np.dtype(dtype))
+    return (Xt.T @ Xt).toarray()
+
+
+# Копирует верхний треугольник в нижний по блокам строк (без n^2 индексных массивов).
+def _symmetrize_from_upper(A: np.ndarray, block: int = 2048) -> None:
+    n = A.shape[0]
+    for r0 in range(0, n, block):
+        r1 = min(n, r0 + block)
+        A[r0:r1, :r0] = A[:r0, r0:r1].T
+        d = A[r0:r1, r0:r1]
+        d[...] = np.triu(d) + np.triu(d, 1).T
+
+
+# B = I - P * diag(1/diag(P)), на месте в P.
+def _ease_weights_from_inverse(P: np.ndarray) -> np.ndarray:
+    d = np.diag(P).copy()
+    np.divide(P, -d.reshape(1, -1), out=P)
+    np.fill_diagonal(P, 0.0)
+    return P
+
+
+def _ease_solve(X: "sp.csr_matrix", l2: float, dtype: str = "float32") -> np.ndarray:
+    """
+    EASE^R closed form via in-place Cholesky (LAPACK potrf/potri) of the SPD Gram matrix.
+    Only one dense n x n buffer is alive: G is overwritten by its factor, then by P = G^-1, then by B.
+    """
+    G = _ease_gram(X, dtype)
     diag = np.arange(G.shape[0])
     G[diag, diag] += float(l2)
-    P = np.linalg.inv(G).astype(np.float32)
-    d = np.diag(P)
-    B = -P / d.reshape(1, -1)
-    np.fill_diagonal(B, 0.0)
-    return B
 
+    # G симметрична, поэтому G.T — F-упорядоченный вид того же буфера, и LAPACK работает без копии
+    potrf, potri = sla.lapack.get_lapack_funcs(("potrf", "potri"), (G,))
+    c, info = potrf(G.T, lower=0, overwrite_a=1, clean=1)
+    if info != 0:
+        raise np.linalg.LinAlgError(f"EASE: Cholesky failed (info={info})")
+    P, info = potri(c, lower=0, overwrite_c=1)
+    if info != 0:
+        raise np.linalg.LinAlgError(f"EASE: potri failed (info={info})")
 
-def _eval_ease_one_positive(X_train: "sp.csr_matrix", B: np.ndarray, splits: Splits, k: int) -> Tuple[float, float]:
+    _symmetrize_from_upper(P)
+    return _ease_weights_from_inverse(P.T)
+
+
+def _ease_lambda_sweep(X: "sp.csr_matrix", lambdas: Tuple[float, ...], dtype: str = "float32"):
+    """
+    Yields (lambda, B) for every lambda. G = V diag(s) V^T is eigendecomposed once,
+    then P(lambda) = V diag(1 / (s + lambda)) V^T costs one GEMM per lambda.
+    """
+    s_eig, V = sla.eigh(_ease_gram(X, dtype), overwrite_a=True, check_finite=False)
+    for l2 in lambdas:
+        P = (V / (s_eig + float(l2)).reshape(1, -1)) @ V.T
+        yield float(l2), _ease_weights_from_inverse(P)
+
+
+def _eval_ease_metrics(X_train: "sp.csr_matrix", B: np.ndarray, splits: Splits, ks: Tuple[int, ...],
+                       block: int = 1024) -> Dict[str, float]:
     if len(splits.eval_users) == 0:
-        return 0.0, 0.0
+        return {f"{m}@{k}": 0.0 for k in ks for m in ("recall", "hr", "ndcg", "map")}
 
     users = splits.eval_users.astype(np.int64)
     gt = splits.eval_items.astype(np.int64)
+    kmax = min(max(ks), B.shape[1])
+
+    totals: Dict[str, float] = {}
+    for start in range(0, len(users), max(1, int(block))):
+        u = users[start:start + block]
+        scores = X_train[u] @ B  # [b, n], one sparse x dense GEMM (or sparse x sparse for block EASE)
+        scores = scores.toarray() if sp.issparse(scores) else scores
+        scores = np.asarray(scores, dtype=np.float32)
+
+        row_pos, items, _ = splits.train_csr.gather_rows(u)
+        scores[row_pos, items] = -1e9
+
+        topk_idx = _topk_rows(scores, kmax)
+        for key, val in _ranking_metric_sums(topk_idx, gt[start:start + block], ks).items():
+            totals[key] = totals.get(key, 0.0) + val
+
+    return {key: val / len(users) for key, val in totals.items()}
+
+
+# ---- Partitioned (block-diagonal) EASE ----
 
-    recalls, ndcgs = [], []
-
-    for u, g in zip(users, gt):
-        x = X_train[int(u)]  # 1 x n
-        scores = np.asarray(x @ B).ravel()  # <- safe for ndarray/matrix
-        seen = x.indices
-        if len(seen):
-            scores[seen] = -1e9
-        topk = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
-        topk = topk[np.argsort(-scores[topk])]
-        target = int(g)
-        if target in topk:
-            rank = int(np.where(topk == target)[0][0]) + 1
-            recalls.append(1.0)
-            ndcgs.append(1.0 / np.log2(rank + 1))
+# Группы товаров по справочнику номенклатуры: КатегорияНаСайте, иначе ВидНоменклатуры. -1 — группа не известна.
+def _item_groups_from_nomenclature(data_dir: str, idx2item: List[str]) -> Optional[np.ndarray]:
+    try:
+        nom = catalogue.nomenclature(data_dir)
+    except Exception:
+        return None
+    if nom is None or "КодНоменклатуры" not in nom.columns:
+        return None
+
+    key = pd.Series(pd.NA, index=nom.index, dtype=object)
+    for col in ("ВидНоменклатуры", "КатегорияНаСайте"):
+        if col in nom.columns:
+            values = nom[col].astype(object)
+            key = values.where(values.notna() & (values.astype(str).str.strip() != ""), key)
+    if key.isna().all():
+        return None
+
+    code2group = dict(zip(nom["КодНоменклатуры"].astype(str), key))
+    labels = pd.Series([code2group.get(code) for code in idx2item], dtype=object)
+    return pd.factorize(labels, use_na_sentinel=True)[0].astype(np.int64)
+
+
+# Сферический k-means (косинусная близость): возвращает (центроиды [C, d], метки [n]).
+def _spherical_kmeans(emb: np.ndarray, n_clusters: int, seed: int, iters: int = 15) -> Tuple[np.ndarray, np.ndarray]:
+    n = emb.shape[0]
+    n_clusters = max(1, min(int(n_clusters), n))
+    rng = np.random.default_rng(seed)
+    centroids = emb[rng.choice(n, size=n_clusters, replace=False)].copy()
+    labels = np.zeros(n, dtype=np.int64)
+    for _ in range(iters):
+        labels = np.argmax(emb @ centroids.T, axis=1)
+        counts = np.bincount(labels, minlength=n_clusters).astype(np.float32)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, emb)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids, labels
+
+
+# Кластеризация товаров по совместной встречаемости: усечённый SVD матрицы X и k-means по векторам товаров.
+def _item_groups_from_cooccurrence(X: "sp.csr_matrix", n_groups: int, seed: int, dim: int = 32, iters: int = 15) -> np.ndarray:
+    from scipy.sparse.linalg import svds
+
+    n_items = X.shape[1]
+    if min(X.shape) <= 1:
+        # svds требует k < min(shape) — кластеризовать нечего, все товары в одной группе
+        return np.zeros(n_items, dtype=np.int64)
+    n_groups = max(1, min(int(n_groups), n_items))
+    dim = max(1, min(int(dim), min(X.shape) - 1))
+    Xb = X.astype(np.float64)
+    Xb.data[:] = 1.0
+    _, s_vals, vt = svds(Xb, k=dim, random_state=seed)
+    emb = (vt.T * s_vals).astype(np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12
+    return _spherical_kmeans(emb, n_groups, seed, iters)[1]
+
+
+# Собирает блоки не больше block_size: крупные группы режутся, мелкие объединяются жадно.
+def _pack_item_blocks(groups: np.ndarray, block_size: int) -> List[np.ndarray]:
+    groups = np.asarray(groups, dtype=np.int64)
+    order = np.argsort(groups, kind="stable")
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+    parts = []
+    for members in np.split(order, bounds):
+        for start in range(0, len(members), block_size):
+            parts.append(members[start:start + block_size])
+
+    parts.sort(key=len, reverse=True)
+    blocks: List[List[np.ndarray]] = []
+    sizes: List[int] = []
+    for part in parts:
+        for bi in range(len(blocks)):
+            if sizes[bi] + len(part) <= block_size:
+                blocks[bi].append(part)
+                sizes[bi] += len(part)
+                break
         else:
-            recalls.append(0.0)
-            ndcgs.append(0.0)
+            blocks.append([part])
+            sizes.append(len(part))
+    return [np.sort(np.concatenate(b)) for b in blocks]
+
+
+def _ease_solve_block(args) -> Tuple[np.ndarray, np.ndarray]:
+    items, X_block, l2, dtype = args
+    return items, _ease_solve(X_block, l2, dtype=dtype)
+
+
+def _ease_solve_partitioned(X: "sp.csr_matrix", blocks: List[np.ndarray], l2: float, dtype: str, workers: int) -> "sp.csr_matrix":
+    """
+    Solves EASE^R independently for every item block and assembles a block-sparse CSR B.
+    Memory is sum(block_size^2) for the CSR plus one dense block (per worker) in flight, instead of n_items^2.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    n = X.shape[1]
+    # Блоки не пересекаются: строка товара из блока b содержит ровно len(b) значений в колонках b
+    row_len = np.zeros(n, dtype=np.int64)
+    for items in blocks:
+        row_len[items] = len(items)
+    nnz = int(row_len.sum())
+    index_dtype = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(n + 1, dtype=index_dtype)
+    np.cumsum(row_len, out=indptr[1:])
+    indices = np.empty(nnz, dtype=index_dtype)
+    data = np.empty(nnz, dtype=np.dtype(dtype))
+
+    def put(items: np.ndarray, Bb: np.ndarray) -> None:
+        cols = np.asarray(items, dtype=index_dtype)
+        for j, r in enumerate(items):
+            start = indptr[r]
+            indices[start:start + len(items)] = cols
+            data[start:start + len(items)] = Bb[j]
+
+    Xc = X.tocsc()
+    tasks = ((items, Xc[:, items].tocsr(), float(l2), dtype) for items in blocks)
+
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=min(int(workers), len(blocks))) as ex:
+            pending = {ex.submit(_ease_solve_block, t) for t in tasks}
+            for fut in as_completed(pending):
+                pending.discard(fut)
+                put(*fut.result())
+                del fut
+    else:
+        for t in tasks:
+            put(*_ease_solve_block(t))
+
+    B = sp.csr_matrix((data, indices, indptr), shape=(n, n))
+    B.has_sorted_indices = all(np.all(np.diff(items) > 0) for items in blocks)
+    B.eliminate_zeros()
+    return B
 
-    return float(np.mean(recalls)), float(np.mean(ndcgs))
 
+def _ease_partition_blocks(X: "sp.csr_matrix", cfg: TrainConfig, item_groups: Optional[np.ndarray]) -> List[np.ndarray]:
+    mode = cfg.ease_partition
+    if mode in ("auto", "category") and item_groups is not None:
+        groups = item_groups.copy()
+        # товары без группы кластеризуются отдельно по совместной встречаемости
+        unknown = np.flatnonzero(groups < 0)
+        if len(unknown) > cfg.ease_block_size:
+            sub = _item_groups_from_cooccurrence(X[:, unknown], int(np.ceil(len(unknown) / cfg.ease_block_size)) * 2, cfg.seed)
+            groups[unknown] = groups.max() + 1 + sub
+        return _pack_item_blocks(groups, cfg.ease_block_size)
+    if mode == "category":
+        raise RuntimeError("EASE partition: no item groups in Номенклатура.csv")
 
-def train_ease_r(splits: Splits, num_users: int, num_items: int, cfg: TrainConfig):
+    n_groups = int(np.ceil(X.shape[1] / cfg.ease_block_size)) * 2
+    return _pack_item_blocks(_item_groups_from_cooccurrence(X, n_groups, cfg.seed), cfg.ease_block_size)
+
+
+# ---- Pruned sparse EASE ----
+
+def _prune_ease(B, topm: int = 0, threshold: float = 0.0, block: int = 2048) -> "sp.csr_matrix":
+    """
+    Keeps per row only the top-m weights by |value| (topm > 0) and/or weights with |value| > threshold.
+    Works for dense B (row blocks) and for sparse B (vectorized per-row ranking on the CSR).
+    """
+    n_rows, n_cols = B.shape
+    topm = int(topm)
+
+    if sp.issparse(B):
+        C = B.tocsr()
+        rows = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(C.indptr))
+        mag = np.abs(C.data)
+        keep = mag > float(threshold)
+        if topm > 0:
+            order = np.lexsort((-mag, rows))
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order)) - C.indptr[rows[order]]
+            keep &= rank < topm
+        out = sp.csr_matrix((C.data[keep], (rows[keep], C.indices[keep])), shape=(n_rows, n_cols), dtype=C.dtype)
+        out.eliminate_zeros()
+        return out
+
+    rows_l, cols_l, vals_l = [], [], []
+    for r0 in range(0, n_rows, block):
+        blk = np.asarray(B[r0:r0 + block])
+        if 0 < topm < n_cols:
+            cols = np.argpartition(-np.abs(blk), topm - 1, axis=1)[:, :topm]
+        else:
+            cols = np.tile(np.arange(n_cols), (blk.shape[0], 1))
+        vals = np.take_along_axis(blk, cols, axis=1)
+        keep = (np.abs(vals) > float(threshold)) & (vals != 0)
+        rows = np.broadcast_to(np.arange(r0, r0 + blk.shape[0]).reshape(-1, 1), cols.shape)
+        rows_l.append(rows[keep])
+        cols_l.append(cols[keep])
+        vals_l.append(vals[keep])
+
+    out = sp.csr_matrix(
+        (np.concatenate(vals_l), (np.concatenate(rows_l), np.concatenate(cols_l))),
+        shape=(n_rows, n_cols),
+        dtype=B.dtype,
+    )
+    out.sort_indices()
+    return out
+
+
+def _ease_nbytes(B) -> int:
+    if sp.issparse(B):
+        return int(B.data.nbytes + B.indices.nbytes + B.indptr.nbytes)
+    return int(B.nbytes)
+
+
+# Печатает точность и размер прунинга для каждого m из cfg.ease_prune_report (если список задан), затем применяет
+# выбранный режим и печатает его точность рядом с точностью полной матрицы.
+def _ease_prune_stage(B, X: "sp.csr_matrix", splits: Splits, cfg: TrainConfig, metrics: Dict[str, float]):
+    if not cfg.ease_prune_report and cfg.ease_prune_topm <= 0 and cfg.ease_prune_threshold <= 0:
+        return B, metrics
+
+    ks = _eval_ks(cfg)
+    key_r, key_n = f"recall@{cfg.topk}", f"ndcg@{cfg.topk}"
+    base_size = _ease_nbytes(B)
+
+    def compare(Bm, mm: Dict[str, float]) -> str:
+        size = _ease_nbytes(Bm)
+        return (f"{size / 2**20:8.1f} MB (x{base_size / max(size, 1):.1f} smaller)  "
+                f"{key_r}={mm[key_r]:.4f} ({mm[key_r] - metrics[key_r]:+.4f})  "
+                f"{key_n}={mm[key_n]:.4f} ({mm[key_n] - metrics[key_n]:+.4f})")
+
+    full = (f"full: {base_size / 2**20:.1f} MB, "
+            f"{key_r}={metrics[key_r]:.4f} {key_n}={metrics[key_n]:.4f}")
+    if cfg.ease_prune_report:
+        print(f"[{_now()}] EASE^R pruning report ({full}):")
+        for m in cfg.ease_prune_report:
+            if int(m) >= B.shape[1]:
+                continue
+            Bm = _prune_ease(B, topm=int(m), threshold=cfg.ease_prune_threshold)
+            print(f"  m={int(m):>5}: {compare(Bm, _eval_ease_metrics(X, Bm, splits, ks, block=cfg.ease_eval_block))}")
+            del Bm
+
+    if cfg.ease_prune_topm <= 0 and cfg.ease_prune_threshold <= 0:
+        return B, metrics
+
+    Bp = _prune_ease(B, topm=cfg.ease_prune_topm, threshold=cfg.ease_prune_threshold)
+    mp = _eval_ease_metrics(X, Bp, splits, ks, block=cfg.ease_eval_block)
+    print(f"[{_now()}] EASE^R pruned (m={cfg.ease_prune_topm}, threshold={cfg.ease_prune_threshold:g}, "
+          f"nnz={Bp.nnz:,}; {full}):")
+    print(f"  {compare(Bp, mp).lstrip()}")
+    return Bp, mp
+
+
+# Будет ли EASE^R решаться по блокам товаров (явный режим или "auto" при превышении max_items_for_ease).
+def _ease_partitioned(cfg: TrainConfig, num_items: int) -> bool:
+    return cfg.ease_partition in ("category", "cooccurrence") or (
+        cfg.ease_partition == "auto" and num_items > cfg.max_items_for_ease
+    )
+
+
+def train_ease_r(splits: Splits, num_users: int, num_items: int, cfg: TrainConfig,
+                 item_groups: Optional[np.ndarray] = None):
     if sp is None:
         raise RuntimeError("scipy is not installed")
 
+    X = splits.train_csr.to_scipy()
+    ks = _eval_ks(cfg)
+
+    if _ease_partitioned(cfg, num_items):
+        blocks = _ease_partition_blocks(X, cfg, item_groups)
+        print(f"[{_now()}] EASE^R partitioned: {len(blocks)} blocks, "
+              f"max block={max(len(b) for b in blocks):,} items, workers={cfg.ease_workers}")
+        if not cfg.ease_lambda_grid:
+            B = _ease_solve_partitioned(X, blocks, cfg.ease_lambda, cfg.ease_dtype, cfg.ease_workers)
+            metrics = _eval_ease_metrics(X, B, splits, ks, block=cfg.ease_eval_block)
+            return _ease_prune_stage(B, X, splits, cfg, metrics)
+        # Перебор lambda: блочное решение заново для каждого значения (разложение G по блокам не переиспользуется)
+        sweep = ((l2, _ease_solve_partitioned(X, blocks, l2, cfg.ease_dtype, cfg.ease_workers))
+                 for l2 in cfg.ease_lambda_grid)
+        return _ease_best_lambda(sweep, X, splits, cfg)
+
     if num_items > cfg.max_items_for_ease:
         raise RuntimeError(f"EASE guardrail: items={num_items} > {cfg.max_items_for_ease}")
 
-    rows = splits.train_pairs[:, 0].astype(np.int32)
-    cols = splits.train_pairs[:, 1].astype(np.int32)
-    vals = splits.train_weights.astype(np.float32)
-
-    X = sp.csr_matrix((vals, (rows, cols)), shape=(num_users, num_items))
-    B = _ease_solve(X, cfg.ease_lambda)
-    recall, ndcg = _eval_ease_one_positive(X, B, splits, cfg.topk)
-    return B, recall, ndcg
+    if not cfg.ease_lambda_grid:
+        B = _ease_solve(X, cfg.ease_lambda, dtype=cfg.ease_dtype)
+        metrics = _eval_ease_metrics(X, B, splits, ks, block=cfg.ease_eval_block)
+        return _ease_prune_stage(B, X, splits, cfg, metrics)
+
+    return _ease_best_lambda(_ease_lambda_sweep(X, tuple(cfg.ease_lambda_grid), dtype=cfg.ease_dtype), X, splits, cfg)
+
+
+# Лучшая по recall@topk матрица из перебора (l2, B); остальные освобождаются по ходу перебора.
+def _ease_best_lambda(sweep, X: "sp.csr_matrix", splits: Splits, cfg: TrainConfig):
+    ks = _eval_ks(cfg)
+    best_B, best_metrics, best_l2 = None, None, None
+    for l2, B in sweep:
+        metrics = _eval_ease_metrics(X, B, splits, ks, block=cfg.ease_eval_block)
+        print(f"[{_now()}] EASE^R lambda={l2:g}: recall@{cfg.topk}={metrics[f'recall@{cfg.topk}']:.4f} "
+              f"ndcg@{cfg.topk}={metrics[f'ndcg@{cfg.topk}']:.4f}")
+        if best_metrics is None or metrics[f"recall@{cfg.topk}"] > best_metrics[f"recall@{cfg.topk}"]:
+            best_B, best_metrics, best_l2 = B, metrics, l2
+        del B
+
+    print(f"[{_now()}] EASE^R best lambda={best_l2:g}")
+    return _ease_prune_stage(best_B, X, splits, cfg, best_metrics)
+
+
+# ----------------------------- ANN index (IVF) -----------------------------
+
+def _build_ivf(item_emb: np.ndarray, nlist: int, seed: int) -> IVFIndex:
+    n = item_emb.shape[0]
+    nlist = int(nlist) if nlist > 0 else int(np.ceil(np.sqrt(n)))
+    emb = item_emb / (np.linalg.norm(item_emb, axis=1, keepdims=True) + 1e-12)
+    centroids, labels = _spherical_kmeans(emb.astype(np.float32), nlist, seed)
+    order = np.argsort(labels, kind="stable")
+    indptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=len(centroids)), out=indptr[1:])
+    return IVFIndex(centroids=centroids.astype(np.float32), indptr=indptr, items=order.astype(np.int32), nprobe=1)
+
+
+# Recall@k IVF относительно точного поиска на выборке пользователей для каждого nprobe.
+def _ivf_recall(index: IVFIndex, user_emb: np.ndarray, item_emb: np.ndarray, k: int, nprobes: List[int],
+                n_users: int, seed: int) -> Dict[int, float]:
+    rng = np.random.default_rng(seed)
+    users = rng.choice(len(user_emb), size=min(int(n_users), len(user_emb)), replace=False)
+    U = np.asarray(user_emb[users], dtype=np.float32)
+    k = min(int(k), item_emb.shape[0])
+    exact = _topk_rows(U @ np.asarray(item_emb, dtype=np.float32).T, k)
+
+    out = {}
+    for nprobe in nprobes:
+        hits = 0
+        for row, u in enumerate(U):
+            approx, _ = index.search(u, item_emb, k, nprobe=nprobe)
+            hits += len(np.intersect1d(approx, exact[row], assume_unique=True))
+        out[int(nprobe)] = hits / float(len(users) * k)
+    return out
+
+
+# Строит IVF, подбирает минимальный nprobe с recall >= cfg.ann_target_recall и сохраняет индекс.
+def _save_ann_index(out_dir: str, cfg: TrainConfig, user_emb: np.ndarray, item_emb: np.ndarray) -> Optional[dict]:
+    index = _build_ivf(item_emb, cfg.ann_nlist, cfg.seed)
+    nlist = len(index.centroids)
+    nprobes = sorted({int(p) for p in (1, 2, 4, 8, 16, 32, 64) if p < nlist} | {nlist})
+    recalls = _ivf_recall(index, user_emb, item_emb, cfg.topk, nprobes, cfg.ann_eval_users, cfg.seed)
+
+    chosen = next((p for p in nprobes if recalls[p] >= cfg.ann_target_recall), nlist)
+    index.nprobe = chosen
+    print(f"[{_now()}] ANN IVF: nlist={nlist}, recall@{cfg.topk} vs exact: "
+          + "  ".join(f"nprobe={p}:{recalls[p]:.3f}" for p in nprobes)
+          + f" -> nprobe={chosen} (target {cfg.ann_target_recall:.2f})")
+
+    np.save(os.path.join(out_dir, "ann_ivf.centroids.npy"), index.centroids)
+    np.save(os.path.join(out_dir, "ann_ivf.indptr.npy"), index.indptr)
+    np.save(os.path.join(out_dir, "ann_ivf.items.npy"), index.items)
+    return {"nlist": nlist, "nprobe": chosen, "recall": {str(p): r for p, r in recalls.items()}}
 
 
 # ----------------------------- Saving / Loading -----------------------------
+# Формат каталога Models/ описан в Inference.py.
 
-def _save_artifacts(cfg: TrainConfig, maps: Mappings, model: BPRMF, splits: Splits, ease_B: Optional[np.ndarray]):
+def _save_profile_index(out_dir: str, events: pd.DataFrame, num_users: int, num_items: int) -> None:
+    pairs = events[["u_idx", "i_idx"]].to_numpy(dtype=np.int64)
+    prof = UserItemCSR.from_pairs(pairs, num_users, num_items, events["w"].to_numpy(dtype=np.float64))
+    np.save(os.path.join(out_dir, "profile.data.npy"), prof.weights.astype(np.float32))
+    np.save(os.path.join(out_dir, "profile.indices.npy"), prof.indices.astype(np.int32))
+    np.save(os.path.join(out_dir, "profile.indptr.npy"), prof.indptr.astype(np.int64))
+
+
+def _save_code_index(out_dir: str, name: str, codes: List[str]) -> None:
+    arr = np.asarray(codes, dtype=str)
+    order = np.argsort(arr, kind="stable")
+    np.save(os.path.join(out_dir, f"idx2{name}.npy"), arr)
+    np.save(os.path.join(out_dir, f"{name}s_sorted.npy"), arr[order])
+    np.save(os.path.join(out_dir, f"{name}s_sorted_idx.npy"), order.astype(np.int64))
+
+
+def _save_artifacts(cfg: TrainConfig, maps: Mappings, model: BPRMF, splits: Splits, ease_B: Optional[np.ndarray],
+                    events: Optional[pd.DataFrame] = None):
     out_dir = "Models"
     _ensure_dir(out_dir)
 
@@ -446,182 +1347,355 @@ def _save_artifacts(cfg: TrainConfig, maps: Mappings, model: BPRMF, splits: Spli
     }
     torch.save(ckpt, os.path.join(out_dir, "lightgcn.pt"))
 
+    _save_code_index(out_dir, "user", maps.idx2user)
+    _save_code_index(out_dir, "item", maps.idx2item)
+    np.save(os.path.join(out_dir, "user_emb.npy"), model.user_emb.weight.detach().cpu().numpy().astype(np.float32))
+    np.save(os.path.join(out_dir, "item_emb.npy"), model.item_emb.weight.detach().cpu().numpy().astype(np.float32))
+
+    dense_path = os.path.join(out_dir, "ease_B.npy")
+    csr_paths = [os.path.join(out_dir, f"ease_B.{part}.npy") for part in _CSR_PARTS]
+    # удаляем артефакты другого формата, чтобы при загрузке не подхватить устаревшую модель
+    for stale in [dense_path, os.path.join(out_dir, "ease_B.npz")] + csr_paths:
+        if os.path.isfile(stale):
+            os.remove(stale)
+
+    ease_kind = None
     if ease_B is not None:
-        np.save(os.path.join(out_dir, "ease_B.npy"), ease_B)
+        if sp is not None and sp.issparse(ease_B):
+            C = ease_B.tocsr()
+            C.sort_indices()
+            for part, path in zip(_CSR_PARTS, csr_paths):
+                np.save(path, getattr(C, part))
+            ease_kind = "csr"
+        else:
+            np.save(dense_path, np.ascontiguousarray(ease_B))
+            ease_kind = "dense"
+
+    ann_meta = None
+    for stale in ("centroids", "indptr", "items"):
+        path = os.path.join(out_dir, f"ann_ivf.{stale}.npy")
+        if os.path.isfile(path):
+            os.remove(path)
+    if cfg.ann_enabled:
+        ann_meta = _save_ann_index(
+            out_dir,
+            cfg,
+            model.user_emb.weight.detach().cpu().numpy().astype(np.float32),
+            model.item_emb.weight.detach().cpu().numpy().astype(np.float32),
+        )
 
+    profile_sources, profile_versions = {}, []
+    if events is not None:
+        _save_profile_index(out_dir, events, len(maps.idx2user), len(maps.idx2item))
+        profile_sources = _file_stamps(_profile_source_paths(cfg.data_dir))
+        profile_versions = _source_versions(_profile_source_paths(cfg.data_dir))
 
-def _load_artifacts():
-    out_dir = "Models"
+    meta = {
+        "format": ARTIFACTS_FORMAT,
+        "num_users": len(maps.idx2user),
+        "num_items": len(maps.idx2item),
+        "embedding_dim": int(cfg.embedding_dim),
+        "ease": ease_kind,
+        "profile_sources": profile_sources,
+        "profile_versions": profile_versions,
+        "ann": ann_meta,
+        "config": cfg.__dict__,
+    }
+    with open(os.path.join(out_dir, "artifacts.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+# Загрузка прежнего формата (mappings.json + lightgcn.pt + ease_B.npy/.npz) целиком в память.
+def _load_legacy_artifacts(out_dir: str) -> ModelArtifacts:
     mappings_path = os.path.join(out_dir, "mappings.json")
     ckpt_path = os.path.join(out_dir, "lightgcn.pt")
-    ease_path = os.path.join(out_dir, "ease_B.npy")
-
     if not (os.path.isfile(mappings_path) and os.path.isfile(ckpt_path)):
         raise FileNotFoundError("Models not found. Train first (press the train button).")
 
     with open(mappings_path, "r", encoding="utf-8") as f:
         maps = json.load(f)
-
     ckpt = torch.load(ckpt_path, map_location="cpu")
-    ease_B = np.load(ease_path) if os.path.isfile(ease_path) else None
-    return maps, ckpt, ease_B
+    state = ckpt["state_dict"]
+
+    ease_B = None
+    ease_path = os.path.join(out_dir, "ease_B.npy")
+    ease_sparse_path = os.path.join(out_dir, "ease_B.npz")
+    if os.path.isfile(ease_path):
+        ease_B = np.load(ease_path, mmap_mode="r")
+    elif os.path.isfile(ease_sparse_path) and sp is not None:
+        C = sp.load_npz(ease_sparse_path).tocsr()
+        ease_B = SparseRows(C.data, C.indices, C.indptr, C.shape)
+
+    users = np.asarray(maps["idx2user"], dtype=str)
+    items = np.asarray(maps["idx2item"], dtype=str)
+    u_ord = np.argsort(users, kind="stable")
+    i_ord = np.argsort(items, kind="stable")
+    return ModelArtifacts(
+        meta={"format": 1, "num_users": len(users), "num_items": len(items)},
+        idx2user=users,
+        idx2item=items,
+        users_sorted=users[u_ord],
+        users_sorted_idx=u_ord,
+        items_sorted=items[i_ord],
+        items_sorted_idx=i_ord,
+        user_emb=state["user_emb.weight"].numpy(),
+        item_emb=state["item_emb.weight"].numpy(),
+        ease_B=ease_B,
+    )
+
+
+def _load_artifacts(out_dir: str = "Models") -> ModelArtifacts:
+    if not os.path.isfile(os.path.join(out_dir, "artifacts.json")):
+        return _load_legacy_artifacts(out_dir)
+    return load_artifacts(out_dir)
 
 
 # ----------------------------- Recommendation (console) -----------------------------
 
-def _load_item_names(data_dir: str, idx2item: List[str]) -> Dict[str, str]:
+def print_recommendations(mindbox_id: str, k: int = 20, use: str = "ease") -> None:
     """
-    Returns mapping item_code -> name (if nomenclature file exists).
+    Prints top-K recommendations to console using saved artifacts.
+    use: "ease" | "bprmf"
+    Scoring lives in Inference.py (NumPy only); this wrapper also accepts legacy model folders.
     """
-    nom_path = os.path.join(data_dir, "Номенклатура.csv")
-    if not os.path.isfile(nom_path):
-        return {}
-    try:
-        nom = _read_csv_pipe(nom_path)
-    except Exception:
-        return {}
-
-    if "КодНоменклатуры" not in nom.columns:
-        return {}
-    name_col = "НазваниеНаСайте" if "НазваниеНаСайте" in nom.columns else None
-    if name_col is None:
-        return {}
+    _print_recommendations(mindbox_id, k=k, use=use, arts=_load_artifacts())
 
-    sub = nom[["КодНоменклатуры", name_col]].dropna()
-    sub["КодНоменклатуры"] = sub["КодНоменклатуры"].astype(str)
-    sub[name_col] = sub[name_col].astype(str)
-    return dict(zip(sub["КодНоменклатуры"].tolist(), sub[name_col].tolist()))
 
+# ----------------------------- Precomputed top-K -----------------------------
 
-def _user_profile_from_processed(data_dir: str, mindbox_id: str, idx2item: List[str], item2idx: Dict[str, int], cfg: TrainConfig) -> Tuple[np.ndarray, np.ndarray]:
+def _materialize_topk(cfg: TrainConfig, out_dir: str = "Models") -> None:
     """
-    Build a single-user sparse profile (indices + weights) from processed CSVs.
-    Used for EASE inference and for filtering 'seen' items.
+    Post-training stage: top-K items and scores for every known user and every saved model,
+    stored as int32 items / float16 scores with per-user offsets (empty rows for users EASE cannot score).
+    Masked (already seen) items are not stored, so a row can be shorter than K; scores are clipped to the float16 range.
     """
-    orders_path = _pick_file(data_dir, "Заказы", True)
-    views_path = _pick_file(data_dir, "Просмотры", True)
-    fav_path = _pick_file(data_dir, "Избранное", True)
-
-    # fallback to originals if selection not found
-    if not os.path.isfile(orders_path):
-        orders_path = _pick_file(data_dir, "Заказы", False)
-    if not os.path.isfile(views_path):
-        views_path = _pick_file(data_dir, "Просмотры", False)
-    if not os.path.isfile(fav_path):
-        fav_path = _pick_file(data_dir, "Избранное", False)
-
-    weights = {}
-
-    if os.path.isfile(orders_path):
-        o = _read_csv_pipe(orders_path)
-        if {"MindboxID", "КодНоменклатуры"}.issubset(o.columns):
-            oo = o[o["MindboxID"].astype(str) == str(mindbox_id)]
-            if len(oo):
-                qty = pd.to_numeric(oo.get("Количество", 1), errors="coerce").fillna(1).astype(float).clip(1, 10)
-                for code, q in zip(oo["КодНоменклатуры"].astype(str).tolist(), qty.tolist()):
-                    if code in item2idx:
-                        weights[item2idx[code]] = weights.get(item2idx[code], 0.0) + cfg.w_purchase * float(q)
-
-    if os.path.isfile(fav_path):
-        f = _read_csv_pipe(fav_path)
-        if {"MindboxID", "КодНоменклатуры"}.issubset(f.columns):
-            ff = f[f["MindboxID"].astype(str) == str(mindbox_id)]
-            for code in ff.get("КодНоменклатуры", pd.Series(dtype=str)).dropna().astype(str).tolist():
-                if code in item2idx:
-                    weights[item2idx[code]] = weights.get(item2idx[code], 0.0) + cfg.w_favorite
-
-    if os.path.isfile(views_path):
-        v = _read_csv_pipe(views_path)
-        if {"MindboxID", "КодНоменклатуры", "ТипТовара"}.issubset(v.columns):
-            vv = v[(v["MindboxID"].astype(str) == str(mindbox_id)) & (v["ТипТовара"] == "Номенклатура")]
-            for code in vv.get("КодНоменклатуры", pd.Series(dtype=str)).dropna().astype(str).tolist():
-                if code in item2idx:
-                    weights[item2idx[code]] = weights.get(item2idx[code], 0.0) + cfg.w_view_item
-
-    if not weights:
-        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
-
-    idx = np.fromiter(weights.keys(), dtype=np.int64)
-    val = np.fromiter(weights.values(), dtype=np.float32)
-    return idx, val
+    K = int(cfg.precompute_topk)
+    arts = _load_artifacts(out_dir)
+    K = min(K, arts.num_items)
+    X = _profile_matrix(arts, cfg)
+    users = np.arange(arts.num_users, dtype=np.int64)
+    block = max(1, int(cfg.precompute_block))
+
+    built = {}
+    for use in ("ease", "bprmf"):
+        if use == "ease" and arts.ease_B is None:
+            continue
+        if use == "bprmf" and (arts.user_emb is None or arts.item_emb is None):
+            continue
+        B = _ease_matrix(arts.ease_B) if use == "ease" else None
+        lens = np.full(arts.num_users, K, dtype=np.int64)
+        if use == "ease":
+            lens[np.diff(X.indptr) == 0] = 0
+
+        items_l, scores_l = [], []
+        f16 = float(np.finfo(np.float16).max)
+        for start in range(0, len(users), block):
+            ub = users[start:start + block]
+            top, top_scores = _score_block(ub, X, use, arts, B, K)
+            # замаскированные (-1e9) стоят в конце строки; во float16 они стали бы -inf
+            lens[ub] = np.minimum(lens[ub], (top_scores > -1e9).sum(axis=1))
+            keep = np.arange(K)[None, :] < lens[ub][:, None]
+            items_l.append(top[keep].astype(np.int32))
+            scores_l.append(np.clip(top_scores[keep], -f16, f16).astype(np.float16))
+
+        offsets = np.zeros(arts.num_users + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        for part, arr in zip(_CSR_PARTS, (np.concatenate(scores_l), np.concatenate(items_l), offsets)):
+            np.save(os.path.join(out_dir, f"topk_{use}.{part}.npy"), arr)
+        built[use] = K
+        print(f"[{_now()}] Top-{K} table ({use}): {int((lens > 0).sum()):,} users, "
+              f"{(offsets[-1] * 6 + offsets.nbytes) / 2**20:.1f} MB")
+
+    meta_path = os.path.join(out_dir, "artifacts.json")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["topk"] = built
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+# ----------------------------- Batch scoring -----------------------------
+
+# Матрица профилей всех известных пользователей (U x I, CSR): из сохранённого индекса плюс события, дозаписанные
+# после обучения (Inference._profile_changes), иначе одним проходом по обработанным файлам.
+def _profile_matrix(arts: ModelArtifacts, cfg: TrainConfig) -> "sp.csr_matrix":
+    shape = (arts.num_users, arts.num_items)
+    changes = _profile_changes(arts, cfg.data_dir, cfg) if arts.profile is not None else None
+    if changes is not None:
+        p = arts.profile
+        X = sp.csr_matrix((np.asarray(p.data), np.asarray(p.indices), np.asarray(p.indptr)), shape=shape)
+        if not changes:
+            return X
+        users = list(changes)
+        lens = np.array([len(changes[u][0]) for u in users], dtype=np.int64)
+        u = np.repeat(_lookup_sorted(arts.users_sorted, arts.users_sorted_idx, users), lens)
+        i = arts.item_indices([c for codes, _ in changes.values() for c in codes])
+        v = np.fromiter((w for _, weights in changes.values() for w in weights), dtype=np.float64, count=int(lens.sum()))
+        ok = (u >= 0) & (i >= 0)
+        D = sp.csr_matrix((v[ok], (u[ok], i[ok])), shape=shape)
+        return (X + D).astype(np.float32).tocsr()
+
+    orders_path, views_path, fav_path = _profile_source_paths(cfg.data_dir)
+    empty = pd.DataFrame()
+    orders = _read_csv_pipe(orders_path, _EVENT_COLUMNS) if os.path.isfile(orders_path) else empty
+    views = _read_csv_pipe(views_path, _EVENT_COLUMNS) if os.path.isfile(views_path) else empty
+    fav = _read_csv_pipe(fav_path, _EVENT_COLUMNS) if os.path.isfile(fav_path) else empty
+
+    if {"ТипТовара"}.issubset(views.columns):
+        views = views[views["ТипТовара"] == "Номенклатура"]
+    else:
+        views = empty
+
+    rows, cols, vals = [], [], []
+    for df, w in ((orders, None), (fav, cfg.w_favorite), (views, cfg.w_view_item)):
+        if not len(df) or not {"MindboxID", "КодНоменклатуры"}.issubset(df.columns):
+            continue
+        df = df.dropna(subset=["MindboxID", "КодНоменклатуры"])
+        u = _lookup_sorted(arts.users_sorted, arts.users_sorted_idx, df["MindboxID"].astype(str))
+        i = arts.item_indices(df["КодНоменклатуры"].astype(str))
+        if w is None:
+            qty = pd.to_numeric(df.get("Количество", 1), errors="coerce").fillna(1).astype(float).clip(1, 10)
+            v = cfg.w_purchase * np.asarray(qty, dtype=np.float64)
+        else:
+            v = np.full(len(df), w, dtype=np.float64)
+        ok = (u >= 0) & (i >= 0)
+        rows.append(u[ok])
+        cols.append(i[ok])
+        vals.append(v[ok])
+
+    if not rows:
+        return sp.csr_matrix(shape, dtype=np.float32)
+    X = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+    X.sum_duplicates()
+    return X.astype(np.float32)
+
+
+def _ease_matrix(B):
+    if isinstance(B, SparseRows):
+        return sp.csr_matrix((np.asarray(B.data), np.asarray(B.indices), np.asarray(B.indptr)), shape=B.shape)
+    return B
 
 
-def print_recommendations(mindbox_id: str, k: int = 20, use: str = "ease") -> None:
+# Top-k для блока пользователей одной матричной операцией; просмотренные маскируются одним scatter.
+def _score_block(users: np.ndarray, X: "sp.csr_matrix", use: str, arts: ModelArtifacts, B, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    Xb = X[users]
+    if use == "ease":
+        scores = Xb @ B
+        scores = scores.toarray() if sp.issparse(scores) else np.asarray(scores)
+    else:
+        scores = np.asarray(arts.user_emb[users]) @ np.asarray(arts.item_emb).T
+    scores = np.asarray(scores, dtype=np.float32)
+
+    coo = Xb.tocoo()
+    scores[coo.row, coo.col] = -1e9
+    top = _topk_rows(scores, k)
+    return top, np.take_along_axis(scores, top, axis=1)
+
+
+def recommend_batch(ids: Optional[List[str]], out_path: str, k: int = 20, use: str = "ease",
+                    workers: int = 4, block: int = 2048) -> None:
     """
-    Prints top-K recommendations to console using saved artifacts.
-    use: "ease" | "bprmf"
+    Scores many users in blocks and streams long-format results
+    (MindboxID, rank, КодНоменклатуры, score) to CSV (`|`-separated, utf-8-sig) or Parquet.
+    ids=None scores every user known to the model.
     """
-    cfg = TrainConfig()  # for profile weights + paths
-    maps_json, ckpt, ease_B = _load_artifacts()
-
-    idx2user = maps_json["idx2user"]
-    idx2item = maps_json["idx2item"]
-    item2idx = {code: i for i, code in enumerate(idx2item)}
+    from concurrent.futures import ThreadPoolExecutor
 
-    names = _load_item_names(cfg.data_dir, idx2item)
+    if sp is None:
+        raise RuntimeError("scipy is not installed")
+    if int(k) < 1:
+        raise ValueError("k must be a positive integer")
 
-    # Build user seen profile for filtering (and for EASE scoring)
-    seen_idx, seen_w = _user_profile_from_processed(cfg.data_dir, str(mindbox_id), idx2item, item2idx, cfg)
+    cfg = TrainConfig()
+    use = use.lower()
+    t0 = time.perf_counter()
+    arts = _load_artifacts()
 
-    if use.lower() == "ease":
-        if ease_B is None:
-            print(f"[{_now()}] EASE model not found (Models/ease_B.npy). Use use='bprmf' or retrain.")
-            return
-        if len(seen_idx) == 0:
-            print(f"[{_now()}] User {mindbox_id}: no history in processed files. Cannot score with EASE.")
-            return
+    if use == "ease" and arts.ease_B is None:
+        print(f"[{_now()}] EASE model not found (Models/ease_B*.npy). Use --model bprmf or retrain.")
+        return
+    if use != "ease" and (arts.user_emb is None or arts.item_emb is None):
+        print(f"[{_now()}] BPR-MF embeddings not found (Models/user_emb.npy, item_emb.npy). Retrain.")
+        return
 
-        # score = w @ B[seen, :]
-        B_sub = ease_B[seen_idx]                       # [m, n_items]
-        scores = (seen_w.astype(np.float32) @ B_sub)   # [n_items]
-        scores = np.asarray(scores).ravel()
+    if ids is None:
+        users = np.arange(arts.num_users, dtype=np.int64)
+    else:
+        found = _lookup_sorted(arts.users_sorted, arts.users_sorted_idx, ids)
+        unknown = int((found < 0).sum())
+        if unknown:
+            print(f"[{_now()}] {unknown:,} of {len(ids):,} MindboxIDs are unknown to the model and are skipped.")
+        users = found[found >= 0]
+
+    X = _profile_matrix(arts, cfg)
+    B = _ease_matrix(arts.ease_B) if use == "ease" else None
+    if use == "ease":
+        # EASE не может оценить пользователей без истории
+        users = users[np.diff(X.indptr)[users] > 0]
+
+    k = min(int(k), arts.num_items)
+    blocks = [users[start:start + block] for start in range(0, len(users), max(1, int(block)))]
+    print(f"[{_now()}] Batch scoring: users={len(users):,} model={use} k={k} blocks={len(blocks)} workers={workers}")
+
+    is_parquet = out_path.lower().endswith(".parquet")
+    writer = None
+    if is_parquet:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    elif os.path.isfile(out_path):
+        os.remove(out_path)
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as ex:
+        results = ex.map(lambda ub: (ub, _score_block(ub, X, use, arts, B, k)), blocks)
+        for ub, (top, top_scores) in results:
+            frame = pd.DataFrame({
+                "MindboxID": np.repeat(np.asarray(arts.idx2user[ub]).astype(str), top.shape[1]),
+                "rank": np.tile(np.arange(1, top.shape[1] + 1, dtype=np.int32), len(ub)),
+                "КодНоменклатуры": np.asarray(arts.idx2item)[top.ravel()].astype(str),
+                "score": top_scores.ravel(),
+            })
+            if is_parquet:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(out_path, table.schema)
+                writer.write_table(table)
+            else:
+                frame.to_csv(out_path, sep="|", index=False, mode="a", header=written == 0,
+                             encoding="utf-8-sig" if written == 0 else "utf-8")
+            written += len(ub)
+
+    if written == 0:
+        # Ни один пользователь не подошёл — пустой файл с колонками, чтобы не осталось прежнего результата
+        frame = pd.DataFrame({
+            "MindboxID": pd.Series(dtype=str),
+            "rank": pd.Series(dtype=np.int32),
+            "КодНоменклатуры": pd.Series(dtype=str),
+            "score": pd.Series(dtype=np.float32),
+        })
+        if is_parquet:
+            frame.to_parquet(out_path, index=False, engine="pyarrow")
+        else:
+            frame.to_csv(out_path, sep="|", index=False, encoding="utf-8-sig")
+    if writer is not None:
+        writer.close()
+    print(f"[{_now()}] Batch done: {written:,} users -> {out_path} in {time.perf_counter() - t0:.1f} s")
 
-        # filter seen
-        scores[seen_idx] = -1e9
 
-        top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
-        top = top[np.argsort(-scores[top])]
+# Список MindboxID из файла: по одному в строке или CSV с колонкой MindboxID.
+def _read_id_list(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8-sig") as f:
+        lines = [ln.strip() for ln in f if ln.strip()]
+    if lines and "MindboxID" in lines[0].split("|"):
+        return _read_csv_pipe(path, {"MindboxID": str})["MindboxID"].dropna().astype(str).tolist()
+    return lines
 
-        print(f"[{_now()}] Recommendations (EASE) for MindboxID={mindbox_id} top{k}:")
-        for rank, ii in enumerate(top, start=1):
-            code = idx2item[int(ii)]
-            nm = names.get(code, "")
-            if nm:
-                print(f"{rank:02d}. {code} | {nm} | score={scores[int(ii)]:.4f}")
-            else:
-                print(f"{rank:02d}. {code} | score={scores[int(ii)]:.4f}")
 
-    else:
-        # BPR-MF
-        num_users = int(ckpt["num_users"])
-        num_items = int(ckpt["num_items"])
-        model = BPRMF(num_users, num_items, int(ckpt["config"]["embedding_dim"]))
-        model.load_state_dict(ckpt["state_dict"])
-        model.eval()
+# ----------------------------- Recommendation server -----------------------------
 
-        # Map mindbox -> idx
-        user2idx = {u: i for i, u in enumerate(idx2user)}
-        if str(mindbox_id) not in user2idx:
-            print(f"[{_now()}] User {mindbox_id} not found in mappings.json.")
-            return
-        u_idx = user2idx[str(mindbox_id)]
-
-        u = model.user_emb.weight[u_idx]                 # [d]
-        scores = (u @ model.item_emb.weight.t()).numpy() # [n_items]
-        if len(seen_idx):
-            scores[seen_idx] = -1e9
-
-        top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
-        top = top[np.argsort(-scores[top])]
-
-        print(f"[{_now()}] Recommendations (BPR-MF) for MindboxID={mindbox_id} top{k}:")
-        for rank, ii in enumerate(top, start=1):
-            code = idx2item[int(ii)]
-            nm = names.get(code, "")
-            if nm:
-                print(f"{rank:02d}. {code} | {nm} | score={scores[int(ii)]:.4f}")
-            else:
-                print(f"{rank:02d}. {code} | score={scores[int(ii)]:.4f}")
+def serve_recommendations(host: str = "127.0.0.1", port: int = 8765) -> None:
+    """Local HTTP recommendation server (see Inference.serve_recommendations)."""
+    _serve_recommendations(host=host, port=port, arts=_load_artifacts())
 
 
 # ----------------------------- Training entry point (UI button) -----------------------------
@@ -644,60 +1718,43 @@ def _train_in_this_process() -> None:
         print("Сначала загрузите/обработайте датасеты во вкладке 'Обработка датасета'.")
         return
 
-    orders = _read_csv_pipe(orders_path)
-    views = _read_csv_pipe(views_path)
-    fav = _read_csv_pipe(fav_path)
-
-    print(f"[{_now()}] Loaded:")
-    print(f"  - Orders:     {len(orders):,} rows  ({os.path.basename(orders_path)})")
-    print(f"  - Views:      {len(views):,} rows  ({os.path.basename(views_path)})")
-    print(f"  - Favorites:  {len(fav):,} rows    ({os.path.basename(fav_path)})")
-
-    maps = _build_mappings(orders, views, fav)
-    num_users = len(maps.idx2user)
-    num_items = len(maps.idx2item)
-    print(f"[{_now()}] Universe sizes: users={num_users:,} items={num_items:,}")
-
-    events = _collect_user_item_events(orders, views, fav, maps, cfg)
-    if len(events) == 0:
+    dataset = _prepare_dataset(cfg, orders_path, views_path, fav_path)
+    if dataset is None:
         print(f"[{_now()}] ERROR: no user-item events found.")
         return
+    maps, events, splits = dataset
+    num_users = len(maps.idx2user)
+    num_items = len(maps.idx2item)
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[{_now()}] Device: {device}")
 
-    model, splits = train_bprmf(maps, events, cfg, device)
+    model, splits = train_bprmf(maps, events, cfg, device, splits=splits)
 
     print(f"[{_now()}] Saving artifacts to ./Models/ ...")
     ease_B = None
     try:
-        B, r, n = train_ease_r(splits, num_users, num_items, cfg)
+        # Справочник нужен только для разбиения по категориям
+        item_groups = None
+        if cfg.ease_partition in ("auto", "category") and _ease_partitioned(cfg, num_items):
+            item_groups = _item_groups_from_nomenclature(data_dir, maps.idx2item)
+        B, metrics = train_ease_r(splits, num_users, num_items, cfg, item_groups=item_groups)
         ease_B = B
-        print(f"[{_now()}] EASE^R: recall@{cfg.topk}={r:.4f} ndcg@{cfg.topk}={n:.4f}")
+        print(f"[{_now()}] EASE^R: recall@{cfg.topk}={metrics[f'recall@{cfg.topk}']:.4f} "
+              f"ndcg@{cfg.topk}={metrics[f'ndcg@{cfg.topk}']:.4f}")
+        print("  " + "  ".join(f"{key}={val:.4f}" for key, val in metrics.items()))
     except Exception as e:
         print(f"[{_now()}] EASE^R failed (non-fatal): {repr(e)}")
 
-    _save_artifacts(cfg, maps, model, splits, ease_B)
+    _save_artifacts(cfg, maps, model, splits, ease_B, events=events)
+    if cfg.precompute_topk > 0:
+        try:
+            _materialize_topk(cfg)
+        except Exception as e:
+            print(f"[{_now()}] Top-K table failed (non-fatal): {repr(e)}")
     print(f"[{_now()}] Done. Exiting training process.")
 
 
-def train_recommender(*_args, **_kwargs) -> None:
-    """
-    Called by your PyQt button.
-
-    Runs training in a subprocess to avoid Windows native shutdown crashes.
-    """
-    py = sys.executable
-    script = os.path.abspath(__file__)
-    cmd = [py, script, "--train"]
-    print(f"[{_now()}] Starting training in subprocess:")
-    print(" ", " ".join(cmd))
-    try:
-        subprocess.Popen(cmd, cwd=os.getcwd())
-    except Exception as e:
-        print(f"[{_now()}] Failed to start subprocess: {repr(e)}")
-
-
 # ----------------------------- CLI -----------------------------
 
 def _parse_cli(argv: List[str]) -> Tuple[bool, Optional[str], int, str]:
@@ -732,5 +1789,30 @@ if __name__ == "__main__":
         # hard-exit helps avoid rare native crashes during Python shutdown on Windows
         os._exit(0)
 
-    if mindbox is not None:
+    argv = sys.argv[1:]
+    if "--recommend-batch" in argv or "--all-users" in argv:
+        ids_path = _cli_value(argv, "--recommend-batch")
+        missing_ids = (ids_path is None or ids_path.startswith("--")) and "--all-users" not in argv
+        if missing_ids or k < 1:
+            if k < 1:
+                print("k must be a positive integer")
+            print("Usage:")
+            print("  python LightFM.py --recommend-batch <ids.txt|ids.csv> [--out recommendations.csv] [--k 20] "
+                  "[--model ease|bprmf] [--workers 4] [--block 2048]")
+            print("  python LightFM.py --all-users [--out recommendations.parquet] [--k 20] [--model ease|bprmf]")
+            sys.exit(2)
+        recommend_batch(
+            None if "--all-users" in argv else _read_id_list(ids_path),
+            out_path=_cli_value(argv, "--out", "recommendations.csv"),
+            k=k,
+            use=model,
+            workers=int(_cli_value(argv, "--workers", "4")),
+            block=int(_cli_value(argv, "--block", "2048")),
+        )
+    elif "--serve" in sys.argv[1:]:
+        serve_recommendations(
+            host=_cli_value(sys.argv[1:], "--host", "127.0.0.1"),
+            port=int(_cli_value(sys.argv[1:], "--port", "8765")),
+        )
+    elif mindbox is not None:
         print_recommendations(mindbox, k=k, use=model)
@@ -0,0 +1,25 @@
+import os
+import sys
+import time
+import subprocess
+
+# Запуск обучения (LightFM.py --train) в отдельном процессе — так обходятся аварийные завершения нативных
+# библиотек при выходе на Windows. Модуль не импортирует torch, scipy и pandas: его подключает интерфейс
+# (кнопка "Начать обучение"), а LightFM.train_recommender — та же функция.
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "LightFM.py")
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Запускает обучение в отдельном процессе (текущая папка — рабочая папка процесса); аргументы слота Qt игнорируются
+def train_recommender(*_args, **_kwargs) -> None:
+    cmd = [sys.executable, TRAIN_SCRIPT, "--train"]
+    print(f"[{_now()}] Starting training in subprocess:")
+    print(" ", " ".join(cmd))
+    try:
+        subprocess.Popen(cmd, cwd=os.getcwd())
+    except Exception as e:
+        print(f"[{_now()}] Failed to start subprocess: {repr(e)}")
@@ -1,10 +1,16 @@
 import os
 import sys
-import chardet
-import numpy as np
-import pandas as pd
+import time
+import importlib
+
+# Момент запуска процесса: от него считается время до первого окна
+_STARTUP_T0 = time.perf_counter()
+
 from SwitchTheme import ThemeSwitch
-from LightFM import train_recommender
+import Catalogue as catalogue
+from TrainLauncher import train_recommender
+from DataStore import (DatasetWriter, ImportIndex, add_segment, append_dataset, compact_in_background, dataset_path,
+                       dataset_stem, new_segment_path, read_dataset, target_path, write_dataset)
 from PyQt6.QtCore import Qt, QTimer, QSize
 from PyQt6.QtGui import QIcon, QPixmap, QPalette, QColor
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
@@ -13,6 +19,51 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QH
                              QFileDialog, QFrame, QFormLayout, QAbstractSpinBox, QGridLayout, QSizePolicy)
 
 
+# Ленивый модуль: настоящий импорт выполняется при первом обращении к атрибуту
+class _LazyModule:
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# numpy/pandas/chardet нужны только обработчикам CSV и анализу — окно открывается без них
+chardet = _LazyModule("chardet")
+np = _LazyModule("numpy")
+pd = _LazyModule("pandas")
+cleaning = _LazyModule("DataCleaning")
+
+# Тяжёлые модули, попадание которых в процесс интерфейса показывает отчёт о запуске
+_HEAVY_MODULES = ("torch", "scipy", "pandas", "numpy", "chardet", "LightFM")
+
+# Потоковая загрузка: выгрузки Mindbox от этого размера читаются и обрабатываются кусками по _STREAM_CHUNK_ROWS строк,
+# так что память зависит от размера куска, а не файла (порог в МБ можно задать через RS_STREAM_MIN_MB)
+_STREAM_MIN_BYTES = int(os.environ.get("RS_STREAM_MIN_MB", "256")) * (1 << 20)
+_STREAM_CHUNK_ROWS = 200_000
+
+# Кодировка определяется по выборке из начала, середины и конца файла такого размера каждая
+_ENCODING_SAMPLE_BYTES = 256 * 1024
+
+# Возрастные группы в порядке возрастания; список общий для всех кусков потоковой загрузки,
+# поэтому категории колонки "ВозрастнаяГруппа" совпадают во всех частях датасета
+_AGE_GROUPS = ["до 14", "14-25", "26-35", "36-45", "46-55", "56-65", "65+", "Не указан"]
+
+
+# Отчёт о запуске: время до первого окна и какие тяжёлые модули уже загружены
+def _report_startup(quit_after: bool = False) -> None:
+    elapsed_ms = (time.perf_counter() - _STARTUP_T0) * 1000.0
+    loaded = [name for name in _HEAVY_MODULES if name in sys.modules]
+    mode = "eager" if "--eager-imports" in sys.argv else "lazy"
+    print(f"[startup] импорт={mode} первое окно через {elapsed_ms:.0f} мс; "
+          f"загружены: {', '.join(loaded) if loaded else 'нет'}")
+    if quit_after:
+        QApplication.quit()
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self):
@@ -728,87 +779,185 @@ class MainWindow(QMainWindow):
             os.makedirs(input_dir, exist_ok=True)
 
             # --- helpers (локально, чтобы не засорять класс лишними методами) ---
+            # Формат файла (parquet/csv) выбирает DataStore; CSV для внешних программ — python DataStore.py --export-csv
             def _save(df: pd.DataFrame, save_path: str) -> None:
-                df.to_csv(save_path, index=False, sep="|", encoding="utf-8-sig")
+                write_dataset(df, save_path)
 
-            def _append_or_overwrite(df: pd.DataFrame, save_path: str) -> None:
+            # True — данные дописаны к существующему датасету, False — датасет перезаписан
+            def _append_or_overwrite(df: pd.DataFrame, save_path: str) -> bool:
                 if mode == "Добавить новый / Обновить существующий":
                     _save(df, save_path)
+                    return False
+
+                # mode == "Добавить данные к существующему": новый сегмент, прежние данные не читаются
+                try:
+                    append_dataset(df, input_dir, dataset_stem(save_path))
+                    return True
+                except Exception:
+                    # Если манифест поврежден — просто перезапишем
+                    _save(df, save_path)
+                    return False
+
+            # После дозаписи сегменты датасета сливаются в фоне, когда их накопилось COMPACT_MIN_SEGMENTS
+            def _compact_later(stems: list) -> None:
+                if mode == "Добавить данные к существующему":
+                    for stem in stems:
+                        compact_in_background(input_dir, stem)
+
+            # Убирает из пары обработанных таблиц строки, уже загруженные раньше (отбор — подмножество строк полной)
+            def _drop_repeats(index: ImportIndex, df_full: pd.DataFrame, df_selection: pd.DataFrame):
+                keep = pd.Series(index.fresh(df_full), index=df_full.index)
+                return df_full[keep.to_numpy()], df_selection[keep.loc[df_selection.index].to_numpy()]
+
+            # Большой файл: каждый кусок проходит тот же processor_fn и сразу дописывается в выходные файлы.
+            # Сортировка по дате внутри processor_fn при этом действует в пределах куска.
+            def _stream_pair(reader_sep: str, processor_fn, save_paths: list, index: ImportIndex) -> None:
+                chunks = self.read_csv_auto_encoding(file_path=file_path, sep=reader_sep, chunksize=_STREAM_CHUNK_ROWS)
+                if chunks is None:
                     return
 
-                # mode == "Добавить данные к существующему"
-                if os.path.exists(save_path):
-                    try:
-                        df_old = pd.read_csv(save_path, sep="|", encoding="utf-8-sig")
-                        df = pd.concat([df_old, df], ignore_index=True)
-                    except Exception:
-                        # Если файл поврежден/кодировка/структура — просто перезапишем
-                        pass
-                _save(df, save_path)
-
+                # В режиме дозаписи каждый выходной файл — новый сегмент датасета (stem), иначе stem = None
+                writers, stems = [], []
+                for save_path in save_paths:
+                    stem = None
+                    if mode == "Добавить данные к существующему":
+                        try:
+                            stem = dataset_stem(save_path)
+                            save_path = new_segment_path(input_dir, stem)
+                        except Exception:
+                            # Если манифест поврежден — просто перезапишем
+                            stem = None
+                    writers.append(DatasetWriter(save_path))
+                    stems.append(stem)
+
+                try:
+                    for chunk in chunks:
+                        parts = processor_fn(chunk)
+                        if any(part is None for part in parts):
+                            for writer in writers:
+                                writer.abort()
+                            return
+                        parts = _drop_repeats(index, *parts)
+                        for writer, part in zip(writers, parts):
+                            writer.write(part)
+                        self.status_label.setText(f"Обработка данных... {writers[0].rows:,} строк")
+                        QApplication.processEvents()
+                    for writer, stem in zip(writers, stems):
+                        rows = writer.close()
+                        if stem is not None:
+                            add_segment(input_dir, stem, writer.path, rows)
+                    index.commit(replace=stems[0] is None)
+                except Exception:
+                    for writer in writers:
+                        writer.abort()
+                    raise
+                finally:
+                    chunks.close()
+
+            # Возвращает число строк выгрузки, пропущенных как уже загруженные
             def _process_pair(
                 reader_sep: str,
                 processor_fn,
-                filename_full: str,
-                filename_selection: str,
-            ) -> None:
+                stem_full: str,
+                stem_selection: str,
+                key_columns: list,
+            ) -> int:
+                # Индекс загруженных строк ведётся по полному датасету пары (строки одинаковы, если совпадают
+                # key_columns); при дозаписи повторы убираются из обеих таблиц. Датасет, загруженный до появления
+                # индекса, при первой дозаписи индексируется целиком
+                if mode == "Добавить данные к существующему":
+                    self.status_label.setText("Проверка повторов...")
+                    QApplication.processEvents()
+                index = ImportIndex(input_dir, stem_full, file_path, key_columns,
+                                    append=mode == "Добавить данные к существующему")
+                self.status_label.setText("Обработка данных...")
+                if index.already_imported():
+                    self.show_custom_message(
+                        title="Внимание",
+                        text="Этот файл уже был загружен раньше — данные не изменились",
+                        image_path="Картинки/Внимание.png",
+                    )
+                    return 0
+
+                if os.path.getsize(file_path) >= _STREAM_MIN_BYTES:
+                    _stream_pair(reader_sep, processor_fn,
+                                 [target_path(input_dir, stem_full), target_path(input_dir, stem_selection)], index)
+                    _compact_later([stem_full, stem_selection])
+                    return index.rejected
+
                 df_src = self.read_csv_auto_encoding(file_path=file_path, sep=reader_sep)
+                if df_src is None:
+                    return 0
                 df_full, df_selection = processor_fn(df_src)
 
                 if df_full is None or df_selection is None:
-                    return
+                    return 0
+
+                df_full, df_selection = _drop_repeats(index, df_full, df_selection)
+                if index.append and not len(df_full):
+                    # Все строки файла уже есть в датасете: запоминаем файл, данные не меняются
+                    index.commit()
+                    return index.rejected
 
-                save_path_full = os.path.join(input_dir, filename_full)
-                save_path_selection = os.path.join(input_dir, filename_selection)
+                save_path_full = target_path(input_dir, stem_full)
+                save_path_selection = target_path(input_dir, stem_selection)
 
-                _append_or_overwrite(df_full, save_path_full)
+                appended = _append_or_overwrite(df_full, save_path_full)
                 _append_or_overwrite(df_selection, save_path_selection)
+                index.commit(replace=not appended)
+                _compact_later([stem_full, stem_selection])
+                return index.rejected
 
-            def _process_single(reader_sep: str, processor_fn, filename: str) -> None:
+            def _process_single(reader_sep: str, processor_fn, stem: str) -> None:
                 df_src = self.read_csv_auto_encoding(file_path=file_path, sep=reader_sep)
                 df_res = processor_fn(df_src)
                 if df_res is None:
                     return
-                save_path_full = os.path.join(input_dir, filename)
+                save_path_full = target_path(input_dir, stem)
                 _save(df_res, save_path_full)
 
             # --- routing по типу ---
+            rejected = 0
             if selected_type == "Заказы клиентов из Mindbox":
-                _process_pair(
+                rejected = _process_pair(
                     reader_sep=";",
                     processor_fn=self.process_orders_file,
-                    filename_full="ЗаказыОригинал.csv",
-                    filename_selection="ЗаказыОтбор.csv",
+                    stem_full="ЗаказыОригинал",
+                    stem_selection="ЗаказыОтбор",
+                    key_columns=["Дата", "НомерЗаказа", "КодНоменклатуры", "Количество", "НачальнаяЦена",
+                                 "КонечнаяСтоимость", "MindboxID"],
                 )
 
             elif selected_type == "Просмотры товаров и категорий из Mindbox":
-                _process_pair(
+                rejected = _process_pair(
                     reader_sep=";",
                     processor_fn=self.process_views_file,
-                    filename_full="ПросмотрыОригинал.csv",
-                    filename_selection="ПросмотрыОтбор.csv",
+                    stem_full="ПросмотрыОригинал",
+                    stem_selection="ПросмотрыОтбор",
+                    key_columns=["Дата", "ТипТовара", "КодНоменклатуры", "MindboxID"],
                 )
 
             elif selected_type == "Добавление товаров в избранное из Mindbox":
-                _process_pair(
+                rejected = _process_pair(
                     reader_sep=";",
                     processor_fn=self.process_favorites_file,
-                    filename_full="ИзбранноеОригинал.csv",
-                    filename_selection="ИзбранноеОтбор.csv",
+                    stem_full="ИзбранноеОригинал",
+                    stem_selection="ИзбранноеОтбор",
+                    key_columns=["Дата", "КодНоменклатуры", "MindboxID"],
                 )
 
             elif selected_type == "Номенклатура из 1С":
                 _process_single(
                     reader_sep="|",
                     processor_fn=self.process_nomenclature_file,
-                    filename="Номенклатура.csv",
+                    stem="Номенклатура",
                 )
 
             elif selected_type == "Категории сайта из 1С":
                 _process_single(
                     reader_sep="|",
                     processor_fn=self.process_categories_file,
-                    filename="КатегорииСайта.csv",
+                    stem="КатегорииСайта",
                 )
 
             else:
@@ -831,7 +980,10 @@ class MainWindow(QMainWindow):
             self.analyze_favorites_full_dataset()
             self.analyze_favorites_selection_dataset()
 
-            self.status_label.setText(" Обработка завершена")
+            if rejected:
+                self.status_label.setText(f" Обработка завершена, пропущено повторов: {rejected:,}")
+            else:
+                self.status_label.setText(" Обработка завершена")
 
         except Exception as e:
             self.show_custom_message(
@@ -842,17 +994,15 @@ class MainWindow(QMainWindow):
             self.status_label.setText(" Ошибка обработки")
 
     # -------------------------------------------АВТОМАТИЧЕСКАЯ КОДИРОВКА-----------------------------------------------
-    def read_csv_auto_encoding(self, file_path: str, sep: str):
+    # chunksize — вернуть итератор по кускам (pandas TextFileReader) вместо DataFrame целиком
+    def read_csv_auto_encoding(self, file_path: str, sep: str, chunksize: int = None):
 
         try:
             # Определяем кодировку
-            with open(file_path, "rb") as f:
-                raw = f.read()
-            detected = chardet.detect(raw)
-            encoding = detected.get("encoding", "utf-8")
+            encoding = self.detect_encoding(file_path)
 
             # Пробуем прочитать файл
-            df = pd.read_csv(file_path, sep=sep, encoding=encoding)
+            df = pd.read_csv(file_path, sep=sep, encoding=encoding, chunksize=chunksize)
             return df
 
         except Exception as e:
@@ -864,6 +1014,28 @@ class MainWindow(QMainWindow):
             self.status_label.setText(" Ошибка чтения файла")
             return None
 
+    # Кодировка по ограниченной выборке: начало файла плюс целые строки из середины и конца,
+    # поэтому многогигабайтная выгрузка не читается в память целиком
+    @staticmethod
+    def detect_encoding(file_path: str, sample_bytes: int = _ENCODING_SAMPLE_BYTES) -> str:
+        size = os.path.getsize(file_path)
+        with open(file_path, "rb") as f:
+            sample = f.read(sample_bytes)
+            for offset in (size // 2, size - sample_bytes):
+                if offset <= sample_bytes:
+                    continue
+                f.seek(offset)
+                part = f.read(sample_bytes)
+                # обрезаем до целых строк, чтобы не разрезать многобайтовый символ
+                start, end = part.find(b"\n") + 1, part.rfind(b"\n") + 1
+                if 0 < start < end:
+                    sample += b"\n" + part[start:end]
+
+        encoding = chardet.detect(sample).get("encoding") or "utf-8"
+
+        # ascii в выборке не гарантирует ascii во всём файле — читаем как utf-8 (его надмножество)
+        return "utf-8" if encoding.lower() == "ascii" else encoding
+
     # -------------------------------------------ОБРАБОТКА ЗАКАЗОВ------------------------------------------------------
     def process_orders_file(self, df):
 
@@ -915,8 +1087,7 @@ class MainWindow(QMainWindow):
         df = df.dropna(subset=["КодНоменклатурыРФ", "КодНоменклатурыКЗ"], how="all")
 
         # Объединяем номера телефонов
-        df["Телефон"] = (df["ТелефонОсновной"].combine_first(df["ЗапаснойТелефон"]).apply(
-            lambda x: str(x)[:-2] if pd.notnull(x) and str(x).endswith(".0") else str(x) if pd.notnull(x) else np.nan))
+        df["Телефон"] = cleaning.merge_phones(df["ТелефонОсновной"], df["ЗапаснойТелефон"])
         df = df.drop(columns=["ТелефонОсновной", "ЗапаснойТелефон"])
 
         # Преобразуем цены и количество в числовой формат
@@ -949,34 +1120,24 @@ class MainWindow(QMainWindow):
 
         df["ДатаРождения"] = pd.to_datetime(df["ДатаРождения"], errors='coerce')
 
-        # Рассчитываем возраст на момент заказа
-        df["Возраст"] = df.apply(
-            lambda row: row["Дата"].year - row["ДатаРождения"].year -
-                        ((row["Дата"].month, row["Дата"].day) < (row["ДатаРождения"].month, row["ДатаРождения"].day))
-            if pd.notnull(row["ДатаРождения"]) and pd.notnull(row["Дата"]) else np.nan,
-            axis=1
-        ).astype('Int64')
-
-        # Добавляем колонку с возрастной группой
-        df["ВозрастнаяГруппа"] = df["Возраст"].apply(self.get_age_group)
+        # Рассчитываем возраст на момент заказа и возрастную группу
+        self.add_age_columns(df)
 
         # В колонке Магазин заменяем значение
         df["Магазин"] = df["Магазин"].replace({"kanzler-style.ru": "ИНТЕРНЕТ-МАГАЗИН"})
 
         # Объединяем Имя, Фамилия, Отчество в ФИО
-        df["ФИО"] = df[["Фамилия", "Имя", "Отчество"]].fillna("").agg(" ".join, axis=1).str.strip()
+        df["ФИО"] = cleaning.full_name(df, ["Фамилия", "Имя", "Отчество"])
         df = df.drop(columns=["Имя", "Фамилия", "Отчество"])
 
         # В колонке Пол заменяем значения
         df["ПолКлиента"] = df["ПолКлиента"].replace({"male": "Мужской", "female": "Женский"})
 
         # Дисконтную карту приводим к строке, убираем ".0", если он был числом
-        df["ДисконтнаяКарта"] = df["ДисконтнаяКарта"].apply(
-            lambda x: str(int(x)) if pd.notnull(x) and str(x).endswith(".0") else str(x))
+        df["ДисконтнаяКарта"] = cleaning.strip_float_suffix(df["ДисконтнаяКарта"])
 
         # Дисконтную карту приводим к строке, убираем ".0", если он был числом
-        df["НомерЗаказа"] = df["НомерЗаказа"].apply(
-            lambda x: str(int(x)) if pd.notnull(x) and str(x).endswith(".0") else str(x))
+        df["НомерЗаказа"] = cleaning.strip_float_suffix(df["НомерЗаказа"])
 
         # Очистка категорий от точек и запятых
         for col in [
@@ -984,20 +1145,12 @@ class MainWindow(QMainWindow):
             "СамаяПросматриваемаяРодительскаяКатегория",
             "СамаяПросматриваемаяДочерняяКатегория"
         ]:
-            df[col] = (
-                df[col]
-                .astype(str)
-                .str.replace(r"\.0$", "", regex=True)  # убираем только .0 в конце
-                .str.replace(r"[.,]", "", regex=True)  # убираем лишние знаки, если вдруг есть
-                .str.strip()
-            )
+            df[col] = cleaning.clean_category_code(df[col])
 
         # Объединяем любимые категории в одну колонку через "_"
-        df["ЛюбимаяКатегория"] = (df[["СамаяПросматриваемаяКатегория",
-                                      "СамаяПросматриваемаяРодительскаяКатегория",
-                                      "СамаяПросматриваемаяДочерняяКатегория"]].apply(
-            lambda row: "_".join([str(x) for x in row if pd.notnull(x) and x != "nan"]),
-            axis=1))
+        df["ЛюбимаяКатегория"] = cleaning.join_present(df, ["СамаяПросматриваемаяКатегория",
+                                                           "СамаяПросматриваемаяРодительскаяКатегория",
+                                                           "СамаяПросматриваемаяДочерняяКатегория"], sep="_")
 
         # Удалим отдельные колонки категорий
         df = df.drop(columns=["СамаяПросматриваемаяКатегория",
@@ -1005,9 +1158,9 @@ class MainWindow(QMainWindow):
                               "СамаяПросматриваемаяДочерняяКатегория"])
 
         # --- Подтягиваем данные из Номенклатуры.csv ---
-        nom_path = "ВходныеДанные/Номенклатура.csv"
+        nom_df = catalogue.nomenclature("ВходныеДанные")
 
-        if not os.path.isfile(nom_path):
+        if nom_df is None:
             self.show_custom_message(
                 title="Ошибка",
                 text="Для корректной загрузки необходимо сначала загрузить файл Номенклатура.csv",
@@ -1015,9 +1168,6 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Читаем файл номенклатуры
-        nom_df = pd.read_csv(nom_path, sep="|", dtype=str)
-
         # Проверяем обязательные колонки
         required_nom_cols = ["КодНоменклатуры", "Номенклатура", "ВидНоменклатуры", "НазваниеНаСайте"]
         missing_nom = [col for col in required_nom_cols if col not in nom_df.columns]
@@ -1030,14 +1180,11 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Оставляем только нужные колонки
-        nom_df = nom_df[required_nom_cols]
-
-        # Объединяем основной df с номенклатурой
-        df = df.merge(nom_df, on="КодНоменклатуры", how="left")
+        # Объединяем основной df с номенклатурой (по индексу кода из кэша справочника)
+        df = catalogue.join(df, nom_df, on="КодНоменклатуры", columns=required_nom_cols[1:])
 
         # Заменяем все виды пустых значений на np.nan
-        df = df.replace(["", " ", "  ", "None", "none", "NULL", "null", "-", "--", "nan"], np.nan)
+        df = cleaning.blank_to_nan(df)
 
         # Упорядочиваем колонки
         column_order = [
@@ -1109,9 +1256,7 @@ class MainWindow(QMainWindow):
         df = df.drop(columns=["КодНоменклатурыРФ", "КодНоменклатурыКЗ"])
 
         # Объединяем номера телефонов
-        df["Телефон"] = (df["ТелефонОсновной"].combine_first(df["ЗапаснойТелефон"])
-        .apply(
-            lambda x: str(x)[:-2] if pd.notnull(x) and str(x).endswith(".0") else str(x) if pd.notnull(x) else np.nan))
+        df["Телефон"] = cleaning.merge_phones(df["ТелефонОсновной"], df["ЗапаснойТелефон"])
         df = df.drop(columns=["ТелефонОсновной", "ЗапаснойТелефон"])
 
         # В колонке Дата оставляем только дату (убираем время)
@@ -1119,27 +1264,18 @@ class MainWindow(QMainWindow):
 
         df["ДатаРождения"] = pd.to_datetime(df["ДатаРождения"], errors='coerce')
 
-        # Рассчитываем возраст на момент заказа
-        df["Возраст"] = df.apply(
-            lambda row: row["Дата"].year - row["ДатаРождения"].year -
-                        ((row["Дата"].month, row["Дата"].day) < (row["ДатаРождения"].month, row["ДатаРождения"].day))
-            if pd.notnull(row["ДатаРождения"]) and pd.notnull(row["Дата"]) else np.nan,
-            axis=1
-        ).astype('Int64')
-
-        # Добавляем колонку с возрастной группой
-        df["ВозрастнаяГруппа"] = df["Возраст"].apply(self.get_age_group)
+        # Рассчитываем возраст на момент заказа и возрастную группу
+        self.add_age_columns(df)
 
         # Объединяем Имя, Фамилия, Отчество в ФИО
-        df["ФИО"] = df[["Фамилия", "Имя", "Отчество"]].fillna("").agg(" ".join, axis=1).str.strip()
+        df["ФИО"] = cleaning.full_name(df, ["Фамилия", "Имя", "Отчество"])
         df = df.drop(columns=["Имя", "Фамилия", "Отчество"])
 
         # В колонке Пол заменяем значения
         df["ПолКлиента"] = df["ПолКлиента"].replace({"male": "Мужской", "female": "Женский"})
 
         # Дисконтную карту приводим к строке, убираем ".0", если он был числом
-        df["ДисконтнаяКарта"] = df["ДисконтнаяКарта"].apply(
-            lambda x: str(int(x)) if pd.notnull(x) and str(x).endswith(".0") else str(x))
+        df["ДисконтнаяКарта"] = cleaning.strip_float_suffix(df["ДисконтнаяКарта"])
 
         # Очистка категорий от точек и запятых
         for col in [
@@ -1148,19 +1284,12 @@ class MainWindow(QMainWindow):
             "СамаяПросматриваемаяРодительскаяКатегория",
             "СамаяПросматриваемаяДочерняяКатегория"
         ]:
-            df[col] = (
-                df[col]
-                .astype(str)
-                .str.replace(r"\.0$", "", regex=True)  # убираем только .0 в конце
-                .str.replace(r"[.,]", "", regex=True)  # убираем лишние знаки, если вдруг есть
-                .str.strip()
-            )
+            df[col] = cleaning.clean_category_code(df[col])
 
         # Объединяем любимые категории в одну колонку через "_"
-        df["ЛюбимаяКатегория"] = df[
-            ["СамаяПросматриваемаяКатегория", "СамаяПросматриваемаяРодительскаяКатегория",
-             "СамаяПросматриваемаяДочерняяКатегория"]
-        ].apply(lambda row: "_".join([str(x) for x in row if pd.notnull(x) and x != "nan"]), axis=1)
+        df["ЛюбимаяКатегория"] = cleaning.join_present(df, ["СамаяПросматриваемаяКатегория",
+                                                           "СамаяПросматриваемаяРодительскаяКатегория",
+                                                           "СамаяПросматриваемаяДочерняяКатегория"], sep="_")
 
         # Удалим отдельные колонки категорий
         df = df.drop(columns=["СамаяПросматриваемаяКатегория",
@@ -1168,7 +1297,7 @@ class MainWindow(QMainWindow):
                               "СамаяПросматриваемаяДочерняяКатегория"])
 
         # Заменяем все виды пустых значений на np.nan
-        df = df.replace(["", " ", "  ", "None", "none", "NULL", "null", "-", "--", "nan"], np.nan)
+        df = cleaning.blank_to_nan(df)
 
         # Определяем тип значения до объединения
         df["ТипТовара"] = df["КодКатегории"].notna().map({
@@ -1182,9 +1311,9 @@ class MainWindow(QMainWindow):
         df = df.drop(columns=["КодКатегории", "КодНоменклатурыПервый"])
 
         # --- Подтягиваем данные из Номенклатуры.csv ---
-        nom_path = "ВходныеДанные/Номенклатура.csv"
+        nom_df = catalogue.nomenclature("ВходныеДанные")
 
-        if not os.path.isfile(nom_path):
+        if nom_df is None:
             self.show_custom_message(
                 title="Ошибка",
                 text="Для корректной загрузки необходимо сначала загрузить файл Номенклатура.csv",
@@ -1192,9 +1321,6 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Читаем файл номенклатуры
-        nom_df = pd.read_csv(nom_path, sep="|", dtype=str)
-
         # Проверяем обязательные колонки
         required_nom_cols = ["КодНоменклатуры", "Номенклатура", "ВидНоменклатуры", "НазваниеНаСайте"]
         missing_nom = [col for col in required_nom_cols if col not in nom_df.columns]
@@ -1207,16 +1333,13 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Оставляем только нужные колонки
-        nom_df = nom_df[required_nom_cols]
-
-        # Объединяем основной df с номенклатурой
-        df = df.merge(nom_df, on="КодНоменклатуры", how="left")
+        # Объединяем основной df с номенклатурой (по индексу кода из кэша справочника)
+        df = catalogue.join(df, nom_df, on="КодНоменклатуры", columns=required_nom_cols[1:])
 
         # --- Подтягиваем данные из КатегорииСайта.csv ---
-        cat_path = "ВходныеДанные/КатегорииСайта.csv"
+        cat_df = catalogue.categories("ВходныеДанные")
 
-        if not os.path.isfile(cat_path):
+        if cat_df is None:
             self.show_custom_message(
                 title="Ошибка",
                 text="Для корректной загрузки необходимо сначала загрузить файл КатегорииСайта.csv",
@@ -1224,9 +1347,6 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Читаем файл категорий
-        cat_df = pd.read_csv(cat_path, sep="|", dtype=str)
-
         # Проверяем обязательные колонки
         required_cat_cols = ["КодКатегории", "НазваниеКатегории"]
         missing_cat = [col for col in required_cat_cols if col not in cat_df.columns]
@@ -1239,11 +1359,8 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Оставляем только нужные колонки
-        cat_df = cat_df[required_cat_cols]
-
-        # Объединяем основной df с номенклатурой
-        df = df.merge(cat_df, left_on="КодНоменклатуры", right_on="КодКатегории", how="left")
+        # Объединяем основной df с категориями (по индексу кода из кэша справочника)
+        df = catalogue.join(df, cat_df, on="КодНоменклатуры", columns=required_cat_cols[1:])
 
         # Упорядочиваем колонки
         column_order = [
@@ -1317,9 +1434,7 @@ class MainWindow(QMainWindow):
         df = df.drop(columns=["КодНоменклатурыРФ", "КодНоменклатурыКЗ"])
 
         # Объединяем номера телефонов
-        df["Телефон"] = (df["ТелефонОсновной"].combine_first(df["ЗапаснойТелефон"])
-                         .apply(
-            lambda x: str(x)[:-2] if pd.notnull(x) and str(x).endswith(".0") else str(x) if pd.notnull(x) else np.nan))
+        df["Телефон"] = cleaning.merge_phones(df["ТелефонОсновной"], df["ЗапаснойТелефон"])
         df = df.drop(columns=["ТелефонОсновной", "ЗапаснойТелефон"])
 
         # В колонке Дата оставляем только дату (убираем время)
@@ -1327,31 +1442,21 @@ class MainWindow(QMainWindow):
 
         df["ДатаРождения"] = pd.to_datetime(df["ДатаРождения"], errors='coerce')
 
-        # Рассчитываем возраст на момент заказа
-        df["Возраст"] = df.apply(
-            lambda row: row["Дата"].year - row["ДатаРождения"].year -
-                        ((row["Дата"].month, row["Дата"].day) < (row["ДатаРождения"].month, row["ДатаРождения"].day))
-            if pd.notnull(row["ДатаРождения"]) and pd.notnull(row["Дата"]) else np.nan,
-            axis=1
-        ).astype('Int64')
-
-        # Добавляем колонку с возрастной группой
-        df["ВозрастнаяГруппа"] = df["Возраст"].apply(self.get_age_group)
+        # Рассчитываем возраст на момент заказа и возрастную группу
+        self.add_age_columns(df)
 
         # Объединяем Имя, Фамилия, Отчество в ФИО
-        df["ФИО"] = df[["Фамилия", "Имя", "Отчество"]].fillna("").agg(" ".join, axis=1).str.strip()
+        df["ФИО"] = cleaning.full_name(df, ["Фамилия", "Имя", "Отчество"])
         df = df.drop(columns=["Имя", "Фамилия", "Отчество"])
 
         # В колонке Пол заменяем значения
         df["ПолКлиента"] = df["ПолКлиента"].replace({"male": "Мужской", "female": "Женский"})
 
         # Дисконтную карту приводим к строке, убираем ".0", если он был числом
-        df["ДисконтнаяКарта"] = df["ДисконтнаяКарта"].apply(
-            lambda x: str(int(x)) if pd.notnull(x) and str(x).endswith(".0") else str(x))
+        df["ДисконтнаяКарта"] = cleaning.strip_float_suffix(df["ДисконтнаяКарта"])
 
         # Айди майндбокса приводим к строке, убираем ".0", если он был числом
-        df["MindboxID"] = df["MindboxID"].apply(
-            lambda x: str(int(x)) if pd.notnull(x) and str(x).endswith(".0") else str(x))
+        df["MindboxID"] = cleaning.strip_float_suffix(df["MindboxID"])
 
         # Очистка категорий от точек и запятых
         for col in [
@@ -1359,20 +1464,12 @@ class MainWindow(QMainWindow):
             "СамаяПросматриваемаяРодительскаяКатегория",
             "СамаяПросматриваемаяДочерняяКатегория"
         ]:
-            df[col] = (
-                df[col]
-                .astype(str)
-                .str.replace(r"\.0$", "", regex=True)  # убираем только .0 в конце
-                .str.replace(r"[.,]", "", regex=True)  # убираем лишние знаки, если вдруг есть
-                .str.strip()
-            )
+            df[col] = cleaning.clean_category_code(df[col])
 
         # Объединяем любимые категории в одну колонку через "_"
-        df["ЛюбимаяКатегория"] = (df[["СамаяПросматриваемаяКатегория",
-                                      "СамаяПросматриваемаяРодительскаяКатегория",
-                                      "СамаяПросматриваемаяДочерняяКатегория"]]
-                                  .apply(lambda row: "_".join([str(x) for x in row if pd.notnull(x) and x != "nan"]),
-                                         axis=1))
+        df["ЛюбимаяКатегория"] = cleaning.join_present(df, ["СамаяПросматриваемаяКатегория",
+                                                           "СамаяПросматриваемаяРодительскаяКатегория",
+                                                           "СамаяПросматриваемаяДочерняяКатегория"], sep="_")
 
         # Удалим отдельные колонки категорий
         df = df.drop(columns=["СамаяПросматриваемаяКатегория",
@@ -1380,9 +1477,9 @@ class MainWindow(QMainWindow):
                               "СамаяПросматриваемаяДочерняяКатегория"])
 
         # --- Подтягиваем данные из Номенклатуры.csv ---
-        fav_path = "ВходныеДанные/Номенклатура.csv"
+        fav_df = catalogue.nomenclature("ВходныеДанные")
 
-        if not os.path.isfile(fav_path):
+        if fav_df is None:
             self.show_custom_message(
                 title="Ошибка",
                 text="Для корректной загрузки необходимо сначала загрузить файл Номенклатура.csv",
@@ -1390,9 +1487,6 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Читаем файл номенклатуры
-        fav_df = pd.read_csv(fav_path, sep="|", dtype=str)
-
         # Проверяем обязательные колонки
         required_fav_cols = ["КодНоменклатуры", "Номенклатура", "ВидНоменклатуры", "НазваниеНаСайте"]
         missing_fav = [col for col in required_fav_cols if col not in fav_df.columns]
@@ -1405,14 +1499,11 @@ class MainWindow(QMainWindow):
             )
             return None, None
 
-        # Оставляем только нужные колонки
-        fav_df = fav_df[required_fav_cols]
-
-        # Объединяем основной df с номенклатурой
-        df = df.merge(fav_df, on="КодНоменклатуры", how="left")
+        # Объединяем основной df с номенклатурой (по индексу кода из кэша справочника)
+        df = catalogue.join(df, fav_df, on="КодНоменклатуры", columns=required_fav_cols[1:])
 
         # Заменяем все виды пустых значений на np.nan
-        df = df.replace(["", " ", "  ", "None", "none", "NULL", "null", "-", "--", "nan"], np.nan)
+        df = cleaning.blank_to_nan(df)
 
         # Упорядочиваем колонки
         column_order = [
@@ -1452,6 +1543,26 @@ class MainWindow(QMainWindow):
         else:
             return "65+"
 
+    # Векторный расчёт колонок "Возраст" и "ВозрастнаяГруппа" (те же границы, что в get_age_group)
+    @staticmethod
+    def add_age_columns(df):
+        date = pd.to_datetime(df["Дата"], errors='coerce')
+        birth = pd.to_datetime(df["ДатаРождения"], errors='coerce')
+
+        # Полных лет: разница годов минус 1, если день рождения в этом году ещё не наступил
+        not_yet = (date.dt.month * 100 + date.dt.day) < (birth.dt.month * 100 + birth.dt.day)
+        age = date.dt.year - birth.dt.year - not_yet.astype(int)
+        df["Возраст"] = age.where(date.notna() & birth.notna()).astype('Int64')
+
+        value = df["Возраст"].to_numpy(dtype=float, na_value=np.nan)
+        groups = np.select(
+            [np.isnan(value), value < 14, value <= 25, value <= 35, value <= 45, value <= 55, value <= 65],
+            ["Не указан", "до 14", "14-25", "26-35", "36-45", "46-55", "56-65"],
+            default="65+",
+        )
+        df["ВозрастнаяГруппа"] = pd.Categorical(groups, categories=_AGE_GROUPS)
+        return df
+
     # -------------------------------------------ОБРАБОТКА НОМНЕКЛАТУРЫ-------------------------------------------------
     def process_nomenclature_file(self, df):
 
@@ -1480,16 +1591,10 @@ class MainWindow(QMainWindow):
         for col in [
             "КатегорияНаСайте",
         ]:
-            df[col] = (
-                df[col]
-                .astype(str)
-                .str.replace(r"\.0$", "", regex=True)  # убираем только .0 в конце
-                .str.replace(r"[.,]", "", regex=True)  # убираем лишние знаки, если вдруг есть
-                .str.strip()
-            )
+            df[col] = cleaning.clean_category_code(df[col])
 
         # Заменяем все виды пустых значений на np.nan
-        df = df.replace(["", " ", "  ", "None", "none", "NULL", "null", "-", "--", "nan"], np.nan)
+        df = cleaning.blank_to_nan(df)
 
         # Упорядочиваем колонки
         column_order = [
@@ -1527,16 +1632,10 @@ class MainWindow(QMainWindow):
             "КодКатегории",
             "КодРодительскойКатегории"
         ]:
-            df[col] = (
-                df[col]
-                .astype(str)
-                .str.replace(r"\.0$", "", regex=True)  # убираем только .0 в конце
-                .str.replace(r"[.,]", "", regex=True)  # убираем лишние знаки, если вдруг есть
-                .str.strip()
-            )
+            df[col] = cleaning.clean_category_code(df[col])
 
         # Заменяем все виды пустых значений на np.nan
-        df = df.replace(["", " ", "  ", "None", "none", "NULL", "null", "-", "--", "nan"], np.nan)
+        df = cleaning.blank_to_nan(df)
 
         # Упорядочиваем колонки
         column_order = ["КодКатегории", "НазваниеКатегории", "КодРодительскойКатегории"]
@@ -1554,16 +1653,16 @@ class MainWindow(QMainWindow):
         input_dir = os.path.join(os.getcwd(), "ВходныеДанные")
 
         files = {
-            "Заказы": "ЗаказыОригинал.csv",
-            "Просмотры": "ПросмотрыОригинал.csv",
-            "Избранное": "ИзбранноеОригинал.csv",
-            "Номенклатура": "Номенклатура.csv",
-            "Категории": "КатегорииСайта.csv"
+            "Заказы": "ЗаказыОригинал",
+            "Просмотры": "ПросмотрыОригинал",
+            "Избранное": "ИзбранноеОригинал",
+            "Номенклатура": "Номенклатура",
+            "Категории": "КатегорииСайта"
         }
 
         result = {}
-        for title, filename in files.items():
-            path = os.path.join(input_dir, filename)
+        for title, stem in files.items():
+            path = dataset_path(input_dir, stem)
             result[title] = os.path.exists(path)
 
         text = "Статус загрузки: " + ", ".join(
@@ -1667,7 +1766,7 @@ class MainWindow(QMainWindow):
         if selected_type == "Заказы клиентов из Mindbox":
 
             # Проверяем, существует ли файл
-            if not os.path.isfile("ВходныеДанные/ЗаказыОригинал.csv"):
+            if not os.path.isfile(dataset_path("ВходныеДанные", "ЗаказыОригинал")):
                 self.show_custom_message(title="Ошибка",
                                          text="Необходимо загрузить файл Заказы.csv перед началом анализа",
                                          image_path="Картинки/Неудача.png")
@@ -1676,7 +1775,7 @@ class MainWindow(QMainWindow):
             self.analyze_orders_full_dataset()
 
             # Проверяем, существует ли файл
-            if not os.path.isfile("ВходныеДанные/ЗаказыОтбор.csv"):
+            if not os.path.isfile(dataset_path("ВходныеДанные", "ЗаказыОтбор")):
                 self.show_custom_message(title="Ошибка",
                                          text="Необходимо загрузить файл Заказы.csv перед началом анализа",
                                          image_path="Картинки/Неудача.png")
@@ -1687,7 +1786,7 @@ class MainWindow(QMainWindow):
         elif selected_type == "Просмотры товаров и категорий из Mindbox":
 
             # Проверяем, существует ли файл
-            if not os.path.isfile("ВходныеДанные/ПросмотрыОригинал.csv"):
+            if not os.path.isfile(dataset_path("ВходныеДанные", "ПросмотрыОригинал")):
                 self.show_custom_message(title="Ошибка",
                                          text="Необходимо загрузить файл Просмотры.csv перед началом анализа",
                                          image_path="Картинки/Неудача.png")
@@ -1696,7 +1795,7 @@ class MainWindow(QMainWindow):
             self.analyze_views_full_dataset()
 
             # Проверяем, существует ли файл
-            if not os.path.isfile("ВходныеДанные/ПросмотрыОтбор.csv"):
+            if not os.path.isfile(dataset_path("ВходныеДанные", "ПросмотрыОтбор")):
                 self.show_custom_message(title="Ошибка",
                                          text="Необходимо загрузить файл Просмотры.csv перед началом анализа",
                                          image_path="Картинки/Неудача.png")
@@ -1707,7 +1806,7 @@ class MainWindow(QMainWindow):
         elif selected_type == "Добавление товаров в избранное из Mindbox":
 
             # Проверяем, существует ли файл
-            if not os.path.isfile("ВходныеДанные/ИзбранноеОригинал.csv"):
+            if not os.path.isfile(dataset_path("ВходныеДанные", "ИзбранноеОригинал")):
                 self.show_custom_message(title="Ошибка",
                                          text="Необходимо загрузить файл Избранное.csv перед началом анализа",
                                          image_path="Картинки/Неудача.png")
@@ -1716,7 +1815,7 @@ class MainWindow(QMainWindow):
             self.analyze_favorites_full_dataset()
 
             # Проверяем, существует ли файл
-            if not os.path.isfile("ВходныеДанные/ИзбранноеОтбор.csv"):
+            if not os.path.isfile(dataset_path("ВходныеДанные", "ИзбранноеОтбор")):
                 self.show_custom_message(title="Ошибка",
                                          text="Необходимо загрузить файл Избранное.csv перед началом анализа",
                                          image_path="Картинки/Неудача.png")
@@ -1759,7 +1858,7 @@ class MainWindow(QMainWindow):
     # -------------------------------------------АНАЛИЗ ЗАКЗАОВ---------------------------------------------------------
     def analyze_orders_full_dataset(self):
         try:
-            file_path = "ВходныеДанные/ЗаказыОригинал.csv"
+            file_path = dataset_path("ВходныеДанные", "ЗаказыОригинал")
 
             # Проверяем, существует ли файл
             if not os.path.isfile(file_path):
@@ -1769,8 +1868,8 @@ class MainWindow(QMainWindow):
 
             self.order_full_stats_label = self.reset_layout_with_label(self.main_order_full_layout)
 
-            # Загружаем CSV
-            df = pd.read_csv(file_path, sep="|", dtype=str)
+            # Загружаем датасет (parquet или CSV)
+            df = read_dataset(file_path)
 
             # Числовые поля
             df["Количество"] = pd.to_numeric(df["Количество"], errors="coerce").fillna(0).astype(int)
@@ -1953,7 +2052,7 @@ class MainWindow(QMainWindow):
 
     def analyze_orders_selection_dataset(self):
         try:
-            file_path = "ВходныеДанные/ЗаказыОтбор.csv"
+            file_path = dataset_path("ВходныеДанные", "ЗаказыОтбор")
 
             # Проверяем, существует ли файл
             if not os.path.isfile(file_path):
@@ -1964,8 +2063,8 @@ class MainWindow(QMainWindow):
 
             self.order_selection_stats_label = self.reset_layout_with_label(self.main_order_selection_layout)
 
-            # Загружаем CSV
-            df = pd.read_csv(file_path, sep="|", dtype=str)
+            # Загружаем датасет (parquet или CSV)
+            df = read_dataset(file_path)
 
             # Числовые поля
             df["Количество"] = pd.to_numeric(df["Количество"], errors="coerce").fillna(0).astype(int)
@@ -2150,7 +2249,7 @@ class MainWindow(QMainWindow):
     # -------------------------------------------АНАЛИЗ ПРОСМОТРОВ------------------------------------------------------
     def analyze_views_full_dataset(self):
         try:
-            file_path = "ВходныеДанные/ПросмотрыОригинал.csv"
+            file_path = dataset_path("ВходныеДанные", "ПросмотрыОригинал")
 
             # Проверяем, существует ли файл
             if not os.path.isfile(file_path):
@@ -2159,8 +2258,8 @@ class MainWindow(QMainWindow):
                                       stats_label=self.views_full_stats_label)
                 return
 
-            # Загружаем CSV
-            df = pd.read_csv(file_path, sep="|", dtype=str)
+            # Загружаем датасет (parquet или CSV)
+            df = read_dataset(file_path)
 
             # Числовые поля
             df["Возраст"] = pd.to_numeric(df["Возраст"], errors="coerce").fillna(0).astype(int)
@@ -2285,7 +2384,7 @@ class MainWindow(QMainWindow):
 
     def analyze_views_selection_dataset(self):
         try:
-            file_path = "ВходныеДанные/ПросмотрыОтбор.csv"
+            file_path = dataset_path("ВходныеДанные", "ПросмотрыОтбор")
 
             # Проверяем, существует ли файл
             if not os.path.isfile(file_path):
@@ -2294,8 +2393,8 @@ class MainWindow(QMainWindow):
                                       stats_label=self.views_selection_stats_label)
                 return
 
-            # Загружаем CSV
-            df = pd.read_csv(file_path, sep="|", dtype=str)
+            # Загружаем датасет (parquet или CSV)
+            df = read_dataset(file_path)
 
             # Числовые поля
             df["Возраст"] = pd.to_numeric(df["Возраст"], errors="coerce").fillna(0).astype(int)
@@ -2422,7 +2521,7 @@ class MainWindow(QMainWindow):
     # -------------------------------------------АНАЛИЗ ИЗБРАННОГО------------------------------------------------------
     def analyze_favorites_full_dataset(self):
         try:
-            file_path = "ВходныеДанные/ИзбранноеОригинал.csv"
+            file_path = dataset_path("ВходныеДанные", "ИзбранноеОригинал")
 
             # Проверяем, существует ли файл
             if not os.path.isfile(file_path):
@@ -2431,8 +2530,8 @@ class MainWindow(QMainWindow):
                                       stats_label=self.favorites_full_stats_label)
                 return
 
-            # Загружаем CSV
-            df = pd.read_csv(file_path, sep="|", dtype=str)
+            # Загружаем датасет (parquet или CSV)
+            df = read_dataset(file_path)
 
             # Числовые поля
             df["Возраст"] = pd.to_numeric(df["Возраст"], errors="coerce").fillna(0).astype(int)
@@ -2538,7 +2637,7 @@ class MainWindow(QMainWindow):
 
     def analyze_favorites_selection_dataset(self):
         try:
-            file_path = "ВходныеДанные/ИзбранноеОтбор.csv"
+            file_path = dataset_path("ВходныеДанные", "ИзбранноеОтбор")
 
             # Проверяем, существует ли файл
             if not os.path.isfile(file_path):
@@ -2547,8 +2646,8 @@ class MainWindow(QMainWindow):
                                       stats_label=self.favorites_selection_stats_label)
                 return
 
-            # Загружаем CSV
-            df = pd.read_csv(file_path, sep="|", dtype=str)
+            # Загружаем датасет (parquet или CSV)
+            df = read_dataset(file_path)
 
             # Числовые поля
             df["Возраст"] = pd.to_numeric(df["Возраст"], errors="coerce").fillna(0).astype(int)
@@ -3175,6 +3274,13 @@ if __name__ == "__main__":
                                         }
                                     """)
 
+    # --eager-imports воспроизводит прежний запуск (всё импортируется до окна) для сравнения времени
+    if "--eager-imports" in sys.argv:
+        import chardet, numpy, pandas, LightFM
+
     window = MainWindow()
     window.show()
+
+    # Отчёт печатается после первой отрисовки окна; --startup-report завершает приложение сразу после него
+    QTimer.singleShot(0, lambda: _report_startup(quit_after="--startup-report" in sys.argv))
     sys.exit(app.exec())
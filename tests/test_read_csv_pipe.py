@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LightFM  # noqa: E402
+
+
+# Коды из одних цифр должны читаться как есть ("007", а не "7") при любом движке CSV
+@pytest.mark.parametrize("engine", ["c", "pyarrow"])
+def test_read_csv_pipe_keeps_leading_zeros(tmp_path, monkeypatch, engine):
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setattr(LightFM, "_CSV_ENGINE", engine)
+    path = tmp_path / "orders.csv"
+    path.write_text(
+        "MindboxID|КодНоменклатуры|Дата|Количество|ТипТовара\n"
+        "007|000123|2024-01-01|1|Обувь\n"
+        "42|||2|\n",
+        encoding="utf-8-sig",
+    )
+
+    df = LightFM._read_csv_pipe(str(path), LightFM._EVENT_COLUMNS)
+    assert df["MindboxID"].tolist() == ["007", "42"]
+    assert df["КодНоменклатуры"].iloc[0] == "000123"
+    assert df["КодНоменклатуры"].isna().iloc[1]
+    assert str(df["ТипТовара"].dtype) == "category"
+
+    df = LightFM._read_csv_pipe(str(path))
+    assert df["MindboxID"].tolist() == ["007", "42"]